@@ -21,6 +21,7 @@ You should have received a copy of the GNU General Public License
 along with rq.  If not, see <http://www.gnu.org/licenses/>.
 """
 from peewee import *
+from peewee import mysql
 from app import RPM_URI, SRPM_URI
 from playhouse.db_url import connect
 from collections import namedtuple
@@ -29,12 +30,95 @@ rpm_db  = connect(RPM_URI)
 srpm_db = connect(SRPM_URI)
 
 def create_tables():
+    rpm_models  = [RPM_File, RPM_User, RPM_Group, RPM_Package, RPM_Provides, RPM_Requires,
+                   RPM_Symbols, RPM_SymbolName, RPM_Analysis, RPM_Tag, RPM_AlreadySeen, RPM_FileTrigram, RPM_SymbolTrigram,
+                   RPM_Dirname, RPM_Basename, RPM_TagStats]
+    srpm_models = [SRPM_File, SRPM_Package, SRPM_Source, SRPM_BuildRequires, SRPM_Tag, SRPM_Ctag,
+                   SRPM_AlreadySeen, SRPM_FileTrigram, SRPM_CtagTrigram, SRPM_Dirname, SRPM_Basename, SRPM_TagStats,
+                   SRPM_Archive]
     rpm_db.connect()
-    rpm_db.create_tables([RPM_File, RPM_User, RPM_Group, RPM_Package, RPM_Provides, RPM_Requires,
-               RPM_Symbols, RPM_Flags, RPM_Tag, RPM_AlreadySeen], True) # only create if it doesn't already exist
+    rpm_db.create_tables(rpm_models, True) # only create if it doesn't already exist
+    create_indexes(rpm_db, rpm_models)
     srpm_db.connect()
-    srpm_db.create_tables([SRPM_File, SRPM_Package, SRPM_Source, SRPM_BuildRequires, SRPM_Tag, SRPM_Ctag,
-               SRPM_AlreadySeen], True)
+    srpm_db.create_tables(srpm_models, True)
+    create_indexes(srpm_db, srpm_models)
+
+
+def create_indexes(database, models):
+    """
+    Creates the lookup indexes declared in each model's Meta.lookup_indexes that do not
+    exist yet, so this is safe to run against an existing database.  Each index is a
+    tuple of (field, prefix length) pairs; MySQL can't index TEXT columns without a
+    prefix length, everything else indexes the whole column and ignores it
+    :param database: the database the models live in
+    :param models: list of models to create indexes for
+    :return: list (names of the indexes created)
+    """
+    compiler = database.compiler()
+    created  = []
+    for model in models:
+        table    = model._meta.db_table
+        existing = set(index.name for index in database.get_indexes(table))
+        for fields in getattr(model._meta, 'lookup_indexes', ()):
+            columns = [model._meta.fields[field].db_column for (field, length) in fields]
+            name    = compiler.index_name(table, columns)
+            if name in existing:
+                continue
+
+            parts = []
+            for (column, (field, length)) in zip(columns, fields):
+                if length and isinstance(database, MySQLDatabase):
+                    parts.append('%s(%d)' % (compiler.quote(column), length))
+                else:
+                    parts.append(compiler.quote(column))
+            database.execute_sql('CREATE INDEX %s ON %s (%s)' % (compiler.quote(name), compiler.quote(table),
+                                                               ', '.join(parts)))
+            created.append(name)
+    return created
+
+
+def stream(query):
+    """
+    Yields the rows of a .dicts() query one at a time without holding the whole
+    result set in memory.  On MySQL this uses an unbuffered server-side cursor,
+    so no other queries may be run on the connection until the rows are consumed
+    """
+    database = query.database
+    if mysql and isinstance(database, MySQLDatabase):
+        (sql, params) = query.sql()
+        cursor = database.get_conn().cursor(mysql.cursors.SSCursor)
+        try:
+            cursor.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            for row in cursor:
+                yield dict(zip(columns, row))
+        finally:
+            cursor.close()
+    else:
+        for row in query.iterator():
+            yield row
+
+
+def concat(database, *parts):
+    """
+    Returns an expression joining strings together; MySQL only treats || as
+    concatenation in ANSI mode, so it gets CONCAT() instead
+    """
+    if isinstance(database, MySQLDatabase):
+        return fn.CONCAT(*parts)
+    expression = parts[0]
+    for part in parts[1:]:
+        expression = expression.concat(part)
+    return expression
+
+
+def split_path(path):
+    """
+    Splits a path into its directory, including the trailing slash the way rpm
+    stores DIRNAMES, and its basename; a path without a slash has a directory of ''
+    """
+    (dirname, sep, basename) = path.rpartition('/')
+    return (dirname + sep, basename)
 
 # tid is always tag id
 # pid is always package id
@@ -42,32 +126,163 @@ def create_tables():
 # uid is always user id
 # gid is always group id
 
-class RPMModel(Model):
-    class Meta:
-        database = rpm_db
+# the methods the models of both databases share
+class ModelMixin(object):
 
     @classmethod
     def optimize(cls):
+        # only MySQL has OPTIMIZE TABLE
+        if not isinstance(cls._meta.database, MySQLDatabase):
+            return
         query = 'OPTIMIZE TABLE %s' % cls._meta.db_table
-        database.execute_sql(query)
+        cls._meta.database.execute_sql(query)
         return
 
+    @classmethod
+    def bulk_insert(cls, rows, batch_size=500):
+        """
+        Insert rows using multi-row INSERT statements of batch_size rows each
+        :param rows: list of dicts mapping field names to values
+        :param batch_size: the number of rows to send per INSERT
+        :return: int (number of rows inserted)
+        """
+        with cls._meta.database.atomic():
+            for x in range(0, len(rows), batch_size):
+                cls.insert_many(rows[x:x + batch_size]).execute()
+        return len(rows)
 
-class SRPMModel(Model):
+    @classmethod
+    def delete_tags(cls, tid, batch_size=10000, progress=None):
+        """
+        Delete the rows with this tid batch_size rows at a time, each batch in its own
+        statement, so that deleting a large tag never holds its locks for long; the
+        batches are ranges of ids so that this works the same with every database
+        :param tid: tid to remove
+        :param batch_size: the number of rows to delete per statement
+        :param progress: called after each batch with the number of rows removed so far
+        :return: int (number of rows removed)
+        """
+        removed = 0
+        while True:
+            query  = cls.select(cls.id).where(cls.tid == tid).order_by(cls.id.asc()).limit(1).offset(batch_size - 1)
+            bound  = [rid for (rid,) in query.tuples()]
+            delete = cls.delete().where(cls.tid == tid)
+            if bound:
+                delete = delete.where(cls.id <= bound[0])
+            removed += delete.execute()
+            if progress:
+                progress(removed)
+            if not bound:
+                return removed
+
+
+class RPMModel(ModelMixin, Model):
     class Meta:
-        database = srpm_db
+        database = rpm_db
+
+
+# the methods of the tables that store every distinct name once
+class DictionaryMixin(object):
 
     @classmethod
-    def optimize(cls):
-        query = 'OPTIMIZE TABLE %s' % cls._meta.db_table
-        database.execute_sql(query)
-        return
+    def get_ids(cls, names):
+        """
+        Returns the ids of the provided names, for those that are known
+        :param names: list of names to lookup
+        :return: dict (name: id)
+        """
+        ids   = {}
+        names = list(names)
+        # names come back from the database as unicode, which doesn't match an encoded
+        # string asked for unless it is plain ASCII, so they are mapped back
+        asked = dict((isinstance(name, str) and name.decode('utf-8', 'replace') or name, name) for name in names)
+        for x in range(0, len(names), 500):
+            query = cls.select(cls.id, cls.name).where(cls.name << names[x:x + 500]).tuples()
+            ids.update((asked.get(name, name), nid) for (nid, name) in query)
+        return ids
+
+    @classmethod
+    def intern(cls, names, cache, batch_size=500):
+        """
+        Adds the names that aren't known yet; cache is a dict (name: id) that is checked
+        first and updated with the ids of all of the names
+        :param names: list of names
+        :param cache: dict (name: id)
+        :param batch_size: the number of rows to send per INSERT
+        :return: dict (name: id) of the names that were added
+        """
+        missing = set(name for name in names if name not in cache)
+        if not missing:
+            return {}
+
+        cache.update(cls.get_ids(missing))
+        new = [name for name in missing if name not in cache]
+        if not new:
+            return {}
+
+        cls.bulk_insert([{'name': name} for name in new], batch_size)
+        added = cls.get_ids(new)
+        cache.update(added)
+        return added
+
+    @classmethod
+    def prune(cls, ref, index=None, batch_size=500):
+        """
+        Delete the names that nothing refers to any more, and their trigram index entries
+        :param ref: the foreign key field that refers to this model
+        :param index: the trigram index model of this model, if there is one
+        :param batch_size: the number of names to delete per statement
+        :return: int (number of names removed)
+        """
+        # collected up front as MySQL can't delete from a table it is selecting from
+        query = cls.select(cls.id).join(ref.model_class, JOIN_LEFT_OUTER, on=(ref == cls.id)).where(
+                    ref.model_class.id >> None)
+        ids   = [nid for (nid,) in query.tuples()]
+
+        for x in range(0, len(ids), batch_size):
+            batch = ids[x:x + batch_size]
+            if index:
+                index.delete().where(index.ref << batch).execute()
+            cls.delete().where(cls.id << batch).execute()
+        return len(ids)
+
+
+# the base model of the tables that store every distinct name once, so that other
+# tables can refer to a name by its id rather than repeating it
+class RPMDictionary(DictionaryMixin, RPMModel):
+    name = TextField(null=False)
+
+    class Meta:
+        lookup_indexes = (
+            (('name', 191),),
+        )
+
+
+class SRPMModel(ModelMixin, Model):
+    class Meta:
+        database = srpm_db
+
+
+# the base model of the tables that store every distinct name once, so that other
+# tables can refer to a name by its id rather than repeating it
+class SRPMDictionary(DictionaryMixin, SRPMModel):
+    name = TextField(null=False)
+
+    class Meta:
+        lookup_indexes = (
+            (('name', 191),),
+        )
 
 
 # the binary rpm user model
 class RPM_User(RPMModel):
     user = CharField(null=False)  # f_user
 
+    class Meta:
+        lookup_indexes = (
+            (('user', 191),),
+        )
+
     @classmethod
     def get_id(cls, name):
         """
@@ -81,6 +296,15 @@ class RPM_User(RPMModel):
         except:
             return None
 
+    @classmethod
+    def get_ids(cls):
+        """
+        Returns the ids of every user, in one query
+        :return: dict (user name: uid)
+        """
+        query = RPM_User.select(RPM_User.id, RPM_User.user).tuples()
+        return dict((name, uid) for (uid, name) in query)
+
     @classmethod
     def get_name(cls, uid):
         """
@@ -102,6 +326,11 @@ class RPM_User(RPMModel):
 class RPM_Group(RPMModel):
     group = CharField(null=False)  # f_group
 
+    class Meta:
+        lookup_indexes = (
+            (('group', 191),),
+        )
+
     @classmethod
     def get_id(cls, name):
         """
@@ -115,6 +344,15 @@ class RPM_Group(RPMModel):
         except:
             return None
 
+    @classmethod
+    def get_ids(cls):
+        """
+        Returns the ids of every group, in one query
+        :return: dict (group name: gid)
+        """
+        query = RPM_Group.select(RPM_Group.id, RPM_Group.group).tuples()
+        return dict((name, gid) for (gid, name) in query)
+
     @classmethod
     def get_name(cls, gid):
         """
@@ -140,6 +378,11 @@ class RPM_Tag(RPMModel):  # tags
     update_path = CharField(null=False)
     update_date = CharField(default='')
 
+    class Meta:
+        lookup_indexes = (
+            (('tag', 191),),
+        )
+
     @classmethod
     def get_tag(cls, id):
         """
@@ -207,7 +450,7 @@ class RPM_Tag(RPMModel):  # tags
         Return the number of packages
         :return: int
         """
-        return RPM_Package.select().where(RPM_Package.tid == self.id).count()
+        return RPM_TagStats.get_counts(self.id)['packages']
 
     @property
     def update_count(self):
@@ -215,7 +458,7 @@ class RPM_Tag(RPMModel):  # tags
         Return the number of updates packages
         :return: int
         """
-        return RPM_Package.select().where((RPM_Package.tid == self.id) & (RPM_Package.update == 1)).count()
+        return RPM_TagStats.get_counts(self.id)['updates']
 
 
     def __repr__(self):
@@ -228,12 +471,20 @@ class RPM_Package(RPMModel):
     package  = TextField(null=False)  # p_package
     version  = TextField(null=False)  # p_version
     release  = TextField(null=False)  # p_release
+    epoch    = IntegerField(null=True)  # p_epoch
+    evr      = CharField(null=False)  # rq.evr.evr_key(), sorts the way rpm orders versions
     date     = TextField(null=False)  # p_date
     arch     = CharField(null=False)  # p_arch
     srpm     = TextField(null=False)  # p_srpm
     fullname = TextField(null=False)  # p_fullname
     update   = IntegerField(default=0)  # p_update
 
+    class Meta:
+        lookup_indexes = (
+            (('tid', None), ('package', 100), ('version', 50), ('release', 50), ('arch', 32)),
+            (('tid', None), ('fullname', 191)),
+        )
+
     @property
     def tag(self):
         t = RPM_Tag.get(RPM_Tag.id == self.tid)
@@ -281,6 +532,16 @@ class RPM_Package(RPMModel):
             return True
         return False
 
+    @classmethod
+    def get_packages(cls, tid):
+        """
+        Returns every package in a tag, with just what is needed to plan an import or update
+        :param tid: tag id to lookup
+        :return: list of package records
+        """
+        return list(RPM_Package.select(RPM_Package.id, RPM_Package.fullname, RPM_Package.package, RPM_Package.version,
+                                       RPM_Package.release, RPM_Package.arch).where(RPM_Package.tid == tid))
+
     @classmethod
     def list_updates(cls, tag):
         """
@@ -342,17 +603,157 @@ class RPM_Requires(RPMModel):  # requires
         return '<RPM Requires {self.name}>'.format(self=self)
 
 
-# the binary rpm files model
+# the binary analysis model; the flags (and symbols) of an ELF binary are stored once per
+# content digest and shared by every file with the same contents, whatever package or tag it is in
+class RPM_Analysis(RPMModel):
+    digest  = CharField(max_length=128, null=False)
+    relro   = IntegerField(default=0)  # f_relro
+    ssp     = IntegerField(default=0)  # f_ssp
+    pie     = IntegerField(default=0)  # f_pie
+    fortify = IntegerField(default=0)  # f_fortify
+    nx      = IntegerField(default=0)  # f_nx
+
+    class Meta:
+        lookup_indexes = (
+            (('digest', None),),
+        )
+
+    @classmethod
+    def get_ids(cls, digests):
+        """
+        Returns the analysis ids of the provided digests, for those that have been analyzed
+        :param digests: list of digests to lookup
+        :return: dict (digest: analysis id)
+        """
+        ids     = {}
+        digests = list(digests)
+        for x in range(0, len(digests), 500):
+            query = RPM_Analysis.select(RPM_Analysis.id, RPM_Analysis.digest).where(
+                        RPM_Analysis.digest << digests[x:x + 500]).tuples()
+            ids.update((digest, aid) for (aid, digest) in query)
+        return ids
+
+    @classmethod
+    def get_digests(cls):
+        """
+        Returns the digests of every binary that has been analyzed
+        :return: set
+        """
+        return set(digest for (digest,) in RPM_Analysis.select(RPM_Analysis.digest).tuples())
+
+    @classmethod
+    def describe(cls, relro, ssp, nx, pie, fortify):
+        """
+        Returns described flags for the provided numerical values
+        :return: object
+        """
+        # these are the default values
+        newflags  = namedtuple('newflags', 'relro ssp nx pie fortify')
+        n_relro   = 'none'
+        n_ssp     = 'not found'
+        n_nx      = 'disabled'
+        n_pie     = 'none'
+        n_fortify = 'not found'
+
+        if relro == 1:
+            n_relro = 'full'
+        elif relro == 2:
+            n_relro = 'partial'
+
+        if ssp == 1:
+            n_ssp = 'found'
+
+        if nx == 1:
+            n_nx = 'enabled'
+
+        if pie == 2:
+            n_pie = 'DSO'
+        elif pie == 1:
+            n_pie = 'enabled'
+
+        if fortify == 1:
+            n_fortify = 'found'
+
+        return newflags(relro=n_relro, ssp=n_ssp, nx=n_nx, pie=n_pie, fortify=n_fortify)
+
+    @classmethod
+    def prune(cls, batch_size=500):
+        """
+        Delete the analyses (and their symbols) that no file refers to any more, and the
+        symbol names no analysis uses, which is what is left behind when packages or tags
+        are removed
+        :param batch_size: the number of analyses to delete per statement
+        :return: int (number of analyses removed)
+        """
+        # collected up front as MySQL can't delete from a table it is selecting from
+        query = RPM_Analysis.select(RPM_Analysis.id).join(
+                    RPM_File, JOIN_LEFT_OUTER, on=(RPM_File.aid == RPM_Analysis.id)).where(RPM_File.id >> None)
+        aids  = [aid for (aid,) in query.tuples()]
+
+        symbols = 0
+        for x in range(0, len(aids), batch_size):
+            batch    = aids[x:x + batch_size]
+            symbols += RPM_Symbols.delete().where(RPM_Symbols.aid << batch).execute()
+            RPM_Analysis.delete().where(RPM_Analysis.id << batch).execute()
+
+        if aids:
+            RPM_TagStats.add(None, flags=-len(aids), symbols=-symbols)
+            # and the names of symbols that no binary has any more
+            RPM_SymbolName.prune(RPM_Symbols.sid, RPM_SymbolTrigram, batch_size)
+        return len(aids)
+
+    def __repr__(self):
+        return '<RPM Analysis {self.digest}>'.format(self=self)
+
+
+# the binary rpm directory name model; every distinct directory is stored once
+class RPM_Dirname(RPMDictionary):
+
+    def __repr__(self):
+        return '<RPM Dirname {self.name}>'.format(self=self)
+
+
+# the binary rpm basename model; every distinct file basename is stored once
+class RPM_Basename(RPMDictionary):
+
+    def __repr__(self):
+        return '<RPM Basename {self.name}>'.format(self=self)
+
+
+# the binary rpm files model; paths are stored as a directory and a basename, the way rpm does
 class RPM_File(RPMModel):
     pid     = ForeignKeyField(RPM_Package, related_name='file')  # p_record
     tid     = ForeignKeyField(RPM_Tag, related_name='file')  # t_record
     uid     = ForeignKeyField(RPM_User, related_name='file')  # u_record
     gid     = ForeignKeyField(RPM_Group, related_name='file')  # g_record
-    file    = TextField()  # files
+    aid     = ForeignKeyField(RPM_Analysis, related_name='file', null=True)  # binaries only
+    did     = ForeignKeyField(RPM_Dirname, related_name='file')
+    bid     = ForeignKeyField(RPM_Basename, related_name='file')
     is_suid = IntegerField(default=0)  # f_is_suid
     is_sgid = IntegerField(default=0)  # f_is_sgid
     perms   = CharField()  # f_perms
 
+    class Meta:
+        lookup_indexes = (
+            (('tid', None), ('pid', None)),
+        )
+
+    @classmethod
+    def path(cls):
+        """
+        Returns an expression for the full path of a file, for queries that have been
+        through join_path()
+        """
+        return concat(rpm_db, RPM_Dirname.name, RPM_Basename.name)
+
+    @classmethod
+    def join_path(cls, query):
+        """
+        Joins the directory and basename of each file onto a query that includes RPM_File
+        """
+        return query.switch(RPM_File).join(RPM_Dirname, on=(RPM_File.did == RPM_Dirname.id)).switch(
+                   RPM_File).join(RPM_Basename, on=(RPM_File.bid == RPM_Basename.id)).switch(RPM_File)
+
     @classmethod
     def find_id(cls, file, tid, pid):
         """
@@ -362,13 +763,27 @@ class RPM_File(RPMModel):
         :param pid: the package id to lookup
         :return: int
         """
+        (dirname, basename) = split_path(file)
         try:
-            file = RPM_File.get(
-                (RPM_File.file == file) & (RPM_File.pid == pid) & (RPM_File.tid == tid))
+            file = RPM_File.join_path(RPM_File.select(RPM_File.id)).where(
+                (RPM_Dirname.name == dirname) & (RPM_Basename.name == basename) &
+                (RPM_File.pid == pid) & (RPM_File.tid == tid)).get()
             return file.id
         except:
             return None
 
+    @classmethod
+    def get_ids(cls, tid, pid):
+        """
+        Returns the file ids of every file in a package, in one query
+        :param tid: the tag id to lookup
+        :param pid: the package id to lookup
+        :return: dict (file name: file id)
+        """
+        query = RPM_File.join_path(RPM_File.select(RPM_File.id, RPM_File.path())).where(
+                    (RPM_File.pid == pid) & (RPM_File.tid == tid)).tuples()
+        return dict((path, fid) for (fid, path) in query)
+
     @classmethod
     def get_name(cls, fid):
         """
@@ -377,7 +792,7 @@ class RPM_File(RPMModel):
         :return: int
         """
         try:
-            file = RPM_File.get((RPM_File.id == fid))
+            file = RPM_File.join_path(RPM_File.select(RPM_File.path().alias('file'))).where(RPM_File.id == fid).get()
             return file.file
         except:
             return None
@@ -395,23 +810,19 @@ class RPM_File(RPMModel):
         elif db_col == 'is_sgid':
             sxid_cond = ((RPM_File.is_sgid == 1))
 
-        # TODO would really love to get this to work, but it doesn't yet give me the values for user, group, etc just files
-        # TODO getting this to work would save some extra lame queries
-        query = (RPM_File.select().join(
-                    RPM_Package, on=(RPM_File.pid == RPM_Package.id)).join(
-                    RPM_User, JOIN_LEFT_OUTER, on=(RPM_File.uid == RPM_User.id)).join(
+        query = (RPM_File.join_path(RPM_File.select(RPM_Package.package, RPM_File.path().alias('file'), RPM_User.user,
+                    RPM_Group.group, RPM_File.perms)).join(
+                    RPM_Package, on=(RPM_File.pid == RPM_Package.id)).switch(RPM_File).join(
+                    RPM_User, JOIN_LEFT_OUTER, on=(RPM_File.uid == RPM_User.id)).switch(RPM_File).join(
                     RPM_Group, JOIN_LEFT_OUTER, on=(RPM_File.gid == RPM_Group.id)).where(
                     sxid_cond & (RPM_File.tid == tid)).order_by(
-                    RPM_Package.package.asc()))
+                    RPM_Package.package.asc()).dicts())
 
         #print query
         out = []
         s = namedtuple('s', 'package file user group perms')
         for q in query:
-            u = RPM_User.get(RPM_User.id == q.uid)
-            g = RPM_Group.get(RPM_Group.id == q.gid)
-            p = RPM_Package.get(RPM_Package.id == q.pid)
-            out.append(s(package=p.package, file=q.file, user=u.user, group=g.group, perms=q.perms))
+            out.append(s(**q))
         return out
 
         # query = "SELECT p_package, files, f_user, f_group, f_perms FROM files JOIN packages ON \
@@ -422,112 +833,223 @@ class RPM_File(RPMModel):
 
 
     def __repr__(self):
-        return '<RPM File {self.file}>'.format(self=self)
+        return '<RPM File {self.id}>'.format(self=self)
+
+
+# the binary rpm symbol name model; every distinct symbol name is stored once
+class RPM_SymbolName(RPMDictionary):
+
+    def __repr__(self):
+        return '<RPM Symbol Name {self.name}>'.format(self=self)
 
 
-# the binary rpm symbols model
+# the binary rpm symbols model; links the symbol names to the analysis of each binary
 class RPM_Symbols(RPMModel):  # symbols
-    pid     = ForeignKeyField(RPM_Package, related_name='symbols') # p_record
-    tid     = ForeignKeyField(RPM_Tag, related_name='symbols') # t_record
-    fid     = ForeignKeyField(RPM_File, related_name='symbols') # f_id
-    symbols = TextField(null=False)
+    aid = ForeignKeyField(RPM_Analysis, related_name='symbols')
+    sid = ForeignKeyField(RPM_SymbolName, related_name='symbols')
 
     @classmethod
-    def delete_tags(cls, tid):
+    def get_counts(cls, aids):
         """
-        Delete symbols with this tid
-        :param tid: tid to remove
-        :return: int (number of symbols removed)
+        Returns the number of symbols each of the provided analyses has
+        :param aids: list of analysis ids to lookup
+        :return: dict (analysis id: number of symbols)
         """
-        query   = RPM_Symbols.delete().where(RPM_Symbols.tid == tid)
-        removed = query.execute()
-        return removed
+        counts = {}
+        aids   = list(aids)
+        for x in range(0, len(aids), 500):
+            query = RPM_Symbols.select(RPM_Symbols.aid, fn.COUNT(RPM_Symbols.id)).where(
+                        RPM_Symbols.aid << aids[x:x + 500]).group_by(RPM_Symbols.aid).tuples()
+            counts.update(query)
+        return counts
 
     def __repr__(self):
-        return '<RPM Symbol {self.symbols}>'.format(self=self)
+        return '<RPM Symbol {self.sid.name}>'.format(self=self)
 
 
-# the binary rpm flags model
-class RPM_Flags(RPMModel):  # flags
-    pid     = ForeignKeyField(RPM_Package, related_name='flags')  # p_record
-    tid     = ForeignKeyField(RPM_Tag, related_name='flags')  # t_record
-    fid     = ForeignKeyField(RPM_File, related_name='flags')  # f_id
-    relro   = IntegerField(default=0)  # f_relro
-    ssp     = IntegerField(default=0)  # f_ssp
-    pie     = IntegerField(default=0)  # f_pie
-    fortify = IntegerField(default=0)  # f_fortify
-    nx      = IntegerField(default=0)  # f_nx
+# the binary alreadyseen model
+class RPM_AlreadySeen(RPMModel):
+    fullname = TextField(null=False)
+    tid      = ForeignKeyField(RPM_Tag, related_name='alreadyseen')
+
+    class Meta:
+        lookup_indexes = (
+            (('tid', None), ('fullname', 191)),
+        )
 
     @classmethod
-    def get_named(cls, fid):
+    def exists(cls, tid, name):
         """
-        Returns described flags rather than their numerical values we return what the values mean
-        :param fid: integer of file id to look up
-        :return: object or None
+        Find out if the supplied filename and associated tag is in the database
+
+        :param tid: tag id to lookup
+        :param name: filename to lookup
+        :return: True if exists, False otherwise
         """
-        try:
-            f = RPM_Flags.get(RPM_Flags.fid == fid)
-        except:
-            return None
+        if RPM_AlreadySeen.select().where((RPM_AlreadySeen.tid == tid) & (RPM_AlreadySeen.fullname == name)):
+            return True
+        return False
 
-        # these are the default values
-        newflags = namedtuple('newflags', 'relro ssp nx pie fortify')
-        relro    = 'none'
-        ssp      = 'not found'
-        nx       = 'disabled'
-        pie      = 'none'
-        fortify  = 'not found'
+    @classmethod
+    def get_fullnames(cls, tid):
+        """
+        Returns the names of every package that has been seen in a tag
+        :param tid: tag id to lookup
+        :return: list
+        """
+        return [fullname for (fullname,) in RPM_AlreadySeen.select(RPM_AlreadySeen.fullname).where(RPM_AlreadySeen.tid == tid).tuples()]
+
+
+# the binary rpm file basename trigram index model; only populated when trigram_index is enabled.
+# Basenames are shared by every tag, so these are removed by RPM_Basename.prune()
+class RPM_FileTrigram(RPMModel):
+    ref     = ForeignKeyField(RPM_Basename, related_name='trigram')
+    trigram = CharField(max_length=3, null=False)
 
-        if f.relro == 1:
-            relro = 'full'
-        elif f.relro == 2:
-            relro = 'partial'
+    class Meta:
+        indexes = (
+            (('trigram', 'ref'), False),
+        )
 
-        if f.ssp == 1:
-            ssp = 'found'
 
-        if f.nx == 1:
-            nx = 'enabled'
+# the binary rpm symbol name trigram index model; only populated when trigram_index is enabled.  Symbol
+# names are shared by every tag, so these are removed by RPM_Analysis.prune()
+class RPM_SymbolTrigram(RPMModel):
+    ref     = ForeignKeyField(RPM_SymbolName, related_name='trigram')
+    trigram = CharField(max_length=3, null=False)
 
-        if f.pie == 2:
-            pie = 'DSO'
-        elif f.pie == 1:
-            pie = 'enabled'
+    class Meta:
+        indexes = (
+            (('trigram', 'ref'), False),
+        )
 
-        if f.fortify == 1:
-            fortify = 'found'
 
-        return newflags(relro=relro, ssp=ssp, nx=nx, pie=pie, fortify=fortify)
+# the methods of the tag statistics models; each model lists its counters in counters and
+# counts them from scratch with count_rows()
+class TagStatsMixin(object):
 
     @classmethod
-    def delete_tags(cls, tid):
+    def add(cls, tid, **counts):
         """
-        Delete flags with this tid
-        :param tid: tid to remove
-        :return: int (number of flag entries removed)
+        Add to (or, with negative numbers, take away from) the counters of a tag; a tag that
+        has no counters yet is counted from scratch instead, which picks up the change as well
+        :param tid: tag id, or None for the counters of the whole database
+        :param counts: the counters to change and by how much
+        :return: nothing
         """
-        query   = RPM_Flags.delete().where(RPM_Flags.tid == tid)
-        removed = query.execute()
-        return removed
-
-
-# the binary alreadyseen model
-class RPM_AlreadySeen(RPMModel):
-    fullname = TextField(null=False)
-    tid      = ForeignKeyField(RPM_Tag, related_name='alreadyseen')
+        counts = dict((name, count) for (name, count) in counts.items() if count)
+        if not counts:
+            return
+        query = cls.update(**dict((name, getattr(cls, name) + count) for (name, count) in counts.items()))
+        if not query.where(cls.for_tag(tid)).execute():
+            cls.recount(tid)
 
     @classmethod
-    def exists(cls, tid, name):
+    def for_tag(cls, tid):
         """
-        Find out if the supplied filename and associated tag is in the database
+        Returns the expression that selects the counters of a tag
+        """
+        if tid is None:
+            return cls.tid >> None
+        return cls.tid == tid
 
-        :param tid: tag id to lookup
-        :param name: filename to lookup
-        :return: True if exists, False otherwise
+    @classmethod
+    def recount(cls, tid):
         """
-        if RPM_AlreadySeen.select().where((RPM_AlreadySeen.tid == tid) & (RPM_AlreadySeen.fullname == name)):
-            return True
-        return False
+        Replaces the counters of a tag (or those of the whole database) with what is in the tables
+        :param tid: tag id, or None for the counters of the whole database
+        :return: dict (counter: number)
+        """
+        counts = cls.count_rows(tid)
+        with cls._meta.database.atomic():
+            cls.delete().where(cls.for_tag(tid)).execute()
+            cls.create(tid=tid, **counts)
+        return counts
+
+    @classmethod
+    def get_counts(cls, tid=None):
+        """
+        Returns the counters of a tag, or for the whole database the sum of every tag's counters;
+        anything not counted yet is counted first
+        :param tid: tag id
+        :return: dict (counter: number)
+        """
+        if tid is not None:
+            row = cls.select().where(cls.tid == tid).first()
+            if not row:
+                return cls.recount(tid)
+            return dict((name, getattr(row, name)) for name in cls.counters)
+
+        tag     = cls.tid.rel_model
+        missing = tag.select(tag.id).join(cls, JOIN_LEFT_OUTER, on=(cls.tid == tag.id)).where(cls.id >> None)
+        for (mtid,) in missing.tuples():
+            cls.recount(mtid)
+
+        sums = cls.select(*[fn.SUM(getattr(cls, name)) for name in cls.counters]).where(cls.tid.is_null(False))
+        return dict(zip(cls.counters, [int(count or 0) for count in sums.tuples().get()]))
+
+
+# the binary rpm tag statistics model; the number of rows each tag has in the other tables, kept up to
+# date as packages are added and removed so that nothing needs to count them.  The row with a tid of
+# None holds the number of analyses and symbols in the database, which are shared between tags
+class RPM_TagStats(TagStatsMixin, RPMModel):
+    tid      = ForeignKeyField(RPM_Tag, related_name='stats', null=True, unique=True)
+    packages = IntegerField(default=0)
+    updates  = IntegerField(default=0)
+    files    = IntegerField(default=0)
+    requires = IntegerField(default=0)
+    provides = IntegerField(default=0)
+    flags    = IntegerField(default=0)  # files that have an analysis
+    symbols  = IntegerField(default=0)  # symbols of those files
+
+    counters = ('packages', 'updates', 'files', 'requires', 'provides', 'flags', 'symbols')
+
+    @classmethod
+    def count_rows(cls, tid, pid=None):
+        """
+        Counts the rows of a tag, or of one package in it, the slow way
+        :param tid: tag id, or None for the analyses and symbols of the whole database
+        :param pid: package id
+        :return: dict (counter: number)
+        """
+        if tid is None:
+            return {'flags': RPM_Analysis.select().count(), 'symbols': RPM_Symbols.select().count()}
+
+        def rows(model, key):
+            query = model.select().where(model.tid == tid)
+            if pid:
+                query = query.where(key == pid)
+            return query
+
+        files = rows(RPM_File, RPM_File.pid)
+        return {'packages': rows(RPM_Package, RPM_Package.id).count(),
+                'updates' : rows(RPM_Package, RPM_Package.id).where(RPM_Package.update == 1).count(),
+                'files'   : files.count(),
+                'requires': rows(RPM_Requires, RPM_Requires.pid).count(),
+                'provides': rows(RPM_Provides, RPM_Provides.pid).count(),
+                'flags'   : files.where(RPM_File.aid.is_null(False)).count(),
+                'symbols' : files.join(RPM_Symbols, on=(RPM_Symbols.aid == RPM_File.aid)).count()}
+
+    @classmethod
+    def get_counts(cls, tid=None):
+        """
+        Returns the counters of a tag, or for the whole database the sum of every tag's counters
+        but with the analyses and symbols in the database as the flags and symbols; anything not
+        counted yet is counted first
+        :param tid: tag id
+        :return: dict (counter: number)
+        """
+        counts = super(RPM_TagStats, cls).get_counts(tid)
+        if tid is None:
+            row = cls.select().where(cls.tid >> None).first()
+            if row:
+                counts.update(flags=row.flags, symbols=row.symbols)
+            else:
+                counts.update(cls.recount(None))
+        return counts
+
+    def __repr__(self):
+        return '<RPM TagStats {self.tid}>'.format(self=self)
 
 
 #############################################################################
@@ -544,6 +1066,11 @@ class SRPM_Tag(SRPMModel):  # tags
     update_path = CharField(null=False)
     update_date = CharField(default='')
 
+    class Meta:
+        lookup_indexes = (
+            (('tag', 191),),
+        )
+
     @classmethod
     def get_tag(cls, id):
         """
@@ -611,7 +1138,7 @@ class SRPM_Tag(SRPMModel):  # tags
         Return the number of packages
         :return: int
         """
-        return SRPM_Package.select().where(SRPM_Package.tid == self.id).count()
+        return SRPM_TagStats.get_counts(self.id)['packages']
 
     @property
     def update_count(self):
@@ -619,7 +1146,7 @@ class SRPM_Tag(SRPMModel):  # tags
         Return the number of updates packages
         :return: int
         """
-        return SRPM_Package.select().where((SRPM_Package.tid == self.id) & (SRPM_Package.update == 1)).count()
+        return SRPM_TagStats.get_counts(self.id)['updates']
 
 
     def __repr__(self):
@@ -632,10 +1159,18 @@ class SRPM_Package(SRPMModel):
     package  = TextField(null=False)  # p_package
     version  = TextField(null=False)  # p_version
     release  = TextField(null=False)  # p_release
+    epoch    = IntegerField(null=True)  # p_epoch
+    evr      = CharField(null=False)  # rq.evr.evr_key(), sorts the way rpm orders versions
     date     = TextField(null=False)  # p_date
     fullname = TextField(null=False)  # p_fullname
     update   = IntegerField(default=0)  # p_update
 
+    class Meta:
+        lookup_indexes = (
+            (('tid', None), ('package', 100), ('version', 50), ('release', 50)),
+            (('tid', None), ('fullname', 191)),
+        )
+
     @property
     def tag(self):
         t = SRPM_Tag.get(SRPM_Tag.id == self.tid)
@@ -682,6 +1217,16 @@ class SRPM_Package(SRPMModel):
             return True
         return False
 
+    @classmethod
+    def get_packages(cls, tid):
+        """
+        Returns every package in a tag, with just what is needed to plan an import or update
+        :param tid: tag id to lookup
+        :return: list of package records
+        """
+        return list(SRPM_Package.select(SRPM_Package.id, SRPM_Package.fullname, SRPM_Package.package, SRPM_Package.version,
+                                        SRPM_Package.release).where(SRPM_Package.tid == tid))
+
     @classmethod
     def list_updates(cls, tag):
         """
@@ -704,6 +1249,11 @@ class SRPM_Source(SRPMModel):
     stype   = CharField()  # s_type
     file    = TextField()  # s_file
 
+    class Meta:
+        lookup_indexes = (
+            (('pid', None), ('file', 191)),
+        )
+
     @classmethod
     def find_id(cls, pid, sfile):
         """
@@ -718,16 +1268,62 @@ class SRPM_Source(SRPMModel):
         except:
             return None
 
+    @classmethod
+    def get_ids(cls, pid):
+        """
+        Returns the source ids of every source file in a package, in one query
+        :param pid: the package id to look up
+        :return: dict (source file: source id)
+        """
+        query = SRPM_Source.select(SRPM_Source.id, SRPM_Source.file).where(SRPM_Source.pid == pid)
+        return dict((s.file, s.id) for s in query)
+
     def __repr__(self):
         return '<SRPM Source {self.file}>'.format(self=self)
 
 
-# the source rpm files model
+# the source rpm directory name model; every distinct directory is stored once
+class SRPM_Dirname(SRPMDictionary):
+
+    def __repr__(self):
+        return '<SRPM Dirname {self.name}>'.format(self=self)
+
+
+# the source rpm basename model; every distinct file basename is stored once
+class SRPM_Basename(SRPMDictionary):
+
+    def __repr__(self):
+        return '<SRPM Basename {self.name}>'.format(self=self)
+
+
+# the source rpm files model; paths are stored as a directory and a basename, the way rpm does
 class SRPM_File(SRPMModel):
     pid     = ForeignKeyField(SRPM_Package, related_name='sfile')  # p_record
     tid     = ForeignKeyField(SRPM_Tag, related_name='sfile')  # t_record
     sid     = ForeignKeyField(SRPM_Source, related_name='sfile')  # s_record
-    file    = TextField()  # f_file
+    did     = ForeignKeyField(SRPM_Dirname, related_name='sfile')
+    bid     = ForeignKeyField(SRPM_Basename, related_name='sfile')
+
+    class Meta:
+        lookup_indexes = (
+            (('tid', None), ('pid', None)),
+        )
+
+    @classmethod
+    def path(cls):
+        """
+        Returns an expression for the full path of a file, for queries that have been
+        through join_path()
+        """
+        return concat(srpm_db, SRPM_Dirname.name, SRPM_Basename.name)
+
+    @classmethod
+    def join_path(cls, query):
+        """
+        Joins the directory and basename of each file onto a query that includes SRPM_File
+        """
+        return query.switch(SRPM_File).join(SRPM_Dirname, on=(SRPM_File.did == SRPM_Dirname.id)).switch(
+                   SRPM_File).join(SRPM_Basename, on=(SRPM_File.bid == SRPM_Basename.id)).switch(SRPM_File)
 
     @classmethod
     def find_id(cls, file, tid, pid):
@@ -738,9 +1334,11 @@ class SRPM_File(SRPMModel):
         :param pid: the package id to lookup
         :return: int
         """
+        (dirname, basename) = split_path(file)
         try:
-            file = SRPM_File.get(
-                (SRPM_File.file == file) & (SRPM_File.pid == pid) & (SRPM_File.tid == tid))
+            file = SRPM_File.join_path(SRPM_File.select(SRPM_File.id)).where(
+                (SRPM_Dirname.name == dirname) & (SRPM_Basename.name == basename) &
+                (SRPM_File.pid == pid) & (SRPM_File.tid == tid)).get()
             return file.id
         except:
             return None
@@ -753,24 +1351,13 @@ class SRPM_File(SRPMModel):
         :return: int
         """
         try:
-            file = SRPM_File.get((SRPM_File.id == fid))
+            file = SRPM_File.join_path(SRPM_File.select(SRPM_File.path().alias('file'))).where(SRPM_File.id == fid).get()
             return file.file
         except:
             return None
 
-    @classmethod
-    def delete_tags(cls, tid):
-        """
-        Delete files with this tid
-        :param tid: tid to remove
-        :return: int (number of files removed)
-        """
-        query   = SRPM_File.delete().where(SRPM_File.tid == tid)
-        removed = query.execute()
-        return removed
-
     def __repr__(self):
-        return '<SRPM File {self.file}>'.format(self=self)
+        return '<SRPM File {self.id}>'.format(self=self)
 
 
 # the source rpm buildrequires model
@@ -807,19 +1394,69 @@ class SRPM_Ctag(SRPMModel):
     line    = CharField(null=False)  # c_line
     file    = TextField(null=False)  # c_file
 
+    def __repr__(self):
+        return '<SRPM Ctag {self.name}>'.format(self=self)
+
+
+# the source rpm tarball model; the digest of every tarball that has been listed and run through
+# ctags, so that the same tarball in another package (or tag) has its files and ctags copied from
+# the source it was stored with rather than being unpacked again
+class SRPM_Archive(SRPMModel):
+    pid     = ForeignKeyField(SRPM_Package, related_name='archive')  # p_record
+    tid     = ForeignKeyField(SRPM_Tag, related_name='archive')  # t_record
+    sid     = ForeignKeyField(SRPM_Source, related_name='archive')  # s_record
+    digest  = CharField(max_length=128, null=False)
+
+    class Meta:
+        lookup_indexes = (
+            (('digest', None),),
+        )
+
     @classmethod
-    def delete_tags(cls, tid):
+    def get_digests(cls):
         """
-        Delete ctags with this tid
-        :param tid: tid to remove
-        :return: int (number of ctags removed)
+        Returns the digests of every tarball that is in the database
+        :return: set
+        """
+        return set(digest for (digest,) in SRPM_Archive.select(SRPM_Archive.digest).distinct().tuples())
+
+    @classmethod
+    def get_sids(cls, digests):
         """
-        query   = SRPM_Ctag.delete().where(SRPM_Ctag.tid == tid)
-        removed = query.execute()
-        return removed
+        Returns a source that holds the files and ctags of each of the provided digests
+        :param digests: list of digests to lookup
+        :return: dict (digest: source id)
+        """
+        sids    = {}
+        digests = list(digests)
+        for x in range(0, len(digests), 500):
+            query = SRPM_Archive.select(SRPM_Archive.digest, fn.MIN(SRPM_Archive.sid)).where(
+                        SRPM_Archive.digest << digests[x:x + 500]).group_by(SRPM_Archive.digest).tuples()
+            sids.update(query)
+        return sids
+
+    @classmethod
+    def copy_rows(cls, model, sid, tid, pid, to_sid):
+        """
+        Copies the rows of model (files or ctags) that belong to one source to another, in a
+        single INSERT ... SELECT so that none of them has to leave the database
+        :param model: SRPM_File or SRPM_Ctag
+        :param sid: the source id to copy from
+        :param tid: the tag id of the copies
+        :param pid: the package id of the copies
+        :param to_sid: the source id of the copies
+        :return: int (number of rows copied)
+        """
+        values = {'tid': tid, 'pid': pid, 'sid': to_sid}
+        fields = [field for field in model._meta.sorted_fields if field.name != 'id']
+        query  = model.select(*[Param(values[f.name]) if f.name in values else f for f in fields]).where(model.sid == sid)
+        count  = model.select().where(model.sid == sid).count()
+        if count:
+            model.insert_from(fields, query).execute()
+        return count
 
     def __repr__(self):
-        return '<SRPM Ctag {self.name}>'.format(self=self)
+        return '<SRPM Archive {self.digest}>'.format(self=self)
 
 
 # the source alreadyseen model
@@ -827,6 +1464,10 @@ class SRPM_AlreadySeen(SRPMModel):  # a_record
     tid      = ForeignKeyField(SRPM_Tag, related_name='alreadyseen')  # t_record
     fullname = TextField(null=False) # p_fullname
 
+    class Meta:
+        lookup_indexes = (
+            (('tid', None), ('fullname', 191)),
+        )
 
     @classmethod
     def exists(cls, tid, name):
@@ -840,3 +1481,74 @@ class SRPM_AlreadySeen(SRPMModel):  # a_record
         if SRPM_AlreadySeen.select().where((SRPM_AlreadySeen.tid == tid) & (SRPM_AlreadySeen.fullname == name)):
             return True
         return False
+
+    @classmethod
+    def get_fullnames(cls, tid):
+        """
+        Returns the names of every package that has been seen in a tag
+        :param tid: tag id to lookup
+        :return: list
+        """
+        return [fullname for (fullname,) in SRPM_AlreadySeen.select(SRPM_AlreadySeen.fullname).where(SRPM_AlreadySeen.tid == tid).tuples()]
+
+
+# the source rpm file basename trigram index model; only populated when trigram_index is enabled.
+# Basenames are shared by every tag, so these are removed by SRPM_Basename.prune()
+class SRPM_FileTrigram(SRPMModel):
+    ref     = ForeignKeyField(SRPM_Basename, related_name='trigram')
+    trigram = CharField(max_length=3, null=False)
+
+    class Meta:
+        indexes = (
+            (('trigram', 'ref'), False),
+        )
+
+
+# the source rpm ctag trigram index model; only populated when trigram_index is enabled
+class SRPM_CtagTrigram(SRPMModel):
+    tid     = ForeignKeyField(SRPM_Tag, related_name='ctag_trigram')  # t_record
+    ref     = ForeignKeyField(SRPM_Ctag, related_name='trigram')
+    trigram = CharField(max_length=3, null=False)
+
+    class Meta:
+        indexes = (
+            (('trigram', 'ref'), False),
+        )
+
+
+# the source rpm tag statistics model; the number of rows each tag has in the other tables, kept up
+# to date as packages are added and removed so that nothing needs to count them
+class SRPM_TagStats(TagStatsMixin, SRPMModel):
+    tid       = ForeignKeyField(SRPM_Tag, related_name='stats', unique=True)
+    packages  = IntegerField(default=0)
+    updates   = IntegerField(default=0)
+    files     = IntegerField(default=0)
+    sources   = IntegerField(default=0)
+    ctags     = IntegerField(default=0)
+    buildreqs = IntegerField(default=0)
+
+    counters = ('packages', 'updates', 'files', 'sources', 'ctags', 'buildreqs')
+
+    @classmethod
+    def count_rows(cls, tid, pid=None):
+        """
+        Counts the rows of a tag, or of one package in it, the slow way
+        :param tid: tag id
+        :param pid: package id
+        :return: dict (counter: number)
+        """
+        def rows(model, key):
+            query = model.select().where(model.tid == tid)
+            if pid:
+                query = query.where(key == pid)
+            return query
+
+        return {'packages' : rows(SRPM_Package, SRPM_Package.id).count(),
+                'updates'  : rows(SRPM_Package, SRPM_Package.id).where(SRPM_Package.update == 1).count(),
+                'files'    : rows(SRPM_File, SRPM_File.pid).count(),
+                'sources'  : rows(SRPM_Source, SRPM_Source.pid).count(),
+                'ctags'    : rows(SRPM_Ctag, SRPM_Ctag.pid).count(),
+                'buildreqs': rows(SRPM_BuildRequires, SRPM_BuildRequires.pid).count()}
+
+    def __repr__(self):
+        return '<SRPM TagStats {self.tid}>'.format(self=self)
@@ -1,4 +1,9 @@
 from . import basics
+from . import pool
+from . import header
+from . import payload
+from . import elf
+from . import search
 from . import tag
 from . import binary
 from . import source
@@ -0,0 +1,403 @@
+"""
+This program extracts data from RPM and SRPM packages and stores it in
+a database for later querying.
+
+based on the srpm script of similar function copyright (c) 2005 Stew Benedict <sbenedict@mandriva.com>
+copyright (c) 2007-2017 Vincent Danen <vdanen@linsec.ca>
+
+This file is part of rq.
+
+rq is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rq is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rq.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import stat
+import logging
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+import subprocess
+import zlib
+import bz2
+from distutils.spawn import find_executable
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # no lzma module, we fall back to piping through xz
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    # no zstandard module, we fall back to piping through zstd
+    zstandard = None
+
+CHUNK_SIZE = 65536
+
+ZIP_MAGIC = ('PK\x03\x04', 'PK\x05\x06')
+
+# the known compressors, as (name, magic, factory) tuples; see register()
+DECOMPRESSORS = []
+
+
+def register(name, magic, factory):
+    """
+    Function to add a compressor to the ones open_stream() knows; data compressed with
+    it is recognised by the magic it starts with rather than by the name of the file,
+    the way tar -a and zgrep do it.  factory is called for every stream and returns
+    either an object with a decompress(data) method, like those of zlib and bz2, or
+    the command line of a program that decompresses its standard input.
+    """
+    DECOMPRESSORS.append((name, magic, factory))
+
+
+def gzip_decompressor():
+    # 16 + MAX_WBITS tells zlib to expect the gzip header
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+register('gzip', '\x1f\x8b', gzip_decompressor)
+register('bzip2', 'BZh', bz2.BZ2Decompressor)
+
+# xz 5.4 and later decompress on every core, which the lzma module can't do, so the
+# program is preferred when it is installed
+if find_executable('xz'):
+    register('xz', '\xfd7zXZ\x00', lambda: ['xz', '-d', '-c', '-q', '-T0'])
+    register('lzma', '\x5d\x00\x00', lambda: ['xz', '-d', '-c', '-q', '--format=lzma'])
+elif lzma:
+    register('xz', '\xfd7zXZ\x00', lzma.LZMADecompressor)
+    register('lzma', '\x5d\x00\x00', lzma.LZMADecompressor)
+
+# zstd decompresses on one core whichever way it is done, so the module saves a process
+if zstandard:
+    register('zstd', '\x28\xb5\x2f\xfd', lambda: zstandard.ZstdDecompressor().decompressobj())
+elif find_executable('zstd'):
+    register('zstd', '\x28\xb5\x2f\xfd', lambda: ['zstd', '-d', '-c', '-q'])
+
+
+class Reader:
+    """
+    Class to present a file object as a read-only file object that can be peeked at;
+    the subclasses decompress what they read
+    """
+
+    def __init__(self, fobj, head=''):
+        self.fobj    = fobj
+        self.pending = head
+        self.buffer  = ''
+        self.pos     = 0
+        self.eof     = False
+
+
+    def chunk(self):
+        """
+        Function to return the next chunk of data, or '' at the end
+        """
+        data         = self.pending or self.fobj.read(CHUNK_SIZE)
+        self.pending = ''
+        return data
+
+
+    def __fill(self, size):
+        """
+        Function to read until we have at least size bytes buffered or hit the end
+        """
+        available = len(self.buffer) - self.pos
+        chunks    = [self.buffer[self.pos:]]
+        self.pos  = 0
+        while not self.eof and (size < 0 or available < size):
+            data = self.chunk()
+            if not data:
+                self.eof = True
+            chunks.append(data)
+            available += len(data)
+        self.buffer = ''.join(chunks)
+
+
+    def peek(self, size):
+        """
+        Function to return up to size bytes of data without consuming them
+        """
+        if len(self.buffer) - self.pos < size:
+            self.__fill(size)
+        return self.buffer[self.pos:self.pos + size]
+
+
+    def read(self, size=-1):
+        """
+        Function to read up to size bytes of data, or all of it
+        """
+        if size < 0 or len(self.buffer) - self.pos < size:
+            self.__fill(size)
+        if size < 0:
+            size = len(self.buffer) - self.pos
+        data      = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+
+    def close(self):
+        pass
+
+
+class Decompressor(Reader):
+    """
+    Class to decompress a file object in this process; files made of several compressed
+    streams one after the other (as pigz and pbzip2 write them) are read through to the end
+    """
+
+    def __init__(self, fobj, magic, factory, decomp, head=''):
+        Reader.__init__(self, fobj, head)
+        self.magic   = magic
+        self.factory = factory
+        self.decomp  = decomp
+
+
+    def chunk(self):
+        """
+        Function to decompress the next chunk of data, starting over with a new decompressor
+        whenever a stream ends and another one follows; anything after the last stream that
+        isn't another stream (such as padding) is ignored
+        """
+        while True:
+            data = Reader.chunk(self)
+            if not data:
+                return ''
+
+            chunks = []
+            while data:
+                if self.decomp is None:
+                    if not data.startswith(self.magic[:len(data)]):
+                        break
+                    self.decomp = self.factory()
+                try:
+                    chunks.append(self.decomp.decompress(data))
+                    data = getattr(self.decomp, 'unused_data', '')
+                except EOFError:
+                    # bz2 and lzma refuse any data once their stream has ended, which leaves it all for the next one
+                    pass
+                if data:
+                    self.decomp = None
+
+            data = ''.join(chunks)
+            if data:
+                return data
+
+
+class Pipe(Reader):
+    """
+    Class to decompress a file object by piping it through a program; a thread feeds the
+    program so that reading its output can never block on writing its input
+    """
+
+    def __init__(self, fobj, command, head=''):
+        Reader.__init__(self, fobj, head)
+        self.devnull = open(os.devnull, 'w')
+        self.proc    = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.devnull)
+        self.feeder  = threading.Thread(target=self.__feed)
+        self.feeder.daemon = True
+        self.feeder.start()
+
+
+    def __feed(self):
+        """
+        Function to copy the file object to the program until it ends or the program stops
+        taking it, as it does when close() is called before the end
+        """
+        try:
+            data = Reader.chunk(self)
+            while data:
+                self.proc.stdin.write(data)
+                data = self.fobj.read(CHUNK_SIZE)
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+
+
+    def chunk(self):
+        return self.proc.stdout.read(CHUNK_SIZE)
+
+
+    def close(self):
+        self.proc.stdout.close()
+        self.feeder.join()
+        self.proc.wait()
+        self.devnull.close()
+
+
+def open_stream(fobj):
+    """
+    Function to return a Reader of the decompressed contents of a file object, which may
+    or may not be compressed with one of the registered compressors; it has to be closed
+    """
+    head = fobj.read(CHUNK_SIZE)
+    for (name, magic, factory) in DECOMPRESSORS:
+        if head.startswith(magic):
+            decomp = factory()
+            logging.debug('decompressing %s data with %s' % (name, decomp))
+            if isinstance(decomp, list):
+                return Pipe(fobj, decomp, head)
+            return Decompressor(fobj, magic, factory, decomp, head)
+    return Reader(fobj, head)
+
+
+def lines(fobj):
+    """
+    Function to yield the lines of a file object without reading all of it into memory
+    """
+    rest = ''
+    while True:
+        data = fobj.read(CHUNK_SIZE)
+        if not data:
+            break
+        chunk = (rest + data).split('\n')
+        rest  = chunk.pop()
+        for line in chunk:
+            yield line
+    if rest:
+        yield rest
+
+
+def patch_files(fobj):
+    """
+    Function to return the files a (possibly compressed) patch touches, being the
+    names on its +++ lines
+    """
+    files  = []
+    reader = open_stream(fobj)
+    try:
+        for line in lines(reader):
+            if line.startswith('+++'):
+                fields = line.split()
+                if len(fields) > 1:
+                    files.append(fields[1])
+    except (IOError, EOFError, zlib.error), e:
+        logging.warning('Unable to read all of the patch: %s', e)
+    finally:
+        reader.close()
+    return files
+
+
+def safe_path(root, name):
+    """
+    Function to return where an archive member should be written below root, or None
+    if its name would take it outside of root
+    """
+    path = os.path.normpath(os.path.join(root, name.lstrip('/')))
+    if not path.startswith(root + os.sep):
+        return None
+    return path
+
+
+def write_member(root, name, source=None, linkname=None):
+    """
+    Function to write a file from an archive below root, with its contents read from
+    source, or as a hard link to the file linkname that was written before
+    """
+    path = safe_path(root, name)
+    if not path:
+        logging.debug('Not extracting %s, it is outside of the archive' % name)
+        return
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if os.path.lexists(path):
+            # a later member of the same name replaces the earlier one, as with tar
+            os.unlink(path)
+
+        if source:
+            with open(path, 'wb') as out:
+                shutil.copyfileobj(source, out, CHUNK_SIZE)
+        else:
+            target = safe_path(root, linkname)
+            if target and os.path.isfile(target):
+                os.link(target, path)
+    except (IOError, OSError), e:
+        logging.debug('Unable to extract %s: %s' % (name, e))
+
+
+def tar_members(reader, extract_dir=None, exclude=None, extract=None):
+    """
+    Function to walk a tarball in a single pass, yielding the names of the members that
+    aren't directories and that exclude (a function of the name) doesn't reject.  When
+    extract_dir is given, the files and hard links among them that extract (another
+    function of the name, or None for all of them) accepts are written below it as they
+    go by.  A damaged tarball ends the walk early.
+    """
+    try:
+        tar = tarfile.open(fileobj=reader, mode='r|')
+        for member in tar:
+            if member.isdir() or (exclude and exclude(member.name)):
+                continue
+            yield member.name
+
+            if not extract_dir or (extract and not extract(member.name)):
+                continue
+            if member.isfile():
+                write_member(extract_dir, member.name, source=tar.extractfile(member))
+            elif member.islnk():
+                write_member(extract_dir, member.name, linkname=member.linkname)
+    except (tarfile.TarError, IOError, OSError, EOFError, zlib.error), e:
+        logging.warning('Unable to read all of the tarball: %s', e)
+
+
+def zip_members(reader, extract_dir=None, exclude=None, extract=None):
+    """
+    Function to walk a zip file like tar_members() does; as the index of a zip file is at
+    its end, it is copied to a temporary file first
+    """
+    with tempfile.TemporaryFile() as spool:
+        shutil.copyfileobj(reader, spool, CHUNK_SIZE)
+        try:
+            zf = zipfile.ZipFile(spool)
+            for info in zf.infolist():
+                name = info.filename
+                if isinstance(name, unicode):
+                    name = name.encode('utf-8')
+                if name.endswith('/') or (exclude and exclude(name)):
+                    continue
+                yield name
+
+                if not extract_dir or (extract and not extract(name)):
+                    continue
+                # symbolic links are stored as files holding the target, leave them out
+                if not stat.S_ISLNK(info.external_attr >> 16):
+                    source = zf.open(info)
+                    write_member(extract_dir, name, source=source)
+                    source.close()
+        except (zipfile.BadZipfile, IOError, OSError, EOFError, RuntimeError, zlib.error), e:
+            logging.warning('Unable to read all of the zip file: %s', e)
+
+
+def list_files(fobj, extract_dir=None, exclude=None, extract=None):
+    """
+    Function to return the names of the files in a (possibly compressed) tarball or in
+    a zip file, read from a file object in a single pass, leaving out directories and
+    whatever exclude (a function of the name) rejects.  When extract_dir is given, the
+    files that extract accepts (all of them if it is None) are written below it at the
+    same time, so the archive is only decompressed once for both listing and extracting
+    it.  Symbolic links are never created, as they could point anywhere.
+    """
+    reader = open_stream(fobj)
+    try:
+        if reader.peek(4) in ZIP_MAGIC:
+            return list(zip_members(reader, extract_dir, exclude, extract))
+        return list(tar_members(reader, extract_dir, exclude, extract))
+    finally:
+        reader.close()
@@ -25,7 +25,7 @@ import logging
 import os
 import sys
 import re
-import commands
+import stat
 
 
 class Common:
@@ -80,32 +80,34 @@ class Common:
         return(file_excludes)
 
 
-    def rpm_list(self, rpm_file, raw=False):
+    def rpm_list(self, hdr, raw=False):
         """
         Function to get the list of files in an RPM, excluding those files defined
-        by files_exclude
+        by files_exclude; hdr is the rq.header.Header of the package
         """
-        logging.debug('in rpm_list(%s)' % rpm_file)
+        logging.debug('in rpm_list(%s)' % hdr.rpm)
 
-        rpm_list  = commands.getoutput("rpm -qlvp --nosignature " + self.clean_shell(rpm_file))
-
-        if rpm_list == '(contains no files)' or rpm_list == '':
+        files = hdr.files
+        if not files:
             return False
 
         if raw:
-            return rpm_list
+            rpm_list = []
+            for entry in files:
+                rpm_list.append('%s %-8s %-8s %10d %s' % (self.get_mode_string(entry.mode), entry.user,
+                                                         entry.group, entry.size, entry.path))
+            return '\n'.join(rpm_list)
 
-        rpm_list  = rpm_list.splitlines()
         rlist     = {}
         count     = 0
 
-        for entry in rpm_list:
+        for entry in files:
             break_loop = False
-            logging.debug('processing: %s' % entry)  # DEBUG
+            logging.debug('processing: %s' % entry.path)  # DEBUG
             for exclude in self.get_file_excludes():
                 # make sure we don't include any files in our exclude list
-                if re.search(exclude, entry):
-                    logging.debug('found unwanted entry: %s' % entry)
+                if re.search(exclude, entry.path):
+                    logging.debug('found unwanted entry: %s' % entry.path)
                     break_loop = True
 
             if break_loop:
@@ -113,27 +115,15 @@ class Common:
 
             is_suid = 0
             is_sgid = 0
-            fperms     = entry.split()
-
-            # this actually really stinks because we are allowed usernames longer
-            # than 8 characters, but rpm -qlv will only display the first 8 characters
-            # of the owner/group name -- not cool at all
-            if len(fperms[2]) > 8:
-                user  = fperms[2][:8]
-                group = fperms[2][8:]
-                fname = fperms[7]
-            else:
-                user  = fperms[2]
-                group = fperms[3]
-                fname = fperms[8]
-            if fperms[0][3].lower() == 's':
+            if entry.mode & stat.S_ISUID:
                 is_suid = 1
-            if fperms[0][6].lower() == 's':
+            if entry.mode & stat.S_ISGID:
                 is_sgid = 1
 
-            perms = self.get_file_mode(fperms[0])
+            perms = '%04o' % stat.S_IMODE(entry.mode)
 
-            rlist[count] = {'file': fname, 'user': user, 'group': group, 'is_suid': is_suid, 'is_sgid': is_sgid, 'perms': perms}
+            rlist[count] = {'file': entry.path, 'user': entry.user, 'group': entry.group, 'is_suid': is_suid, 'is_sgid': is_sgid, 'perms': perms,
+                            'digest': entry.digest}
             count       += 1
 
         return rlist
@@ -165,53 +155,35 @@ class Common:
                 sys.exit(1)
 
 
-    def get_file_mode(self, mode):
+    def get_mode_string(self, mode):
         """
-        Function to return the numeric file mode given the r--r--r-- string as input
+        Function to return the r--r--r-- string for a numeric file mode, the way ls -l displays it
         """
-        user  = mode[1:4]
-        group = mode[4:7]
-        other = mode[7:]
-        perms = {'user': user, 'group': group, 'other': other}
-
-        num   = 0
-        for perm_type in perms.keys():
-
-            read    = perms[perm_type][0]
-            write   = perms[perm_type][1]
-            execute = perms[perm_type][2]
-
-            if perm_type == 'user':
-                if read == 'r':
-                    num = num + 400
-                if write == 'w':
-                    num = num + 200
-                if execute == 'x':
-                    num = num + 100
-                elif execute == 'S':
-                    num = num + 4000
-                elif execute == 's':
-                    num = num + 4100
-            if perm_type == 'group':
-                if read == 'r':
-                    num = num + 40
-                if write == 'w':
-                    num = num + 20
-                if execute == 'x':
-                    num = num + 10
-                elif execute == 'S':
-                    num = num + 2000
-                elif execute == 's':
-                    num = num + 2010
-            if perm_type == 'other':
-                if read == 'r':
-                    num = num + 4
-                if write == 'w':
-                    num = num + 2
-                if execute == 'x':
-                    num = num + 1
-        num = '%04d' % num
-        return num
+        ftype = '-'
+        if stat.S_ISDIR(mode):
+            ftype = 'd'
+        elif stat.S_ISLNK(mode):
+            ftype = 'l'
+        elif stat.S_ISCHR(mode):
+            ftype = 'c'
+        elif stat.S_ISBLK(mode):
+            ftype = 'b'
+        elif stat.S_ISFIFO(mode):
+            ftype = 'p'
+        elif stat.S_ISSOCK(mode):
+            ftype = 's'
+
+        perms = ''
+        for (who, special, lower, upper) in ((6, stat.S_ISUID, 's', 'S'), (3, stat.S_ISGID, 's', 'S'), (0, stat.S_ISVTX, 't', 'T')):
+            bits   = (mode >> who) & 7
+            perms += bits & 4 and 'r' or '-'
+            perms += bits & 2 and 'w' or '-'
+            if mode & special:
+                perms += bits & 1 and lower or upper
+            else:
+                perms += bits & 1 and 'x' or '-'
+
+        return ftype + perms
 
 
     def clean_shell(self, string):
@@ -250,6 +222,10 @@ class Config:
         self.config[index] = value
 
 
+    def get(self, index, default=None):
+        return self.config.get(index, default)
+
+
     def __read_config(self):
         """
         Function to read the configuration file
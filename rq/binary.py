@@ -23,14 +23,21 @@ along with rq.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
 import re
-import commands
+import stat
 import logging
-import tempfile
-import shutil
 import datetime
+import hashlib
 from glob import glob
-from app.models import RPM_Tag, RPM_Package, RPM_User, RPM_Group, RPM_Requires, \
-    RPM_Provides, RPM_File, RPM_Flags, RPM_Symbols
+from . import pool
+from . import header
+from . import evr
+from . import payload
+from . import elf
+from . import search
+from peewee import JOIN_LEFT_OUTER
+from app.models import stream, rpm_db, RPM_Tag, RPM_Package, RPM_User, RPM_Group, RPM_Requires, \
+    RPM_Provides, RPM_File, RPM_Analysis, RPM_Symbols, RPM_SymbolName, \
+    RPM_FileTrigram, RPM_SymbolTrigram, RPM_Dirname, RPM_Basename, RPM_TagStats, split_path
 
 
 class Binary:
@@ -74,12 +81,20 @@ class Binary:
                                  'strnlen', 'strrchr', 'strstr', 'strtol', 'textdomain', 'time', 'umask',
                                  'unlink', 'Version', 'version_etc_copyright', 'waitpid', 'write', '__xstat']
 
-        # caches
-        self.symbol_cache   = {}
-        self.provides_cache = {}
-        self.requires_cache = {}
-        self.group_cache    = {}
-        self.user_cache     = {}
+        # rows are written to the database batch_size at a time
+        self.batch_size = int(config.get('batch_size', 500))
+
+        # maintain (and search with) the trigram index of files and symbols
+        self.trigram_index = int(config.get('trigram_index', 0))
+
+        # digests of the binaries that have already been analyzed, loaded when importing
+        self.analyzed = None
+
+        # caches; users and groups are loaded in full by load_owners()
+        self.symbol_cache  = {}
+        self.dirname_cache = {}
+        self.group_cache   = None
+        self.user_cache    = None
 
 
     def rpm_add_directory(self, tag, path, updatepath):
@@ -118,13 +133,39 @@ class Binary:
             logging.critical('Unable to add tag "%s" to the database!' % tag)
             sys.exit(1)
 
+        rpms = []
         for rpm in file_list:
             if not os.path.isfile(rpm):
                 print 'File %s not found!\n' % rpm
             elif not self.re_brpm.search(rpm):
                 print 'File %s is not a binary rpm!\n' % rpm
             else:
-                self.record_add(tid, rpm)
+                rpms.append(rpm)
+
+        self.import_files(tid, rpms)
+
+
+    def import_files(self, tid, file_list, update=0):
+        """
+        Function to import a list of RPMs; the package analysis is spread across
+        --jobs worker processes and the results are written to the database, in
+        file_list order, by this process alone
+        """
+        logging.debug('in Binary.import_files(%s, %d files, %d)' % (tid, len(file_list), update))
+
+        for rpm in file_list:
+            self.rcommon.file_rpm_check(rpm)
+
+        file_list = self.skip_present(tid, file_list)
+
+        # loaded before the workers are started so that they all get a copy
+        self.load_analyzed()
+
+        for (rpm, pkg) in pool.analyze(self.analyze_package, file_list, self.options.jobs):
+            if not pkg:
+                print 'Unable to analyze %s, skipping it!' % rpm
+                continue
+            self.store_package(tid, pkg, update)
 
 
     def record_add(self, tid, rpm, update=0):
@@ -133,48 +174,135 @@ class Binary:
         """
         logging.debug('in Binary.record_add(%s, %s, %d)' % (tid, rpm, update))
 
-        if os.path.isfile(rpm):
-            path = os.path.abspath(os.path.dirname(rpm))
-        else:
-            path = os.path.abspath(rpm)
-        logging.debug('Path:\t%s' % path)
-
         self.rcommon.file_rpm_check(rpm)
 
-        pid = self.package_add_record(tid, rpm, update)
-        if not pid:
-            return
+        self.load_analyzed()
+        self.store_package(tid, self.analyze_package(rpm), update)
 
-        rpm_list = self.rcommon.rpm_list(rpm)
-        if not rpm_list:
-            return
 
-        logging.debug('Add file records for pid: %s' % pid)
-        self.add_records(tid, pid, rpm_list)
-        self.add_requires(tid, pid, rpm)
-        self.add_provides(tid, pid, rpm)
-        self.add_binary_records(tid, pid, rpm)
+    def skip_present(self, tid, file_list):
+        """
+        Function to drop the packages that are already in the tag from file_list before
+        they are analyzed; the header cache makes this a stat() for packages it has seen
+        """
+        present = set((p.package, p.version, p.release, p.arch) for p in RPM_Package.get_packages(tid))
+        if not present:
+            return file_list
+
+        headers = self.rtag.header_cache()
+        tag     = RPM_Tag.get_tag(tid)
+        rpms    = []
+        for rpm in file_list:
+            try:
+                meta = headers.get(rpm)
+            except header.HeaderError:
+                # analyze_package() will report it
+                rpms.append(rpm)
+                continue
+            if (meta.name, meta.version, meta.release, meta.arch) in present:
+                print 'File %s-%s-%s.%s is already in the database under tag %s' % (meta.name, meta.version, meta.release,
+                                                                                     meta.arch, tag)
+            else:
+                rpms.append(rpm)
+        headers.commit()
+        return rpms
+
+
+    def load_analyzed(self):
+        """
+        Function to load the digests of the binaries that are already in the database,
+        so that analyze_package() doesn't have to look at them again
+        """
+        if self.analyzed is None:
+            self.analyzed = RPM_Analysis.get_digests()
+            logging.debug('%d binaries have already been analyzed' % len(self.analyzed))
+
+
+    def analyze_package(self, rpm):
+        """
+        Function to collect everything we record about a package; this does not
+        touch the database so it is safe to run in a worker process
+        """
+        logging.debug('in Binary.analyze_package(%s)' % rpm)
+
+        hdr = header.Header(rpm)
+
+        pkg = {'rpm'     : rpm,
+               'fullname': os.path.basename(rpm),
+               'package' : hdr.name,
+               'version' : hdr.version,
+               'release' : hdr.release,
+               'epoch'   : hdr.epoch,
+               'date'    : hdr.buildtime,
+               'arch'    : hdr.arch,
+               'srpm'    : self.re_srpmname.sub(r'\1', hdr.sourcerpm),
+               'files'   : self.rcommon.rpm_list(hdr),
+               'requires': [],
+               'provides': [],
+               'binaries': []}
+
+        if pkg['files']:
+            pkg['requires'] = self.get_requires(hdr)
+            pkg['provides'] = self.get_provides(hdr)
+            pkg['binaries'] = self.get_binary_records(hdr)
+
+        return pkg
+
+
+    def store_package(self, tid, pkg, update=0):
+        """
+        Function to write an analyzed package to the database
+        """
+        logging.debug('in Binary.store_package(%s, %s, %d)' % (tid, pkg['rpm'], update))
+
+        # the package and everything that hangs off of it go in as one transaction
+        # so that a failure part way through doesn't leave a half-imported package
+        # behind that in_db() would then consider to be present
+        self.load_owners()
+
+        try:
+            with rpm_db.atomic():
+                pid = self.package_add_record(tid, pkg, update)
+                if not pid:
+                    return
+
+                counts = {'packages': 1, 'updates': update}
+                if pkg['files']:
+                    logging.debug('Add file records for pid: %s' % pid)
+                    aids    = self.add_binary_records(pkg['files'], pkg['binaries'])
+                    flagged = [aid for aid in aids.values() if aid]
+                    symbols = RPM_Symbols.get_counts(set(flagged))
+                    counts.update(files    = self.add_records(tid, pid, pkg['files'], aids),
+                                  requires = self.add_requires(tid, pid, pkg['requires']),
+                                  provides = self.add_provides(tid, pid, pkg['provides']),
+                                  flags    = len(flagged),
+                                  symbols  = sum(symbols.get(aid, 0) for aid in flagged))
+                RPM_TagStats.add(tid, **counts)
+        except Exception, e:
+            logging.error('Adding package %s failed, rolled back!\n%s', pkg['rpm'], e)
+            print 'Unable to add %s to the database!' % pkg['fullname']
+            # any users, groups, names or analyses created in the transaction are gone too
+            self.user_cache    = None
+            self.group_cache   = None
+            self.symbol_cache  = {}
+            self.dirname_cache = {}
+            self.analyzed      = None
+            return
 
         if self.options.progress:
             sys.stdout.write('\n')
 
 
-    def package_add_record(self, tid, rpm, update=0):
+    def package_add_record(self, tid, pkg, update=0):
         """
         Function to add a package record
         """
-        logging.debug('in Binary.package_add_record(%s, %s, %d)' % (tid, rpm, update))
+        logging.debug('in Binary.package_add_record(%s, %s, %d)' % (tid, pkg['rpm'], update))
 
-        fname   = os.path.basename(rpm)
-        rpmtags = commands.getoutput("rpm -qp --nosignature --qf '%{NAME}|%{VERSION}|%{RELEASE}|%{BUILDTIME}|%{ARCH}|%{SOURCERPM}' " + self.rcommon.clean_shell(rpm))
-        tlist   = rpmtags.split('|')
-        logging.debug("tlist is %s " % tlist)
-        package = tlist[0].strip()
-        version = tlist[1].strip()
-        release = tlist[2].strip()
-        pdate   = tlist[3].strip()
-        arch    = tlist[4].strip()
-        srpm    = self.re_srpmname.sub(r'\1', tlist[5].strip())
+        package = pkg['package']
+        version = pkg['version']
+        release = pkg['release']
+        arch    = pkg['arch']
 
         tag = RPM_Tag.get_tag(tid)
 
@@ -185,23 +313,21 @@ class Binary:
         # TODO: we shouldn't have to have p_tag here as t_record has the same info, but it
         # TODO: sure makes it easier to sort alphabetically and I'm too lazy for the JOINs right now
 
-        self.rcommon.show_progress(fname)
-        try:
-            p = RPM_Package.create(
-                tid      = tid,
-                package  = package,
-                version  = version,
-                release  = release,
-                date     = pdate,
-                arch     = arch,
-                srpm     = srpm,
-                fullname = fname,
-                update   = update
-            )
-            return p.id
-        except Exception, e:
-            logging.error('Adding file %s failed!\n%s', rpm, e)
-            return 0
+        self.rcommon.show_progress(pkg['fullname'])
+        p = RPM_Package.create(
+            tid      = tid,
+            package  = package,
+            version  = version,
+            release  = release,
+            epoch    = pkg['epoch'],
+            evr      = evr.evr_key(pkg['epoch'], version, release),
+            date     = pkg['date'],
+            arch     = arch,
+            srpm     = pkg['srpm'],
+            fullname = pkg['fullname'],
+            update   = update
+        )
+        return p.id
 
 
     def query(self, qtype):
@@ -244,28 +370,35 @@ class Binary:
 
         result = None
         if qtype == 'files':
+            # paths are matched against the directory and basename dictionaries first
+            path   = RPM_File.path()
+            result = RPM_File.join_path(RPM_File.select()).order_by(path.asc(), RPM_File.id.asc())
+            if self.options.tag:
+                result = result.where(RPM_File.tid == tid)
             if self.options.regexp:
-                if self.options.tag:
-                    result = RPM_File.select().where((RPM_File.file.regexp(like_q)) & (RPM_File.tid == tid)).order_by(RPM_File.file.asc())
-                else:
-                    result = RPM_File.select().where(RPM_File.file.regexp(like_q)).order_by(RPM_File.file.asc())
+                result = search.regexp_path_filter(result.where(path.regexp(like_q)), RPM_File, path, RPM_Dirname,
+                                                   RPM_Basename, like_q, self.trigram_index and RPM_FileTrigram)
             else:
-                if self.options.tag:
-                    result = RPM_File.select().where((RPM_File.file.contains(like_q)) & (RPM_File.tid == tid)).order_by(RPM_File.file.asc())
-                else:
-                    result = RPM_File.select().where(RPM_File.file.contains(like_q)).order_by(RPM_File.file.asc())
+                result = search.path_filter(result, RPM_File, RPM_Dirname, RPM_Basename, like_q,
+                                            self.trigram_index and RPM_FileTrigram)
 
         elif qtype == 'symbols':
+            # match against the dictionary of distinct symbol names first, then fan out to the
+            # analyses using those symbols and the files that share each analysis
             if self.options.regexp:
-                if self.options.tag:
-                    result = RPM_Symbols.select().where((RPM_Symbols.symbols.regexp(like_q)) & (RPM_Symbols.tid == tid)).order_by(RPM_Symbols.symbols.asc())
-                else:
-                    result = RPM_Symbols.select().where(RPM_Symbols.symbols.regexp(like_q)).order_by(RPM_Symbols.symbols.asc())
+                names = RPM_SymbolName.select(RPM_SymbolName.id).where(RPM_SymbolName.name.regexp(like_q))
+                names = search.regexp_filter(names, RPM_SymbolName, RPM_SymbolName.name, like_q, self.trigram_index and RPM_SymbolTrigram)
             else:
-                if self.options.tag:
-                    result = RPM_Symbols.select().where((RPM_Symbols.symbols.contains(like_q)) & (RPM_Symbols.tid == tid)).order_by(RPM_Symbols.symbols.asc())
-                else:
-                    result = RPM_Symbols.select().where(RPM_Symbols.symbols.contains(like_q)).order_by(RPM_Symbols.symbols.asc())
+                names = RPM_SymbolName.select(RPM_SymbolName.id).where(RPM_SymbolName.name.contains(like_q))
+                if self.trigram_index:
+                    names = search.trigram_filter(names, RPM_SymbolName, RPM_SymbolTrigram, like_q)
+
+            result = RPM_Symbols.select().join(RPM_SymbolName, on=(RPM_Symbols.sid == RPM_SymbolName.id)).switch(
+                         RPM_Symbols).join(RPM_File, on=(RPM_Symbols.aid == RPM_File.aid))
+            if self.options.tag:
+                result = result.where((RPM_Symbols.sid << names) & (RPM_File.tid == tid)).order_by(RPM_SymbolName.name.asc())
+            else:
+                result = result.where(RPM_Symbols.sid << names).order_by(RPM_SymbolName.name.asc())
 
         elif qtype == 'packages':
             if self.options.regexp:
@@ -273,6 +406,7 @@ class Binary:
                     result = RPM_Package.select().where((RPM_Package.package.regexp(like_q)) & (RPM_Package.tid == tid)).order_by(RPM_Package.package.asc())
                 else:
                     result = RPM_Package.select().where(RPM_Package.package.regexp(like_q)).order_by(RPM_Package.package.asc())
+                result = search.regexp_filter(result, RPM_Package, RPM_Package.package, like_q, None, tid)
             else:
                 if self.options.tag:
                     result = RPM_Package.select().where((RPM_Package.package.contains(like_q)) & (RPM_Package.tid == tid)).order_by(RPM_Package.package.asc())
@@ -285,6 +419,7 @@ class Binary:
                     result = RPM_Provides.select().where((RPM_Provides.name.regexp(like_q)) & (RPM_Provides.tid == tid)).order_by(RPM_Provides.name.asc())
                 else:
                     result = RPM_Provides.select().where(RPM_Provides.name.regexp(like_q)).order_by(RPM_Provides.name.asc())
+                result = search.regexp_filter(result, RPM_Provides, RPM_Provides.name, like_q, None, tid)
             else:
                 if self.options.tag:
                     result = RPM_Provides.select().where((RPM_Provides.name.contains(like_q)) & (RPM_Provides.tid == tid)).order_by(RPM_Provides.name.asc())
@@ -297,37 +432,43 @@ class Binary:
                     result = RPM_Requires.select().where((RPM_Requires.name.regexp(like_q)) & (RPM_Requires.tid == tid)).order_by(RPM_Requires.name.asc())
                 else:
                     result = RPM_Requires.select().where(RPM_Requires.name.regexp(like_q)).order_by(RPM_Requires.name.asc())
+                result = search.regexp_filter(result, RPM_Requires, RPM_Requires.name, like_q, None, tid)
             else:
                 if self.options.tag:
                     result = RPM_Requires.select().where((RPM_Requires.name.contains(like_q)) & (RPM_Requires.tid == tid)).order_by(RPM_Requires.name.asc())
                 else:
                     result = RPM_Requires.select().where(RPM_Requires.name.contains(like_q)).order_by(RPM_Requires.name.asc())
 
+        # fetch everything that gets displayed in the same query
+        if result is not None:
+            result = self.display_query(qtype, result)
+
         # DEBUG: print result
-        if result:
+        if result is not None and result.exists():
             if self.options.count:
+                # let the database count the rows rather than fetching them all
+                matches = result.count()
                 if self.options.quiet:
-                    print len(result)
+                    print matches
                 else:
                     if self.options.tag:
-                        print '%d match(es) in database for tag (%s) and %s (%s)' % (len(result), self.options.tag, match_type, like_q)
+                        print '%d match(es) in database for tag (%s) and %s (%s)' % (matches, self.options.tag, match_type, like_q)
                     else:
-                        print '%d match(es) in database for %s (%s)' % (len(result), match_type, like_q)
+                        print '%d match(es) in database for %s (%s)' % (matches, match_type, like_q)
                 return
 
             ltag = ''
             lsrc = ''
-            for row in result:
-                # DEBUG: print vars(row)
+            for row in stream(result):
+                # DEBUG: print row
                 utype = ''
                 # for readability
-                package = RPM_Package.get(RPM_Package.id == row.pid)
-                r_tag   = RPM_Tag.get_tag(row.tid)
-                r_rpm   = package.package
-                r_ver   = package.version
-                r_rel   = package.release
-                r_date  = package.date
-                r_srpm  = package.srpm
+                r_tag   = row['tag']
+                r_rpm   = row['package']
+                r_ver   = row['version']
+                r_rel   = row['release']
+                r_date  = row['date']
+                r_srpm  = row['srpm']
 
                 # defaults, so nothing is undeclared
                 r_is_suid = ''
@@ -341,28 +482,28 @@ class Binary:
                 r_files   = ''
 
                 if qtype == 'provides':
-                    r_type = row.name
+                    r_type = row['name']
 
                 if qtype == 'requires':
-                    r_type = row.name
+                    r_type = row['name']
 
                 if qtype == 'files':
                     # only provides, requires, files
-                    r_type = row.file
+                    r_type = row['file']
 
                 if qtype == 'files':
-                    r_user    = RPM_User.get_name(row.uid)
-                    r_group   = RPM_Group.get_name(row.gid)
-                    r_is_suid = row.is_suid
-                    r_is_sgid = row.is_sgid
-                    r_perms   = row.perms
-                    r_fileid  = row.id
+                    r_user    = row['user']
+                    r_group   = row['group']
+                    r_is_suid = row['is_suid']
+                    r_is_sgid = row['is_sgid']
+                    r_perms   = row['perms']
+                    r_fileid  = row['id']
 
                 if qtype == 'symbols':
-                    r_files  = RPM_File.get_name(row.fid)
-                    r_symbol = row.symbols
+                    r_files  = row['file']
+                    r_symbol = row['symbols']
 
-                if row.update == 1:
+                if row['update'] == 1:
                     utype = '[update] '
 
                 if not ltag == r_tag:
@@ -371,7 +512,7 @@ class Binary:
                     ltag = r_tag
 
                 if self.options.debug:
-                    print vars(row)
+                    print row
                 else:
                     rpm = '%s-%s-%s' % (r_rpm, r_ver, r_rel)
 
@@ -396,8 +537,8 @@ class Binary:
                     else:
                         flags = None
                         if self.options.extrainfo:
-                            if qtype == 'files':
-                                flags = RPM_Flags.get_named(r_fileid)
+                            if qtype == 'files' and row['flags_id']:
+                                flags = RPM_Analysis.describe(row['relro'], row['ssp'], row['nx'], row['pie'], row['fortify'])
                             rpm_date = datetime.datetime.fromtimestamp(float(r_date))
                             if flags:
                                 print '  %-10s%s' % ("Date :", rpm_date.strftime('%a %b %d %H:%M:%S %Y'))
@@ -411,17 +552,56 @@ class Binary:
                 print 'No matches in database for %s (%s)' % (match_type, like_q)
 
 
-    def cache_get_user(self, name):
+    def display_query(self, qtype, query):
         """
-        Function to look up the u_record and add it to the cache for users
+        Function to join the package, tag and, depending on the query type, the
+        owner, flags or file of each row onto a query, so that the results can be
+        displayed without any further lookups; returns the rows as dicts
         """
-        uid = RPM_User.get_id(name)
-        if uid:
-            # add to the cache
-            self.user_cache[name] = uid
-            return uid
-        else:
-            return False
+        logging.debug('in Binary.display_query(%s)' % qtype)
+
+        model   = query.model_class
+        columns = [RPM_Package.package, RPM_Package.version, RPM_Package.release, RPM_Package.date,
+                   RPM_Package.srpm, RPM_Package.update, RPM_Tag.tag]
+
+        if qtype == 'packages':
+            return query.select(*columns).join(RPM_Tag, on=(RPM_Package.tid == RPM_Tag.id)).dicts()
+
+        if qtype == 'symbols':
+            # the symbol query already joins the file, which has the package and tag
+            columns.extend([RPM_SymbolName.name.alias('symbols'), RPM_File.path().alias('file')])
+            query = RPM_File.join_path(query.switch(RPM_File).join(RPM_Package, on=(RPM_File.pid == RPM_Package.id)).switch(
+                        RPM_File).join(RPM_Tag, on=(RPM_File.tid == RPM_Tag.id)))
+            return query.select(*columns).dicts()
+
+        query = query.join(RPM_Package, on=(model.pid == RPM_Package.id)).switch(model).join(
+                    RPM_Tag, on=(model.tid == RPM_Tag.id)).switch(model)
+
+        if qtype in ('provides', 'requires'):
+            columns.append(model.name)
+
+        elif qtype == 'files':
+            columns.extend([RPM_File.id, RPM_File.path().alias('file'), RPM_File.is_suid, RPM_File.is_sgid, RPM_File.perms,
+                            RPM_User.user, RPM_Group.group])
+            query = query.join(RPM_User, JOIN_LEFT_OUTER, on=(RPM_File.uid == RPM_User.id)).switch(model).join(
+                        RPM_Group, JOIN_LEFT_OUTER, on=(RPM_File.gid == RPM_Group.id)).switch(model)
+            if self.options.extrainfo:
+                columns.extend([RPM_Analysis.id.alias('flags_id'), RPM_Analysis.relro, RPM_Analysis.ssp,
+                                RPM_Analysis.nx, RPM_Analysis.pie, RPM_Analysis.fortify])
+                query = query.join(RPM_Analysis, JOIN_LEFT_OUTER, on=(RPM_File.aid == RPM_Analysis.id))
+
+        return query.select(*columns).dicts()
+
+
+    def load_owners(self):
+        """
+        Function to load every known user and group into their caches, one query each,
+        so that looking up the owner of a file never has to go to the database
+        """
+        if self.user_cache is None:
+            self.user_cache = RPM_User.get_ids()
+        if self.group_cache is None:
+            self.group_cache = RPM_Group.get_ids()
 
 
     def get_user_record(self, name):
@@ -429,15 +609,10 @@ class Binary:
         Function to lookup, add, and cache user info
         """
 
-        # first check the cache
+        # every known user is cached
         if name in self.user_cache:
             return self.user_cache[name]
 
-        # not cached, check the database
-        uid = self.cache_get_user(name)
-        if uid:
-            return uid
-
         # not cached, so not in the db, add it
         try:
             u = RPM_User.create(user = name)
@@ -451,33 +626,15 @@ class Binary:
             return u.id
 
 
-    def cache_get_group(self, name):
-        """
-        Function to look up the g_record and add it to the cache for groups
-        """
-        gid = RPM_Group.get_id(name)
-        if gid:
-            # add to the cache
-            self.group_cache[name] = gid
-            return gid
-        else:
-            return False
-
-
     def get_group_record(self, name):
         """
         Function to lookup, add, and cache group info
         """
 
-        # first check the cache
+        # every known group is cached
         if name in self.group_cache:
             return self.group_cache[name]
 
-        # not cached, check the database
-        gid = self.cache_get_group(name)
-        if gid:
-            return gid
-
         # not cached, so not in the db, add it
         try:
             g = RPM_Group.create(group = name)
@@ -491,126 +648,77 @@ class Binary:
             return g.id
 
 
-    def cache_get_requires(self, name):
+    def get_requires(self, hdr):
         """
-        Function to look up the rq_record and add it to the cache for requires
+        Function to get the list of requires from an RPM header, less the
+        rpmlib and compiler/libc symbol version dependencies
         """
-        rid = RPM_Requires.get_id(name)
-        if rid:
-            # add to the cache
-            self.requires_cache[name] = rid
-            return rid
-        else:
-            return False
-
-
-    def get_requires_record(self, name):
-        """
-        Function to lookup, add, and cache requires info
-        """
-
-        # first check the cache
-        if name in self.requires_cache:
-            return self.requires_cache[name]
-
-        # not cached, check the database
-        rid = self.cache_get_requires(name)
-        if rid:
-            return rid
+        logging.debug('in Binary.get_requires(%s)' % hdr.rpm)
 
-        return None
+        flist = []
+        for dep in hdr.requires:
+            dep = header.format_dependency(dep)
+            if re.search('(rpmlib|GLIBC|GCC|rtld)', dep):
+                continue
+            if dep not in flist:
+                flist.append(dep)
+        return flist
 
 
-    def add_requires(self, tid, pid, fname):
+    def add_requires(self, tid, pid, flist):
         """
         Function to add requires to the database
         """
-        logging.debug('in Binary.add_requires(%s, %s, %s)' % (tid, pid, fname))
+        logging.debug('in Binary.add_requires(%s, %s, %s)' % (tid, pid, flist))
 
-        flist = commands.getoutput("rpm -qp --nosignature --requires " + self.rcommon.clean_shell(fname) + " | egrep -v '(rpmlib|GLIBC|GCC|rtld)' | uniq")
-        flist = flist.splitlines()
+        rows = []
         for dep in flist:
             if dep:
                 self.rcommon.show_progress()
                 if self.options.verbose:
                     print 'Dependency: %s' % dep
-                rid = self.get_requires_record(dep.strip())
-                if rid:
-                    return rid
-                try:
-                    r = RPM_Requires.create(
-                        pid  = pid,
-                        tid  = tid,
-                        name = dep.strip()
-                    )
-                    return r.id
-                except Exception, e:
-                    logging.error('Failed to add requires %s to the database!\n%s', fname, e)
-
-
-    def cache_get_provides(self, name):
-        """
-        Function to look up the pv_record and add it to the cache for provides
-        """
-        prid = RPM_Provides.get_id(name)
-        if prid:
-            # add to the cache
-            self.provides_cache[name] = prid
-            return prid
-        else:
-            return False
+                rows.append({'pid': pid, 'tid': tid, 'name': dep.strip()})
 
+        return RPM_Requires.bulk_insert(rows, self.batch_size)
 
-    def get_provides_record(self, name):
+
+    def get_provides(self, hdr):
         """
-        Function to lookup, add, and cache provides info
+        Function to get the list of provides from an RPM header
         """
+        logging.debug('in Binary.get_provides(%s)' % hdr.rpm)
 
-        # first check the cache
-        if name in self.provides_cache:
-            return self.provides_cache[name]
-
-        # not cached, check the database
-        prid = self.cache_get_provides(name)
-        if prid:
-            return prid
+        return [header.format_dependency(dep) for dep in hdr.provides]
 
-        return None
 
-
-    def add_provides(self, tid, pid, fname):
+    def add_provides(self, tid, pid, flist):
         """
         Function to add provides to the database
         """
-        logging.debug('in Binary.add_provides(%s, %s, %s)' % (tid, pid, fname))
+        logging.debug('in Binary.add_provides(%s, %s, %s)' % (tid, pid, flist))
 
-        flist = commands.getoutput("rpm -qp --nosignature --provides " + self.rcommon.clean_shell(fname))
-        flist = flist.splitlines()
+        rows = []
         for prov in flist:
             if prov:
                 self.rcommon.show_progress()
                 if self.options.verbose:
                     print 'Provides: %s' % prov
-                prid = self.get_provides_record(prov.strip())
-                if prid:
-                    return prid
-                try:
-                    pr = RPM_Provides.create(
-                         pid  = pid,
-                         tid  = tid,
-                         name = prov.strip()
-                    )
-                    return pr.id
-                except Exception, e:
-                    logging.error('Failed to add provides %s to the database!\n%s', fname, e)
+                rows.append({'pid': pid, 'tid': tid, 'name': prov.strip()})
+
+        return RPM_Provides.bulk_insert(rows, self.batch_size)
 
 
-    def add_records(self, tid, pid, file_list):
+    def add_records(self, tid, pid, file_list, aids):
         """
-        Function to add file records
+        Function to add file records; aids maps the names of the binaries to their analysis
         """
         logging.debug('in Binary.add_records(%s, %s, %s)' % (tid, pid, file_list))
 
+        paths = dict((x, split_path(file_list[x]['file'].strip())) for x in file_list.keys())
+        dids  = self.get_dirname_ids(set(dirname for (dirname, basename) in paths.values()))
+        bids  = self.get_basename_ids(set(basename for (dirname, basename) in paths.values()))
+
+        rows = []
         for x in file_list.keys():
             fname = file_list[x]['file'].strip()
             uid   = self.get_user_record(file_list[x]['user'])
@@ -619,76 +727,131 @@ class Binary:
             if self.options.verbose:
                 print 'File: %s' % fname
 
+            (dirname, basename) = paths[x]
+            rows.append({'tid'    : tid,
+                         'pid'    : pid,
+                         'uid'    : uid,
+                         'gid'    : gid,
+                         'aid'    : aids.get(fname),
+                         'did'    : dids[dirname],
+                         'bid'    : bids[basename],
+                         'is_suid': file_list[x]['is_suid'],
+                         'is_sgid': file_list[x]['is_sgid'],
+                         'perms'  : file_list[x]['perms']})
+
+        count = RPM_File.bulk_insert(rows, self.batch_size)
+        logging.debug('Filed %d files for pid %d', count, pid)
+        return count
+
+
+    def get_binary_records(self, hdr):
+        """
+        Function to get the flags and symbols of the ELF binaries in an RPM; the payload
+        is streamed and only executable ELF files are read into memory.  Binaries whose
+        digest has already been analyzed are not looked at again.  Returns a list of
+        (file, digest, flags, symbols) tuples, where flags and symbols are None for
+        binaries that were already analyzed
+        """
+        logging.debug('in Binary.get_binary_records(%s)' % hdr.rpm)
+
+        digests  = dict((f.path, f.digest) for f in hdr.files)
+        analyzed = self.analyzed or set()
+        binaries = []
+        for entry in payload.payload_entries(hdr):
+            # only regular files with the user execute bit set are of interest
+            if not stat.S_ISREG(entry.mode) or not entry.mode & stat.S_IXUSR:
+                continue
+
+            digest = digests.get(entry.name)
+            if digest and digest in analyzed:
+                logging.debug('already analyzed: %s' % entry.name)
+                binaries.append((entry.name, digest, None, None))
+                continue
+
+            magic = entry.read(4)
+            if magic != elf.ELF_MAGIC:
+                continue
+
+            logging.debug('checking file: %s' % entry.name)
+            data = magic + entry.read()
+            if not digest:
+                # older packages don't carry file digests
+                digest = hashlib.sha256(data).hexdigest()
             try:
-                f = RPM_File.create(
-                    tid     = tid,
-                    pid     = pid,
-                    uid     = uid,
-                    gid     = gid,
-                    file    = fname,
-                    is_suid = file_list[x]['is_suid'],
-                    is_sgid = file_list[x]['is_sgid'],
-                    perms   = file_list[x]['perms']
-                )
-                logging.debug('Filed File with id %d', f.id)
-            except Exception, e:
-                logging.error('Adding file %s failed!\n%s', fname, e)
+                binary = elf.ELF(data)
+            except elf.ELFError, e:
+                logging.error('Unable to parse %s: %s', entry.name, e)
+                continue
+
+            flags   = self.get_binary_flags(binary)
+            symbols = self.get_binary_symbols(binary)
 
+            binaries.append((entry.name, digest, flags, symbols))
 
-    def add_binary_records(self, tid, pid, rpm):
+        return binaries
+
+
+    def add_binary_records(self, file_list, binaries):
         """
-        Function to add binary symbols and flags to the database
+        Function to add the analyses of the binaries that aren't in the database yet and
+        return a dict mapping the names of the files to their analysis id; files are matched
+        by the digest the header has for them, so that every link to a hardlinked binary
+        gets the analysis of the one payload entry that carries its data
         """
-        logging.debug('in Binary.add_binary_records(%s, %s, %s)' % (tid, pid, rpm))
+        logging.debug('in Binary.add_binary_records(%d binaries)', len(binaries))
 
-        cpio_dir = tempfile.mkdtemp()
-        try:
-            current_dir = os.getcwd()
-            os.chdir(cpio_dir)
-            # explode rpm
-            command      = 'rpm2cpio "%s" | cpio -d -i 2>/dev/null' % rpm
-            (rc, output) = commands.getstatusoutput(command)
-
-            command      = 'find . -perm /u+x -type f'
-            (rc, output) = commands.getstatusoutput(command)
-
-            rdir = output.split()
-            logging.debug('dir is %s' % rdir)
-            for fname in rdir:
-                if os.path.isfile(fname):
-                    logging.debug('checking file: %s' % fname)
-                    # executable files
-                    if re.search('ELF', commands.getoutput('file ' + self.rcommon.clean_shell(fname))):
-                        # ELF binaries
-                        flags   = self.get_binary_flags(fname)
-                        symbols = self.get_binary_symbols(fname)
-                        # need to change ./usr/sbin/foo to /usr/sbin/foo and look up the file record
-                        nfile   = fname[1:]
-                        fid     = RPM_File.find_id(nfile, tid, pid)
-                        self.add_flag_records(tid, fid, pid, flags)
-                        self.add_symbol_records(tid, fid, pid, symbols)
-            os.chdir(current_dir)
-        finally:
-            logging.debug('Removing temporary directory: %s...' % cpio_dir)
-            try:
-                shutil.rmtree(cpio_dir)
-            except:
-                # if we can't remove the directory, recursively chmod and try again
-                os.system('chmod -R u+rwx ' + cpio_dir)
-                shutil.rmtree(cpio_dir)
+        if not binaries:
+            return {}
+
+        # older packages don't carry file digests, those are matched by the name of the
+        # binary that was read
+        computed = dict((b[0], b[1]) for b in binaries)
+        digests  = dict((file_list[x]['file'].strip(), file_list[x]['digest'] or computed.get(file_list[x]['file'].strip()))
+                        for x in file_list.keys())
+
+        # only the binaries that get a file record need an analysis
+        wanted   = set(digests.values())
+        binaries = [b for b in binaries if b[1] in wanted]
+
+        aids     = RPM_Analysis.get_ids(set(b[1] for b in binaries))
+        rows     = []
+        symbols  = {}
+        for (nfile, digest, flags, bsymbols) in binaries:
+            if digest in aids or digest in symbols:
+                continue
+            if flags is None:
+                # analyzed when the package was, but since removed from the database
+                logging.warning('Analysis of %s (%s) is missing, not recording its flags', nfile, digest)
+                continue
+            logging.debug('flags for %s: %s' % (nfile, flags))
+            rows.append({'digest' : digest,
+                         'relro'  : flags['relro'],
+                         'ssp'    : flags['ssp'],
+                         'pie'    : flags['pie'],
+                         'fortify': flags['fortify_source'],
+                         'nx'     : flags['nx']})
+            symbols[digest] = bsymbols
 
+        if rows:
+            RPM_Analysis.bulk_insert(rows, self.batch_size)
+            aids  = RPM_Analysis.get_ids(set(b[1] for b in binaries))
+            count = self.add_symbol_records([(aids[digest], symbols[digest]) for digest in symbols])
+            RPM_TagStats.add(None, flags=len(rows), symbols=count)
+            if self.analyzed is not None:
+                self.analyzed.update(symbols.keys())
 
-    def get_binary_symbols(self, bfile):
+        return dict((fname, aids[digest]) for (fname, digest) in digests.items() if digest in aids)
+
+
+    def get_binary_symbols(self, binary):
         """
-        Function to get symbols from a binary file
+        Function to get the exported dynamic symbols from a parsed ELF binary
         """
         symbols = []
 
         self.rcommon.show_progress()
 
-        nm_output = commands.getoutput('nm -D -g ' + self.rcommon.clean_shell(bfile))
-        nm_output = nm_output.split()
-        for symbol in nm_output:
+        for symbol in binary.dynamic_symbols():
             if re.search('^[A-Za-z_]{2}.*', symbol):
                 if symbol not in self.excluded_symbols:
                     # dump the __cxa* symbols
@@ -698,95 +861,111 @@ class Binary:
         return symbols
 
 
-    def get_binary_flags(self, bfile):
+    def get_binary_flags(self, binary):
         """
-        Function to get binary flags from a file
+        Function to get binary flags from a parsed ELF binary
         """
         # set all bits to their defaults
         flags = {'relro': 0, 'ssp': 0, 'nx': 1, 'pie': 0, 'fortify_source': 0}
 
         self.rcommon.show_progress()
 
-        readelf_l = commands.getoutput('readelf -l ' + self.rcommon.clean_shell(bfile))
-        readelf_d = commands.getoutput('readelf -d ' + self.rcommon.clean_shell(bfile))
-        readelf_s = commands.getoutput('readelf -s ' + self.rcommon.clean_shell(bfile))
-        readelf_h = commands.getoutput('readelf -h ' + self.rcommon.clean_shell(bfile))
+        dt_flags   = binary.dynamic_value(elf.DT_FLAGS) or 0
+        dt_flags_1 = binary.dynamic_value(elf.DT_FLAGS_1) or 0
+        names      = binary.symbol_names()
 
-        if re.search('GNU_RELRO', readelf_l):
-            if re.search('BIND_NOW', readelf_d):
+        if binary.has_segment(elf.PT_GNU_RELRO):
+            if binary.dynamic_value(elf.DT_BIND_NOW) is not None or dt_flags & elf.DF_BIND_NOW or dt_flags_1 & elf.DF_1_NOW:
                 # full RELRO
                 flags['relro'] = 1
             else:
                 # partial RELRO
                 flags['relro'] = 2
 
-        if re.search('__stack_chk_fail', readelf_s):
-            # found
-            flags['ssp'] = 1
+        for name in names:
+            if '__stack_chk_fail' in name:
+                # found
+                flags['ssp'] = 1
+                break
 
-        if re.search('GNU_STACK.*RWE', readelf_l):
+        stack = binary.segment_flags(elf.PT_GNU_STACK)
+        if stack is not None and stack & elf.PF_X:
             # disabled
             flags['nx'] = 0
 
-        if re.search('Type:( )+EXEC', readelf_h):
+        if binary.type == elf.ET_EXEC:
             # none
             flags['pie'] = 0
-        elif re.search('Type:( )+DYN', readelf_h):
-            if re.search('\(DEBUG\)', readelf_d):
+        elif binary.type == elf.ET_DYN:
+            if binary.dynamic_value(elf.DT_DEBUG) is not None or dt_flags_1 & elf.DF_1_PIE:
                 # enabled
                 flags['pie'] = 1
             else:
                 # DSO
                 flags['pie'] = 2
 
-        if re.search('_chk@GLIBC', readelf_s):
-            # found
-            flags['fortify_source'] = 1
+        for name in names:
+            if '_chk@GLIBC' in name:
+                # found
+                flags['fortify_source'] = 1
+                break
 
         return flags
 
 
-    def add_flag_records(self, tid, fid, pid, flags):
+    def get_symbol_ids(self, names):
         """
-        Function to add flag records to the database
+        Function to return a dict mapping symbol names to their id in the symbol name
+        dictionary, adding the names that aren't in it yet (and indexing them)
         """
-        logging.debug('in Binary.add_flag_records(%s, %s, %s, %s)' % (tid, fid, pid, flags))
+        added = RPM_SymbolName.intern(names, self.symbol_cache, self.batch_size)
+        if added and self.trigram_index:
+            rows = search.trigram_rows(None, [(sid, name) for (name, sid) in added.items()])
+            RPM_SymbolTrigram.bulk_insert(rows, self.batch_size)
 
-        logging.debug('flags: %s' % flags)
+        return self.symbol_cache
 
-        try:
-            f = RPM_Flags.create(
-                tid     = tid,
-                pid     = pid,
-                fid     = fid,
-                relro   = flags['relro'],
-                ssp     = flags['ssp'],
-                pie     = flags['pie'],
-                fortify = flags['fortify_source'],
-                nx      = flags['nx']
-            )
-            logging.debug('Filed Flag with id %d', f.id)
-        except Exception, e:
-            logging.error('Adding flags for fid %d failed!\n%s', fid, e)
+
+    def get_dirname_ids(self, names):
+        """
+        Function to return a dict mapping directory names to their id in the directory
+        dictionary, adding the names that aren't in it yet
+        """
+        RPM_Dirname.intern(names, self.dirname_cache, self.batch_size)
+        return self.dirname_cache
 
 
-    def add_symbol_records(self, tid, fid, pid, symbols):
+    def get_basename_ids(self, names):
         """
-        Function to add symbol records to the database
+        Function to return a dict mapping basenames to their id in the basename dictionary,
+        adding the names that aren't in it yet (and indexing them); there are far more
+        basenames than directories, so they are looked up per package rather than cached
         """
-        logging.debug('in Binary.add_symbol_records(%s, %s, %s, %s)' % (tid, fid, pid, symbols))
+        ids   = {}
+        added = RPM_Basename.intern(names, ids, self.batch_size)
+        if added and self.trigram_index:
+            rows = search.trigram_rows(None, [(bid, name) for (name, bid) in added.items()])
+            RPM_FileTrigram.bulk_insert(rows, self.batch_size)
 
-        for symbol in symbols:
-            try:
-                s = RPM_Symbols.create(
-                    pid     = pid,
-                    tid     = tid,
-                    fid     = fid,
-                    symbols = symbol
-                )
-                logging.debug('Filed Symbol with id %d', s.id)
-            except Exception, e:
-                logging.error('Adding symbol for fid %d failed!\n%s', fid, e)
+        return ids
+
+
+    def add_symbol_records(self, records):
+        """
+        Function to add symbol records to the database; records is a list of
+        (aid, symbols) tuples
+        """
+        logging.debug('in Binary.add_symbol_records(%s)' % records)
+
+        sids = self.get_symbol_ids(set(symbol for (aid, symbols) in records for symbol in symbols))
+        rows = []
+        for (aid, symbols) in records:
+            for symbol in symbols:
+                rows.append({'aid': aid, 'sid': sids[symbol]})
+
+        count = RPM_Symbols.bulk_insert(rows, self.batch_size)
+        logging.debug('Filed %d symbols', count)
+        return count
 
 
     def list_updates(self, tag):
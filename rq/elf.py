@@ -0,0 +1,319 @@
+"""
+This program extracts data from RPM and SRPM packages and stores it in
+a database for later querying.
+
+based on the srpm script of similar function copyright (c) 2005 Stew Benedict <sbenedict@mandriva.com>
+copyright (c) 2007-2017 Vincent Danen <vdanen@linsec.ca>
+
+This file is part of rq.
+
+rq is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rq is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rq.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import struct
+from collections import namedtuple
+
+ELF_MAGIC = '\x7fELF'
+
+ELFCLASS32  = 1
+ELFCLASS64  = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+ET_EXEC = 2
+ET_DYN  = 3
+
+PT_DYNAMIC   = 2
+PT_GNU_STACK = 0x6474e551
+PT_GNU_RELRO = 0x6474e552
+
+PF_X = 0x1
+PF_W = 0x2
+PF_R = 0x4
+
+SHT_SYMTAB      = 2
+SHT_DYNSYM      = 11
+SHT_GNU_VERDEF  = 0x6ffffffd
+SHT_GNU_VERNEED = 0x6ffffffe
+SHT_GNU_VERSYM  = 0x6fffffff
+
+VER_FLG_BASE = 0x1
+
+DT_NULL     = 0
+DT_DEBUG    = 21
+DT_BIND_NOW = 24
+DT_FLAGS    = 30
+DT_FLAGS_1  = 0x6ffffffb
+
+DF_BIND_NOW = 0x8
+DF_1_NOW    = 0x1
+DF_1_PIE    = 0x08000000
+
+STB_GLOBAL     = 1
+STB_WEAK       = 2
+STB_GNU_UNIQUE = 10
+
+SHN_UNDEF = 0
+
+VERSYM_HIDDEN = 0x8000
+
+Segment = namedtuple('Segment', 'type flags offset filesz')
+Section = namedtuple('Section', 'name type offset size link entsize')
+Symbol  = namedtuple('Symbol', 'name bind shndx version hidden dynamic')
+
+
+class ELFError(Exception):
+    """
+    Raised when a buffer does not hold a usable ELF object
+    """
+    pass
+
+
+class ELF:
+    """
+    Class to parse the program headers, dynamic section and symbol tables of an
+    ELF object held in memory, in the spirit of readelf -l -d -s -h
+    """
+
+    def __init__(self, data):
+        self.data     = data
+        self.segments = []
+        self.sections = []
+        self.dynamic  = []
+        self.symbols  = []
+
+        if data[:4] != ELF_MAGIC:
+            raise ELFError('not an ELF object')
+
+        try:
+            self.__parse()
+        except (struct.error, IndexError, ValueError), e:
+            raise ELFError('corrupt ELF object: %s' % e)
+
+
+    def __parse(self):
+        """
+        Function to parse the headers and tables we care about
+        """
+        data = self.data
+
+        if ord(data[4]) == ELFCLASS64:
+            self.is64 = True
+        elif ord(data[4]) == ELFCLASS32:
+            self.is64 = False
+        else:
+            raise ELFError('unknown ELF class')
+
+        if ord(data[5]) == ELFDATA2MSB:
+            self.endian = '>'
+        else:
+            self.endian = '<'
+
+        e = self.endian
+        if self.is64:
+            (self.type, machine, version, entry, phoff, shoff, flags, ehsize,
+             phentsize, phnum, shentsize, shnum, shstrndx) = struct.unpack_from(e + 'HHIQQQIHHHHHH', data, 16)
+        else:
+            (self.type, machine, version, entry, phoff, shoff, flags, ehsize,
+             phentsize, phnum, shentsize, shnum, shstrndx) = struct.unpack_from(e + 'HHIIIIIHHHHHH', data, 16)
+
+        # program headers
+        for x in range(phnum):
+            offset = phoff + x * phentsize
+            if self.is64:
+                (p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align) = \
+                    struct.unpack_from(e + 'IIQQQQQQ', data, offset)
+            else:
+                (p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align) = \
+                    struct.unpack_from(e + 'IIIIIIII', data, offset)
+            self.segments.append(Segment(type=p_type, flags=p_flags, offset=p_offset, filesz=p_filesz))
+
+        # dynamic section, via the PT_DYNAMIC segment
+        for segment in self.segments:
+            if segment.type != PT_DYNAMIC:
+                continue
+            if self.is64:
+                fmt  = e + 'qQ'
+            else:
+                fmt  = e + 'iI'
+            size = struct.calcsize(fmt)
+            for offset in range(segment.offset, segment.offset + segment.filesz - size + 1, size):
+                (d_tag, d_val) = struct.unpack_from(fmt, data, offset)
+                if d_tag == DT_NULL:
+                    break
+                self.dynamic.append((d_tag, d_val))
+
+        # section headers
+        if shoff == 0 or shnum == 0:
+            return
+        for x in range(shnum):
+            offset = shoff + x * shentsize
+            if self.is64:
+                (sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign, sh_entsize) = \
+                    struct.unpack_from(e + 'IIQQQQIIQQ', data, offset)
+            else:
+                (sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign, sh_entsize) = \
+                    struct.unpack_from(e + 'IIIIIIIIII', data, offset)
+            self.sections.append(Section(name=sh_name, type=sh_type, offset=sh_offset, size=sh_size,
+                                         link=sh_link, entsize=sh_entsize))
+
+        versions = self.__versions()
+        for section in self.sections:
+            if section.type in (SHT_DYNSYM, SHT_SYMTAB):
+                self.__read_symbols(section, versions)
+
+
+    def __string(self, section, offset):
+        """
+        Function to return a string from a string table section
+        """
+        start = section.offset + offset
+        end   = self.data.index('\0', start)
+        return self.data[start:end]
+
+
+    def __versions(self):
+        """
+        Function to return a dict mapping symbol version indexes to version names,
+        from the version definition and version requirement sections
+        """
+        e        = self.endian
+        versions = {}
+
+        for section in self.sections:
+            if section.type == SHT_GNU_VERNEED:
+                strtab = self.sections[section.link]
+                offset = section.offset
+                while True:
+                    (vn_version, vn_cnt, vn_file, vn_aux, vn_next) = struct.unpack_from(e + 'HHIII', self.data, offset)
+                    aux = offset + vn_aux
+                    for x in range(vn_cnt):
+                        (vna_hash, vna_flags, vna_other, vna_name, vna_next) = struct.unpack_from(e + 'IHHII', self.data, aux)
+                        versions[vna_other] = self.__string(strtab, vna_name)
+                        if not vna_next:
+                            break
+                        aux += vna_next
+                    if not vn_next:
+                        break
+                    offset += vn_next
+
+            elif section.type == SHT_GNU_VERDEF:
+                strtab = self.sections[section.link]
+                offset = section.offset
+                while True:
+                    (vd_version, vd_flags, vd_ndx, vd_cnt, vd_hash, vd_aux, vd_next) = struct.unpack_from(e + 'HHHHIII', self.data, offset)
+                    # the base definition is the file's own soname, not a version
+                    if vd_cnt and not vd_flags & VER_FLG_BASE:
+                        (vda_name, vda_next) = struct.unpack_from(e + 'II', self.data, offset + vd_aux)
+                        versions[vd_ndx] = self.__string(strtab, vda_name)
+                    if not vd_next:
+                        break
+                    offset += vd_next
+
+        return versions
+
+
+    def __read_symbols(self, section, versions):
+        """
+        Function to read the symbols of a symbol table section
+        """
+        e      = self.endian
+        strtab = self.sections[section.link]
+        dynamic = section.type == SHT_DYNSYM
+
+        versym = None
+        if dynamic:
+            for vsection in self.sections:
+                if vsection.type == SHT_GNU_VERSYM:
+                    versym = vsection
+
+        if self.is64:
+            size = 24
+        else:
+            size = 16
+
+        for x in range(1, section.size // size):
+            offset = section.offset + x * size
+            if self.is64:
+                (st_name, st_info, st_other, st_shndx, st_value, st_size) = struct.unpack_from(e + 'IBBHQQ', self.data, offset)
+            else:
+                (st_name, st_value, st_size, st_info, st_other, st_shndx) = struct.unpack_from(e + 'IIIBBH', self.data, offset)
+
+            version = None
+            hidden  = False
+            if versym:
+                ndx     = struct.unpack_from(e + 'H', self.data, versym.offset + x * 2)[0]
+                hidden  = bool(ndx & VERSYM_HIDDEN)
+                version = versions.get(ndx & ~VERSYM_HIDDEN)
+
+            self.symbols.append(Symbol(name=self.__string(strtab, st_name), bind=st_info >> 4, shndx=st_shndx,
+                                       version=version, hidden=hidden, dynamic=dynamic))
+
+
+    def has_segment(self, p_type):
+        """
+        Return True if there is a program header of the given type
+        """
+        for segment in self.segments:
+            if segment.type == p_type:
+                return True
+        return False
+
+
+    def segment_flags(self, p_type):
+        """
+        Return the flags of the first program header of the given type, or None
+        """
+        for segment in self.segments:
+            if segment.type == p_type:
+                return segment.flags
+        return None
+
+
+    def dynamic_value(self, d_tag):
+        """
+        Return the value of a dynamic section entry, or None if it is not there
+        """
+        for (tag, value) in self.dynamic:
+            if tag == d_tag:
+                return value
+        return None
+
+
+    def symbol_names(self):
+        """
+        Return the names of all the symbols, versioned the way readelf -s shows them
+        (name@VERSION for references and hidden versions, name@@VERSION for defaults)
+        """
+        names = []
+        for symbol in self.symbols:
+            if symbol.version and symbol.dynamic:
+                if symbol.shndx == SHN_UNDEF or symbol.hidden:
+                    names.append('%s@%s' % (symbol.name, symbol.version))
+                else:
+                    names.append('%s@@%s' % (symbol.name, symbol.version))
+            else:
+                names.append(symbol.name)
+        return names
+
+
+    def dynamic_symbols(self):
+        """
+        Return the external dynamic symbols, the way nm -D -g lists them
+        """
+        names = []
+        for symbol in self.symbols:
+            if symbol.dynamic and symbol.name and symbol.bind in (STB_GLOBAL, STB_WEAK, STB_GNU_UNIQUE):
+                names.append(symbol.name)
+        names.sort()
+        return names
@@ -0,0 +1,101 @@
+"""
+This program extracts data from RPM and SRPM packages and stores it in
+a database for later querying.
+
+based on the srpm script of similar function copyright (c) 2005 Stew Benedict <sbenedict@mandriva.com>
+copyright (c) 2007-2017 Vincent Danen <vdanen@linsec.ca>
+
+This file is part of rq.
+
+rq is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rq is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rq.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import binascii
+
+# markers for each kind of piece of a version, chosen so that the encoded keys sort
+# the way rpmvercmp() orders versions: a tilde sorts before the end of the version,
+# which sorts before a caret, which sorts before any alphabetic segment, which sorts
+# before any numeric segment.  Only lowercase letters and digits are used so that
+# case-insensitive collations order keys the same way.
+TILDE   = 'a'
+END     = 'b'
+CARET   = 'c'
+ALPHA   = 'd'
+NUMERIC = 'e'
+
+# ends an alphabetic segment, which is hex encoded; sorts before any hex digit
+ALPHA_END = '.'
+
+# width of the (zero padded) epoch and of the length prefix of a numeric segment
+EPOCH_WIDTH  = 10
+LENGTH_WIDTH = 3
+
+
+def _isalnum(c):
+    """
+    Function to test for an ASCII letter or digit the way rpm's risalnum() does;
+    str.isalnum() depends on the locale
+    """
+    return ('0' <= c <= '9') or ('a' <= c <= 'z') or ('A' <= c <= 'Z')
+
+
+def version_key(version):
+    """
+    Function to encode a version (or release) string into a key that sorts, as a
+    plain string, in the same order rpmvercmp() puts the versions in; versions
+    that rpm considers equal ('1.0' and '1_0') get the same key
+    """
+    key = []
+    x   = 0
+    end = len(version)
+    while x < end:
+        c = version[x]
+        if c == '~':
+            key.append(TILDE)
+            x += 1
+        elif c == '^':
+            key.append(CARET)
+            x += 1
+        elif '0' <= c <= '9':
+            start = x
+            while x < end and '0' <= version[x] <= '9':
+                x += 1
+            # leading zeroes don't count, and a longer number is a bigger number
+            digits = version[start:x].lstrip('0')
+            key.append('%s%0*d%s' % (NUMERIC, LENGTH_WIDTH, len(digits), digits))
+        elif _isalnum(c):
+            start = x
+            while x < end and _isalnum(version[x]) and not '0' <= version[x] <= '9':
+                x += 1
+            key.append('%s%s%s' % (ALPHA, binascii.hexlify(version[start:x]), ALPHA_END))
+        else:
+            # separators only split segments
+            x += 1
+    key.append(END)
+    return ''.join(key)
+
+
+def evr_key(epoch, version, release):
+    """
+    Function to encode an epoch, version and release into a single key that sorts,
+    as a plain string, the way rpm orders packages; a missing epoch is 0
+    """
+    return '%0*d%s%s' % (EPOCH_WIDTH, int(epoch or 0), version_key(version or ''), version_key(release or ''))
+
+
+def rpmvercmp(a, b):
+    """
+    Function to compare two version strings the way rpm does; returns 1 if a is
+    newer, -1 if b is newer and 0 if they are the same
+    """
+    return cmp(version_key(a), version_key(b))
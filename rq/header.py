@@ -0,0 +1,315 @@
+"""
+This program extracts data from RPM and SRPM packages and stores it in
+a database for later querying.
+
+based on the srpm script of similar function copyright (c) 2005 Stew Benedict <sbenedict@mandriva.com>
+copyright (c) 2007-2017 Vincent Danen <vdanen@linsec.ca>
+
+This file is part of rq.
+
+rq is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rq is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rq.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import struct
+from collections import namedtuple
+
+# see rpm's lib/rpmtag.h for the full list; these are the ones we care about
+RPMTAG_NAME              = 1000
+RPMTAG_VERSION           = 1001
+RPMTAG_RELEASE           = 1002
+RPMTAG_EPOCH             = 1003
+RPMTAG_BUILDTIME         = 1006
+RPMTAG_ARCH              = 1022
+RPMTAG_OLDFILENAMES      = 1027
+RPMTAG_FILESIZES         = 1028
+RPMTAG_FILEMODES         = 1030
+RPMTAG_FILEDIGESTS       = 1035
+RPMTAG_FILELINKTOS       = 1036
+RPMTAG_FILEFLAGS         = 1037
+RPMTAG_FILEUSERNAME      = 1039
+RPMTAG_FILEGROUPNAME     = 1040
+RPMTAG_SOURCERPM         = 1044
+RPMTAG_PROVIDENAME       = 1047
+RPMTAG_REQUIREFLAGS      = 1048
+RPMTAG_REQUIRENAME       = 1049
+RPMTAG_REQUIREVERSION    = 1050
+RPMTAG_SOURCEPACKAGE     = 1106
+RPMTAG_PROVIDEFLAGS      = 1112
+RPMTAG_PROVIDEVERSION    = 1113
+RPMTAG_DIRINDEXES        = 1116
+RPMTAG_BASENAMES         = 1117
+RPMTAG_DIRNAMES          = 1118
+RPMTAG_PAYLOADFORMAT     = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMTAG_LONGFILESIZES     = 5008
+RPMTAG_FILEDIGESTALGO    = 5011
+
+# header data types
+RPM_NULL_TYPE         = 0
+RPM_CHAR_TYPE         = 1
+RPM_INT8_TYPE         = 2
+RPM_INT16_TYPE        = 3
+RPM_INT32_TYPE        = 4
+RPM_INT64_TYPE        = 5
+RPM_STRING_TYPE       = 6
+RPM_BIN_TYPE          = 7
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE   = 9
+
+# dependency sense flags
+RPMSENSE_LESS    = 0x02
+RPMSENSE_GREATER = 0x04
+RPMSENSE_EQUAL   = 0x08
+
+LEAD_MAGIC   = '\xed\xab\xee\xdb'
+HEADER_MAGIC = '\x8e\xad\xe8\x01'
+LEAD_SIZE    = 96
+
+RPMFile    = namedtuple('RPMFile', 'path mode user group size digest linkto flags')
+Dependency = namedtuple('Dependency', 'name flags version')
+
+
+class HeaderError(Exception):
+    """
+    Raised when a file does not look like an RPM package
+    """
+    pass
+
+
+class Header:
+    """
+    Class to read the lead, signature and header of an RPM package in a single
+    pass over the file, without calling out to rpm.  Tag data is only decoded
+    when it is asked for.
+    """
+
+    def __init__(self, rpm):
+        self.rpm            = rpm
+        self.is_source      = False
+        self.payload_offset = 0
+        self.tags           = {}
+        self.store          = ''
+        self.cache          = {}
+        self.__read()
+
+
+    def __read(self):
+        """
+        Function to read the lead, the signature header and the main header
+        """
+        logging.debug('in Header.__read(%s)' % self.rpm)
+
+        f = open(self.rpm, 'rb')
+        try:
+            lead = f.read(LEAD_SIZE)
+            if len(lead) != LEAD_SIZE or lead[:4] != LEAD_MAGIC:
+                raise HeaderError('%s is not an RPM package' % self.rpm)
+            # the lead type is 0 for binary and 1 for source packages
+            self.is_source = struct.unpack('>h', lead[6:8])[0] == 1
+
+            # the signature header is padded out to an 8 byte boundary
+            (index, store) = self.__read_section(f)
+            pad = (8 - ((16 + len(index) + len(store)) % 8)) % 8
+            f.read(pad)
+
+            (index, store) = self.__read_section(f)
+            for i in range(0, len(index), 16):
+                (tag, dtype, offset, count) = struct.unpack('>iiii', index[i:i + 16])
+                self.tags[tag] = (dtype, offset, count)
+            self.store = store
+
+            self.payload_offset = f.tell()
+        finally:
+            f.close()
+
+        if RPMTAG_SOURCEPACKAGE in self.tags:
+            self.is_source = True
+
+
+    def __read_section(self, f):
+        """
+        Function to read a header structure; returns the raw index and data store
+        """
+        intro = f.read(16)
+        if len(intro) != 16 or intro[:4] != HEADER_MAGIC:
+            raise HeaderError('%s has a corrupt header' % self.rpm)
+        (nindex, hsize) = struct.unpack('>ii', intro[8:16])
+        index = f.read(nindex * 16)
+        store = f.read(hsize)
+        if len(index) != nindex * 16 or len(store) != hsize:
+            raise HeaderError('%s has a truncated header' % self.rpm)
+        return (index, store)
+
+
+    def get(self, tag, default=None):
+        """
+        Function to return the decoded value of a tag; strings are returned as a
+        string, everything else as a list
+        """
+        if tag in self.cache:
+            return self.cache[tag]
+        if tag not in self.tags:
+            return default
+
+        (dtype, offset, count) = self.tags[tag]
+        store = self.store
+
+        if dtype in (RPM_STRING_TYPE, RPM_STRING_ARRAY_TYPE, RPM_I18NSTRING_TYPE):
+            value = []
+            for x in range(count):
+                end = store.index('\0', offset)
+                value.append(store[offset:end])
+                offset = end + 1
+            if dtype == RPM_STRING_TYPE:
+                value = value[0]
+        elif dtype == RPM_INT16_TYPE:
+            value = list(struct.unpack('>%dH' % count, store[offset:offset + 2 * count]))
+        elif dtype == RPM_INT32_TYPE:
+            value = list(struct.unpack('>%dI' % count, store[offset:offset + 4 * count]))
+        elif dtype == RPM_INT64_TYPE:
+            value = list(struct.unpack('>%dQ' % count, store[offset:offset + 8 * count]))
+        elif dtype in (RPM_CHAR_TYPE, RPM_INT8_TYPE):
+            value = [ord(c) for c in store[offset:offset + count]]
+        elif dtype == RPM_BIN_TYPE:
+            value = store[offset:offset + count]
+        else:
+            value = None
+
+        self.cache[tag] = value
+        return value
+
+
+    def get_string(self, tag):
+        """
+        Function to return a tag as a single string, or '' if it is not present
+        """
+        value = self.get(tag, '')
+        if isinstance(value, list):
+            if value:
+                value = value[0]
+            else:
+                value = ''
+        return str(value)
+
+
+    @property
+    def name(self):
+        return self.get_string(RPMTAG_NAME)
+
+    @property
+    def version(self):
+        return self.get_string(RPMTAG_VERSION)
+
+    @property
+    def release(self):
+        return self.get_string(RPMTAG_RELEASE)
+
+    @property
+    def epoch(self):
+        epoch = self.get(RPMTAG_EPOCH)
+        if epoch:
+            return epoch[0]
+        return None
+
+    @property
+    def buildtime(self):
+        return self.get_string(RPMTAG_BUILDTIME)
+
+    @property
+    def arch(self):
+        return self.get_string(RPMTAG_ARCH)
+
+    @property
+    def sourcerpm(self):
+        return self.get_string(RPMTAG_SOURCERPM)
+
+    @property
+    def payload_compressor(self):
+        compressor = self.get_string(RPMTAG_PAYLOADCOMPRESSOR)
+        if not compressor:
+            # older packages do not have this tag and are always gzip'd
+            compressor = 'gzip'
+        return compressor
+
+
+    @property
+    def files(self):
+        """
+        Return the list of files in this package as RPMFile tuples
+        """
+        if 'files' in self.cache:
+            return self.cache['files']
+
+        basenames = self.get(RPMTAG_BASENAMES)
+        if basenames:
+            dirnames   = self.get(RPMTAG_DIRNAMES)
+            dirindexes = self.get(RPMTAG_DIRINDEXES)
+            paths      = [dirnames[dirindexes[x]] + basenames[x] for x in range(len(basenames))]
+        else:
+            paths      = self.get(RPMTAG_OLDFILENAMES, [])
+
+        count   = len(paths)
+        modes   = self.get(RPMTAG_FILEMODES, [0] * count)
+        users   = self.get(RPMTAG_FILEUSERNAME, ['root'] * count)
+        groups  = self.get(RPMTAG_FILEGROUPNAME, ['root'] * count)
+        sizes   = self.get(RPMTAG_LONGFILESIZES) or self.get(RPMTAG_FILESIZES, [0] * count)
+        digests = self.get(RPMTAG_FILEDIGESTS, [''] * count)
+        linktos = self.get(RPMTAG_FILELINKTOS, [''] * count)
+        flags   = self.get(RPMTAG_FILEFLAGS, [0] * count)
+
+        files = []
+        for x in range(count):
+            files.append(RPMFile(path=paths[x], mode=modes[x], user=users[x], group=groups[x], size=sizes[x],
+                                 digest=digests[x], linkto=linktos[x], flags=flags[x]))
+
+        self.cache['files'] = files
+        return files
+
+
+    def __dependencies(self, name_tag, flags_tag, version_tag):
+        """
+        Function to return a list of Dependency tuples
+        """
+        names    = self.get(name_tag, [])
+        flags    = self.get(flags_tag, [0] * len(names))
+        versions = self.get(version_tag, [''] * len(names))
+        return [Dependency(name=names[x], flags=flags[x], version=versions[x]) for x in range(len(names))]
+
+
+    @property
+    def requires(self):
+        return self.__dependencies(RPMTAG_REQUIRENAME, RPMTAG_REQUIREFLAGS, RPMTAG_REQUIREVERSION)
+
+    @property
+    def provides(self):
+        return self.__dependencies(RPMTAG_PROVIDENAME, RPMTAG_PROVIDEFLAGS, RPMTAG_PROVIDEVERSION)
+
+
+def format_dependency(dep):
+    """
+    Function to return a dependency as a string the same way that rpm -q --requires
+    and rpm -q --provides would display it
+    """
+    if not dep.version:
+        return dep.name
+
+    sense = ''
+    if dep.flags & RPMSENSE_LESS:
+        sense += '<'
+    if dep.flags & RPMSENSE_GREATER:
+        sense += '>'
+    if dep.flags & RPMSENSE_EQUAL:
+        sense += '='
+
+    return '%s %s %s' % (dep.name, sense, dep.version)
@@ -0,0 +1,120 @@
+"""
+This program extracts data from RPM and SRPM packages and stores it in
+a database for later querying.
+
+based on the srpm script of similar function copyright (c) 2005 Stew Benedict <sbenedict@mandriva.com>
+copyright (c) 2007-2017 Vincent Danen <vdanen@linsec.ca>
+
+This file is part of rq.
+
+rq is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rq is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rq.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import os
+import sqlite3
+from collections import namedtuple
+from . import header
+
+Metadata = namedtuple('Metadata', 'name version release epoch arch')
+
+# rows are committed this many at a time while a directory is being scanned
+COMMIT_SIZE = 500
+
+
+class HeaderCache:
+    """
+    Class to keep the header fields that planning an import or update needs in a
+    local sqlite database, keyed by the path, size and mtime of each package, so
+    that looking at a package that hasn't changed costs a stat() instead of reading
+    its header again.  A path of None (or a cache that can't be opened) means every
+    lookup reads the header.
+    """
+
+    def __init__(self, path):
+        self.path  = path
+        self.conn  = None
+        self.dirty = 0
+
+        if not path:
+            return
+
+        try:
+            self.conn = sqlite3.connect(path)
+            # package names are byte strings, keep them that way
+            self.conn.text_factory = str
+            self.conn.execute('CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                              'name TEXT, version TEXT, release TEXT, epoch INTEGER, arch TEXT)')
+        except sqlite3.Error, e:
+            logging.warning('Unable to use the header cache %s, headers will not be cached: %s', path, e)
+            self.conn = None
+
+
+    def get(self, rpm):
+        """
+        Function to return the Metadata of a package, from the cache if the package
+        is unchanged since it was stored or from its header otherwise
+        """
+        path = os.path.abspath(rpm)
+        st   = os.stat(path)
+
+        if self.conn:
+            try:
+                row = self.conn.execute('SELECT size, mtime, name, version, release, epoch, arch FROM headers WHERE path = ?',
+                                        (path,)).fetchone()
+            except sqlite3.Error, e:
+                self.disable(e)
+                row = None
+            if row and row[0] == st.st_size and row[1] == st.st_mtime:
+                return Metadata(*row[2:])
+
+        hdr  = header.Header(path)
+        meta = Metadata(hdr.name, hdr.version, hdr.release, hdr.epoch, hdr.arch)
+
+        if self.conn:
+            try:
+                self.conn.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                  (path, st.st_size, st.st_mtime) + meta)
+            except sqlite3.Error, e:
+                self.disable(e)
+            else:
+                self.dirty += 1
+                if self.dirty >= COMMIT_SIZE:
+                    self.commit()
+
+        return meta
+
+
+    def commit(self):
+        """
+        Function to write out whatever has been added to the cache
+        """
+        if self.conn and self.dirty:
+            try:
+                self.conn.commit()
+            except sqlite3.Error, e:
+                self.disable(e)
+            self.dirty = 0
+
+
+    def disable(self, e):
+        """
+        Function to stop using the cache after an error, such as another rqp or rqs
+        holding it locked; every lookup from here on reads the header
+        """
+        logging.warning('Unable to use the header cache %s, headers will not be cached: %s', self.path, e)
+        try:
+            self.conn.close()
+        except sqlite3.Error:
+            pass
+        self.conn = None
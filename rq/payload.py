@@ -0,0 +1,164 @@
+"""
+This program extracts data from RPM and SRPM packages and stores it in
+a database for later querying.
+
+based on the srpm script of similar function copyright (c) 2005 Stew Benedict <sbenedict@mandriva.com>
+copyright (c) 2007-2017 Vincent Danen <vdanen@linsec.ca>
+
+This file is part of rq.
+
+rq is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rq is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rq.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+from . import archive
+
+
+class PayloadError(Exception):
+    """
+    Raised when a payload can not be decompressed or is not a valid cpio archive
+    """
+    pass
+
+
+class Stream:
+    """
+    Class to present a compressed file, starting at a given offset, as a
+    read-only file object of the decompressed data; the data is decompressed by
+    whichever of the compressors registered in rq.archive its magic belongs to
+    """
+
+    def __init__(self, fname, offset, compressor):
+        self.fname  = fname
+        self.fobj   = open(fname, 'rb')
+        self.fobj.seek(offset)
+        self.reader = archive.open_stream(self.fobj)
+
+        if compressor != 'none' and not isinstance(self.reader, (archive.Decompressor, archive.Pipe)):
+            self.close()
+            raise PayloadError('%s uses an unsupported compressor: %s' % (fname, compressor))
+
+
+    def read(self, size):
+        """
+        Function to read up to size bytes of decompressed data
+        """
+        return self.reader.read(size)
+
+
+    def skip(self, size):
+        """
+        Function to throw away size bytes of decompressed data
+        """
+        while size > 0:
+            data = self.read(min(size, archive.CHUNK_SIZE))
+            if not data:
+                break
+            size -= len(data)
+
+
+    def close(self):
+        self.reader.close()
+        self.fobj.close()
+
+
+class CpioEntry:
+    """
+    Class to represent a single file in a cpio archive; data is only read (and
+    decompressed into memory) when asked for
+    """
+
+    def __init__(self, stream, name, mode, size):
+        self.stream    = stream
+        self.name      = name
+        self.mode      = mode
+        self.size      = size
+        self.remaining = size
+
+
+    def read(self, size=-1):
+        """
+        Function to read up to size bytes of this entry, or all of it
+        """
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data            = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def cpio_entries(stream, files=None):
+    """
+    Function to walk a cpio archive (newc, crc or rpm's stripped format) from a
+    stream, yielding a CpioEntry for each member.  Whatever the caller does not
+    read of an entry is skipped before moving on.  files is the list of RPMFile
+    tuples from the package header, which is only needed for stripped archives.
+    """
+    offset = 0
+    while True:
+        magic = stream.read(6)
+        if len(magic) != 6:
+            raise PayloadError('truncated cpio archive')
+
+        if magic == '07070X':
+            # rpm >= 4.12 stripped format, everything but the file index lives in the header
+            index   = int(stream.read(8), 16)
+            offset += 14
+            rfile   = files[index]
+            name    = rfile.path
+            mode    = rfile.mode
+            size    = rfile.size
+        elif magic in ('070701', '070702'):
+            fields  = stream.read(104)
+            if len(fields) != 104:
+                raise PayloadError('truncated cpio header')
+            mode    = int(fields[8:16], 16)
+            size    = int(fields[48:56], 16)
+            namelen = int(fields[88:96], 16)
+            name    = stream.read(namelen)[:-1]
+            offset += 110 + namelen
+        else:
+            raise PayloadError('unknown cpio header magic: %r' % magic)
+
+        pad     = (4 - offset % 4) % 4
+        stream.skip(pad)
+        offset += pad
+
+        if name == 'TRAILER!!!':
+            return
+        if name.startswith('./'):
+            name = name[1:]
+
+        entry = CpioEntry(stream, name, mode, size)
+        yield entry
+
+        stream.skip(entry.remaining)
+        offset += size
+        pad    = (4 - offset % 4) % 4
+        stream.skip(pad)
+        offset += pad
+
+
+def payload_entries(hdr):
+    """
+    Function to walk the cpio payload of a package, given its rq.header.Header,
+    without writing anything to disk
+    """
+    logging.debug('in payload_entries(%s)' % hdr.rpm)
+
+    stream = Stream(hdr.rpm, hdr.payload_offset, hdr.payload_compressor)
+    try:
+        for entry in cpio_entries(stream, hdr.files):
+            yield entry
+    finally:
+        stream.close()
@@ -0,0 +1,77 @@
+"""
+This program extracts data from RPM and SRPM packages and stores it in
+a database for later querying.
+
+based on the srpm script of similar function copyright (c) 2005 Stew Benedict <sbenedict@mandriva.com>
+copyright (c) 2007-2017 Vincent Danen <vdanen@linsec.ca>
+
+This file is part of rq.
+
+rq is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rq is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rq.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import multiprocessing
+
+# the analysis function used by the worker processes; this has to live at the
+# module level because bound methods cannot be pickled, so it is set right before
+# the pool is created and the forked workers inherit it
+_analyzer = None
+
+
+def _analyze(fname):
+    """
+    Run the analyzer on a single file, inside a worker process or not
+    """
+    try:
+        return (fname, _analyzer(fname))
+    except (Exception, SystemExit), e:
+        # never let a bad package take down the worker, the writer reports it
+        logging.error('Analyzing %s failed!\n%s', fname, e)
+        return (fname, None)
+
+
+def analyze(analyzer, file_list, jobs=1):
+    """
+    Function to run analyzer() against every file in file_list, yielding a
+    (file, result) tuple for each one in the same order as file_list.
+
+    With more than one job the analysis is fanned out to a pool of worker
+    processes; results are still returned in order so that whoever consumes
+    them (the single database writer) assigns package ids deterministically.
+    """
+    global _analyzer
+
+    # both paths go through _analyze() so that a bad package is skipped the same way
+    _analyzer = analyzer
+    if jobs <= 1 or len(file_list) < 2:
+        try:
+            for fname in file_list:
+                yield _analyze(fname)
+        finally:
+            _analyzer = None
+        return
+
+    logging.debug('starting %d worker processes' % jobs)
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(_analyze, file_list):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _analyzer = None
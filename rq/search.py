@@ -0,0 +1,207 @@
+"""
+This program extracts data from RPM and SRPM packages and stores it in
+a database for later querying.
+
+based on the srpm script of similar function copyright (c) 2005 Stew Benedict <sbenedict@mandriva.com>
+copyright (c) 2007-2017 Vincent Danen <vdanen@linsec.ca>
+
+This file is part of rq.
+
+rq is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rq is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rq.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import re
+import logging
+import sre_parse
+import sre_constants
+from peewee import fn
+
+TRIGRAM_SIZE = 3
+
+# [:class:], [.collating element.] and [=equivalence class=] inside a bracket expression;
+# this also catches the odd plain class like [.] which only costs the prefilter
+POSIX_BRACKET = re.compile(r'\[[:.=]')
+
+
+def trigrams(value):
+    """
+    Function to return the set of lowercased trigrams in a string; searches are
+    case-insensitive so the index is too
+    """
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    value = value.lower()
+    return set(value[x:x + TRIGRAM_SIZE] for x in range(len(value) - TRIGRAM_SIZE + 1))
+
+
+def trigram_rows(tid, records):
+    """
+    Function to turn a list of (id, value) tuples into trigram index rows for
+    bulk_insert(); indexes that aren't per-tag are built with a tid of None
+    """
+    rows = []
+    for (ref, value) in records:
+        for trigram in trigrams(value):
+            if tid is None:
+                rows.append({'ref': ref, 'trigram': trigram})
+            else:
+                rows.append({'tid': tid, 'ref': ref, 'trigram': trigram})
+    return rows
+
+
+def candidates(index, value, tid=None):
+    """
+    Function to return a subquery of the ids of every row whose indexed value
+    contains all of the trigrams of value; this intersects the posting lists, it
+    does not prove that value is a substring
+    """
+    grams = list(trigrams(value))
+    query = index.select(index.ref).where(index.trigram << grams)
+    if tid:
+        query = query.where(index.tid == tid)
+    return query.group_by(index.ref).having(fn.COUNT(fn.DISTINCT(index.trigram)) == len(grams))
+
+
+def trigram_filter(query, model, index, value, tid=None):
+    """
+    Function to narrow a substring query on model down to the candidates found
+    in the trigram index; the query keeps its own LIKE, which does the final
+    verification.  Values shorter than a trigram can't use the index.
+    """
+    if len(value) < TRIGRAM_SIZE:
+        return query
+
+    logging.debug('using trigram index %s for "%s"' % (index._meta.db_table, value))
+    return query.where(model.id << candidates(index, value, tid))
+
+
+def _literal_runs(items, runs):
+    """
+    Function to walk a parsed regular expression, appending every run of
+    literal characters that any match must contain to runs
+    """
+    for (op, av) in items:
+        if op == sre_constants.LITERAL and av < 128 and chr(av) != '\\':
+            runs[-1].append(chr(av))
+            continue
+
+        # anything else ends the current run
+        runs.append([])
+        if op == sre_constants.SUBPATTERN:
+            _literal_runs(av[-1], runs)
+            runs.append([])
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            # whatever is repeated at least once is required
+            _literal_runs(av[2], runs)
+            runs.append([])
+        # alternations, classes, wildcards and optional repeats require nothing
+
+
+def regexp_literals(pattern):
+    """
+    Function to find the literal strings a regular expression requires; returns
+    a (prefix, literals) tuple where prefix is the literal the pattern is anchored
+    to the start with (or '') and literals is a list of strings that every match
+    must contain.  Patterns that can't be parsed return ('', []), as do those with
+    POSIX bracket expressions such as [[:digit:]] or the [[:<:]] word boundary, which
+    MySQL understands and Python reads as a different class followed by literals.
+    """
+    if POSIX_BRACKET.search(pattern):
+        return ('', [])
+
+    try:
+        items = list(sre_parse.parse(pattern))
+    except (sre_constants.error, OverflowError, RuntimeError):
+        return ('', [])
+
+    prefix   = ''
+    anchored = False
+    if items and items[0][0] == sre_constants.AT and items[0][1] in (sre_constants.AT_BEGINNING,
+                                                                     sre_constants.AT_BEGINNING_STRING):
+        anchored = True
+        items    = items[1:]
+
+    runs = [[]]
+    _literal_runs(items, runs)
+    literals = [''.join(run) for run in runs if run]
+
+    if anchored and items and items[0][0] == sre_constants.LITERAL and runs[0]:
+        prefix = ''.join(runs[0])
+
+    return (prefix, literals)
+
+
+def regexp_filter(query, model, field, value, index=None, tid=None):
+    """
+    Function to narrow a regexp query with the literals the expression requires:
+    an anchored prefix becomes a LIKE 'prefix%' that an index on the column can
+    serve, the longest literal goes through the trigram index (if there is one)
+    and every literal is checked with LIKE before the database has to evaluate the
+    regular expression itself.  The query keeps its REGEXP for the final verdict.
+    """
+    (prefix, literals) = regexp_literals(value)
+    logging.debug('regexp literals for "%s": prefix="%s" literals=%s' % (value, prefix, literals))
+
+    if prefix:
+        query = query.where(field.startswith(prefix))
+
+    literals = [l for l in literals if len(l) > 1]
+    for literal in literals:
+        if literal != prefix:
+            query = query.where(field.contains(literal))
+
+    if index and literals:
+        longest = max(literals, key=len)
+        query   = trigram_filter(query, model, index, longest, tid)
+
+    return query
+
+
+def path_filter(query, model, dirnames, basenames, value, index=None):
+    """
+    Function to add a substring match on the paths of model, which are stored as a
+    directory and a basename.  value can be inside the directory, inside the basename
+    or span the two, in which case the directory ends with whatever comes before the
+    last slash of value and the basename starts with whatever follows it.  Both sides
+    are matched against their dictionary of distinct names, and the basename trigram
+    index (if there is one) narrows the basename matches.
+    """
+    dirs = dirnames.select(dirnames.id).where(dirnames.name.contains(value))
+    if '/' not in value:
+        bases = basenames.select(basenames.id).where(basenames.name.contains(value))
+        if index:
+            bases = trigram_filter(bases, basenames, index, value)
+        return query.where((model.did << dirs) | (model.bid << bases))
+
+    # a basename never has a slash, so anything ending in one has to be in the directory
+    (head, sep, tail) = value.rpartition('/')
+    if not tail:
+        return query.where(model.did << dirs)
+
+    spans = dirnames.select(dirnames.id).where(dirnames.name.endswith(head + sep))
+    bases = basenames.select(basenames.id).where(basenames.name.startswith(tail))
+    return query.where((model.did << dirs) | ((model.did << spans) & (model.bid << bases)))
+
+
+def regexp_path_filter(query, model, field, dirnames, basenames, value, index=None):
+    """
+    Function to narrow a regexp query on the paths of model the way regexp_filter()
+    does, with field being the expression for the full path; the longest literal
+    the expression requires goes through path_filter() so that it is matched against
+    the directory and basename dictionaries
+    """
+    query    = regexp_filter(query, model, field, value)
+    literals = [l for l in regexp_literals(value)[1] if len(l) > 1]
+    if literals:
+        query = path_filter(query, model, dirnames, basenames, max(literals, key=len), index)
+    return query
@@ -23,13 +23,23 @@ along with rq.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
 import re
-import commands
 import logging
 import tempfile
 import shutil
 import datetime
+import fnmatch
+import threading
+import subprocess
+import multiprocessing
 from glob import glob
-from app.models import SRPM_Ctag, SRPM_Tag, SRPM_BuildRequires, SRPM_Source, SRPM_Package, SRPM_File, SRPM_AlreadySeen
+from . import pool
+from . import header
+from . import evr
+from . import search
+from . import payload
+from . import archive
+from app.models import stream, srpm_db, SRPM_Ctag, SRPM_Tag, SRPM_BuildRequires, SRPM_Source, SRPM_Package, SRPM_File, SRPM_AlreadySeen, \
+    SRPM_FileTrigram, SRPM_CtagTrigram, SRPM_Dirname, SRPM_Basename, SRPM_TagStats, SRPM_Archive, split_path
 
 class Source:
     """
@@ -43,65 +53,214 @@ class Source:
         self.rcommon    = rcommon
 
         self.re_srpm    = re.compile(r'\.src\.rpm$')
-        self.re_patch   = re.compile(r'\.(diff|dif|patch)(\.bz2|\.gz)?$')
-        self.re_tar     = re.compile(r'\.((tar)(\.bz2|\.gz)?|t(gz|bz2?))$')
-        self.re_targz   = re.compile(r'\.(tgz|tar\.gz)$')
-        self.re_tarbz   = re.compile(r'\.(tbz2?|tar\.bz2)$')
-        self.re_patchgz = re.compile(r'\.(patch|diff|dif)(\.gz)$')
-        self.re_patchbz = re.compile(r'\.(patch|diff|dif)(\.bz2)$')
+        # archives are decompressed by what they contain rather than by their name, these only
+        # decide what is a source tarball (or zip file) and what is a patch
+        self.re_patch   = re.compile(r'\.(diff|dif|patch)(\.bz2|\.gz|\.xz|\.zst)?$')
+        self.re_tar     = re.compile(r'\.((tar)(\.bz2|\.gz|\.xz|\.lzma|\.zst)?|t(gz|bz2?|xz|zst)|zip)$')
 
         self.ctag_map   = {'function'  : 0,
                            'subroutine': 1,
                            'class'     : 2,
                            'method'    : 3}
 
+        # rows are written to the database batch_size at a time
+        self.batch_size = int(config.get('batch_size', 500))
+
+        # maintain (and search with) the trigram index of files and ctags
+        self.trigram_index = int(config.get('trigram_index', 0))
+
+        # the number of ctags processes to index a tarball with; by default the cores are
+        # shared out between the --jobs worker processes
+        self.ctags_jobs = int(config.get('ctags_jobs', 0))
+        if self.ctags_jobs < 1:
+            self.ctags_jobs = max(1, multiprocessing.cpu_count() // max(1, options.jobs))
+
+        # only the files ctags indexes are unpacked for it, which is every file that ctags maps
+        # to a language (as --list-maps shows them) and, as ctags can tell the language of a
+        # script from its #! line, every file without an extension.  ctags_languages picks
+        # the languages (all of them by default) and ctags_langmap changes or adds to their
+        # extensions, using the syntax of ctags --langmap (e.g. "C++:+.inl,Fortran:.f.f90").
+        # ctags is only asked when something is to be indexed, see load_ctags_maps()
+        self.ctags_languages = config.get('ctags_languages', '').strip()
+        self.ctags_options   = config.get('ctags_langmap', '').strip()
+        self.ctags_scripts   = not self.ctags_languages
+        self.ctags_langmap   = None
+        self.ctags_files     = None
+        self.ctags_names     = None
+
+        # where packages are unpacked; a tmpfs like /dev/shm saves the disk the writes
+        self.scratch_dir = os.path.expanduser(config.get('scratch_dir', '').strip()) or None
+
         # caches
-        self.breq_cache = {}
+        self.dirname_cache = {}
+
+        # digests of the tarballs that are already in the database, loaded when importing
+        self.archived = None
 
 
-    def patch_list(self, patchfile):
+    def patch_list(self, fobj):
         """
-        Function to get a list of files that a patch touches
+        Function to get a list of files that a patch, read from a file object, touches
         """
-        logging.debug('in patch_list(%s)' % patchfile)
+        logging.debug('in patch_list(%s)' % fobj)
+
+        return archive.patch_files(fobj)
 
-        grep = 'grep'
 
-        if self.re_patchgz.search(patchfile):
-            grep = 'zgrep'
+    def tar_list(self, fobj, extract_dir=None):
+        """
+        Function to get a list of files in a tarball or zip file, read from a file object;
+        with an extract_dir the files ctags indexes are unpacked there in the same pass
+        """
+        logging.debug('in tar_list(%s, %s)' % (fobj, extract_dir))
 
-        if self.re_patchbz.search(patchfile):
-            grep = 'bzgrep'
+        return archive.list_files(fobj, extract_dir, self.tar_excluded, self.ctags_indexed)
 
-        list = commands.getoutput(grep + " '^+++' " + self.rcommon.clean_shell(patchfile) + " 2>/dev/null | awk '{print $2}'")
 
-        return list
+    def load_ctags_maps(self):
+        """
+        Function to work out which files ctags indexes, from what ctags --list-maps shows or
+        the built-in maps when ctags can't tell us; done once, before the first package is
+        unpacked, so that queries never need ctags
+        """
+        if self.ctags_files is None:
+            self.ctags_langmap = self.ctags_maps() or self.default_maps()
+            self.ctags_files   = self.indexed_files(self.ctags_languages, self.ctags_options)
+            self.ctags_names   = [name[1:-1] for name in self.ctags_files if name.startswith('(')]
 
 
-    def tar_list(self, tarfile):
+    def ctags_maps(self):
         """
-        Function to get a list of files in a tarball
+        Function to ask ctags which extensions and file names each of its languages is
+        found by; returns a dict of language: [extensions and (file names)], which is
+        empty if ctags can't be run
         """
-        logging.debug('in tar_list(%s)' % tarfile)
+        logging.debug('in Source.ctags_maps()')
 
-        comp = 'tf'
-        if self.re_targz.search(tarfile):
-            comp = 'tzf'
-        if self.re_tarbz.search(tarfile):
-            comp = 'tjf'
+        try:
+            with open(os.devnull, 'w') as devnull:
+                proc   = subprocess.Popen(['ctags', '--list-maps'], stdout=subprocess.PIPE, stderr=devnull)
+                output = proc.communicate()[0]
+        except OSError, e:
+            logging.warning('Unable to run ctags --list-maps: %s', e)
+            return {}
+        if proc.returncode != 0:
+            logging.warning('ctags --list-maps failed (rc=%s)', proc.returncode)
+            return {}
+
+        # exuberant ctags lists ".c .h", universal ctags "*.c *.h"; anything that isn't
+        # a plain extension (Makefile, [Mm]akefile, *.tar.xz) is matched as a file name
+        maps = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            names = []
+            for pattern in fields[1:]:
+                ext = pattern.lstrip('*')
+                if ext.startswith('.') and not re.search(r'[.*?\[]', ext[1:]):
+                    names.append(ext)
+                else:
+                    names.append('(%s)' % pattern)
+            maps[fields[0]] = names
+        return maps
 
-        excludes = ''
-        for f in self.rcommon.get_file_excludes():
-            f = self.fix_excludes(f)
 
-            excludes = '%s --exclude=%s' % (excludes, f)
+    def default_maps(self):
+        """
+        Function to return the language maps of exuberant ctags 5.8, for when ctags can't
+        be asked for its own
+        """
+        return {'Ant'       : ['(build.xml)'],
+                'Asm'       : ['.asm', '.ASM', '.s', '.S', '.A51', '.29k', '.29K'],
+                'Asp'       : ['.asp', '.asa'],
+                'Awk'       : ['.awk', '.gawk', '.mawk'],
+                'Basic'     : ['.bas', '.bi', '.bb', '.pb'],
+                'BETA'      : ['.bet'],
+                'C'         : ['.c'],
+                'C++'       : ['.c++', '.cc', '.cp', '.cpp', '.cxx', '.h', '.h++', '.hh', '.hp', '.hpp', '.hxx',
+                               '.C', '.H', '.tcc'],
+                'C#'        : ['.cs'],
+                'Cobol'     : ['.cbl', '.cob', '.CBL', '.COB'],
+                'DosBatch'  : ['.bat', '.cmd'],
+                'Eiffel'    : ['.e'],
+                'Erlang'    : ['.erl', '.ERL', '.hrl', '.HRL'],
+                'Flex'      : ['.as', '.mxml'],
+                'Fortran'   : ['.f', '.for', '.ftn', '.f77', '.f90', '.f95', '.F', '.FOR', '.FTN', '.F77', '.F90',
+                               '.F95'],
+                'HTML'      : ['.htm', '.html'],
+                'Java'      : ['.java'],
+                'JavaScript': ['.js'],
+                'Lisp'      : ['.cl', '.clisp', '.el', '.l', '.lisp', '.lsp'],
+                'Lua'       : ['.lua'],
+                'Make'      : ['([Mm]akefile)', '(GNUmakefile)', '.mak', '.mk'],
+                'MatLab'    : ['.m'],
+                'OCaml'     : ['.ml', '.mli'],
+                'Pascal'    : ['.p', '.pas'],
+                'Perl'      : ['.pl', '.pm', '.plx', '.perl'],
+                'PHP'       : ['.php', '.php3', '.phtml'],
+                'Python'    : ['.py', '.pyx', '.pxd', '.pxi', '.scons'],
+                'REXX'      : ['.cmd', '.rexx', '.rx'],
+                'Ruby'      : ['.rb', '.ruby'],
+                'Scheme'    : ['.SCM', '.SM', '.sch', '.scheme', '.scm', '.sm'],
+                'Sh'        : ['.sh', '.SH', '.bsh', '.bash', '.ksh', '.zsh'],
+                'SLang'     : ['.sl'],
+                'SML'       : ['.sml', '.sig'],
+                'SQL'       : ['.sql'],
+                'Tcl'       : ['.tcl', '.tk', '.wish', '.itcl'],
+                'Tex'       : ['.tex'],
+                'Vera'      : ['.vr', '.vri', '.vrh'],
+                'Verilog'   : ['.v'],
+                'VHDL'      : ['.vhdl', '.vhd'],
+                'Vim'       : ['.vim'],
+                'YACC'      : ['.y']}
+
+
+    def indexed_files(self, languages, langmap):
+        """
+        Function to work out which files are unpacked for ctags from the ctags_languages
+        and ctags_langmap options; returns a set of extensions (with their dot) and file
+        names (in parentheses, as --langmap writes them)
+        """
+        logging.debug('in Source.indexed_files(%s, %s)' % (languages, langmap))
 
-        command = 'tar -%s "%s" %s 2>/dev/null' % (comp, tarfile.replace(' ', '\ '), excludes)
+        extensions = dict((lang.lower(), list(exts)) for (lang, exts) in self.ctags_langmap.items())
+        for entry in langmap.split(','):
+            if ':' not in entry:
+                continue
+            (lang, exts) = entry.strip().split(':', 1)
+            lang         = lang.lower()
+            if not exts.startswith('+'):
+                extensions[lang] = []
+            # ".c.h(Makefile)" is made of extensions and, in parentheses, file names
+            for name in re.findall(r'\([^)]*\)|\.[^.(]+', exts.lstrip('+')):
+                extensions.setdefault(lang, []).append(name)
+
+        if languages:
+            wanted = [lang.strip().lower() for lang in languages.split(',') if lang.strip()]
+        else:
+            wanted = extensions.keys()
 
-        (rc, list) = commands.getstatusoutput(command)
-        logging.debug('called tar (rc=%s): %s\n%s' % (rc, command, list))
+        indexed = set()
+        for lang in wanted:
+            if lang not in extensions:
+                logging.warning('ctags_languages names %s, which has no extensions in ctags_langmap', lang)
+            indexed.update(extensions.get(lang, []))
+        return indexed
 
-        return list
+
+    def ctags_indexed(self, fname):
+        """
+        Function to check whether ctags would index a file, by its name or its extension
+        """
+        base = fname.split('/')[-1]
+        ext  = os.path.splitext(base)[1]
+        if ext in self.ctags_files or (self.ctags_scripts and not ext):
+            return True
+        for name in self.ctags_names:
+            if fnmatch.fnmatchcase(base, name):
+                return True
+        return False
 
 
     def fix_excludes(self, fname):
@@ -114,50 +273,78 @@ class Source:
         return fname
 
 
-    def get_all_files(self, srpm):
+    def tar_excluded(self, fname):
         """
-        Function to get the source and patch files from a SRPM
+        Function to check a tarball member against the file excludes the way tar --exclude
+        does; any directory or file named by an exclude is left out, along with everything
+        below it
         """
-        logging.debug('in Source.get_all_files(%s)' % srpm)
-        self.get_tar_files(srpm)
-        self.get_patch_files(srpm)
+        parts = fname.split('/')
+        for f in self.rcommon.get_file_excludes():
+            if self.fix_excludes(f) in parts:
+                return True
+        return False
 
 
-    def get_tar_files(self, srpm):
+    def read_sources(self, hdr, sources, work_dir=None, patches=True, tarballs=True, skip=(), indexed=None):
         """
-        Function to get the tar files from a SRPM
-
-        cpio --quiet is a GNU-ism and isn't portable
+        Function to walk the payload of a SRPM once, without cpio or tar, listing the files
+        of the tarballs and patches that are in sources (apart from the tarballs in skip).  With a work_dir the spec file is
+        written there and the files ctags indexes are unpacked below it while each tarball
+        is being listed, run through ctags and removed again, so every tarball is only decompressed once;
+        the tarballs ctags ran over without an error are added to indexed.
+        Returns a tuple of two lists, of (source, files) and (source, ctags) tuples
         """
-        logging.debug('in Source.get_tar_files(%s)' % srpm)
+        logging.debug('in Source.read_sources(%s, %s)' % (hdr.rpm, work_dir))
+
+        # file_list may contain paths, so strip them; may be due to rpm5
+        wanted  = set(sources[x]['file'].split('/')[-1] for x in sources.keys())
+        records = []
+        ctags   = []
+        if work_dir and tarballs:
+            self.load_ctags_maps()
+        try:
+            for entry in payload.payload_entries(hdr):
+                sfile = entry.name.split('/')[-1]
+                if work_dir and sfile.endswith('.spec'):
+                    # we need the spec file later for the build requirements
+                    with open(os.path.join(work_dir, sfile), 'wb') as spec:
+                        shutil.copyfileobj(entry, spec)
+                    continue
 
-        # include the .spec file here; we need it later
-        exts = ['*.tar.?z*', '*.tgz', '*.tbz', '*.zip', '*.spec']
-        for search in exts:
-            command      = 'rpm2cpio "%s" | cpio -i "%s" 2>/dev/null' % (srpm, search)
-            (rc, output) = commands.getstatusoutput(command)
-            logging.debug('called cpio (rc=%s): %s' % (rc, command))
+                if sfile not in wanted:
+                    continue
+                logging.debug('processing file: %s' % sfile)
 
-    #    if not rc == 0:
-    #        logging.critical('Failed to execute rpm2cpio!  Command was: %s\nOutput was:\n(rc: %s) %s\n' % (command, rc, output))
-    #        sys.exit(1)
+                if patches and self.re_patch.search(sfile):
+                    records.append((sfile, self.filter_files(self.patch_list(entry))))
 
+                elif tarballs and self.re_tar.search(sfile):
+                    if sfile in skip:
+                        logging.debug('already in the database: %s' % sfile)
+                        continue
+                    if not work_dir:
+                        records.append((sfile, self.filter_files(self.tar_list(entry))))
+                        continue
 
-    def get_patch_files(self, srpm):
-        """
-        Function to get the patch files from a SRPM
-        """
-        logging.debug('in Source.get_patch_files(%s)' % srpm)
+                    tar_dir = os.path.join(work_dir, 'tarball-%d' % len(ctags))
+                    os.mkdir(tar_dir)
+                    try:
+                        records.append((sfile, self.filter_files(self.tar_list(entry, tar_dir))))
+                        (tags, complete) = self.get_ctag_records(tar_dir)
+                        ctags.append((sfile, tags))
+                        if complete and indexed is not None:
+                            indexed.add(sfile)
+                    finally:
+                        logging.debug('Removing temporary directory: %s...' % tar_dir)
+                        shutil.rmtree(tar_dir)
 
-        exts = ['*patch*', '*diff*']
-        for search in exts:
-            command      = 'rpm2cpio "%s" | cpio -i "%s" 2>/dev/null' % (srpm, search)
-            (rc, output) = commands.getstatusoutput(command)
-            logging.debug('called cpio (rc=%s): %s' % (rc, output))
+                else:
+                    logging.debug('unwilling to process: %s' % sfile)
+        except payload.PayloadError, e:
+            logging.error('Unable to read the payload of %s: %s', hdr.rpm, e)
 
-    #    if not rc == 0:
-    #        logging.critical('Failed to execute rpm2cpio!  Command was: %s\nOutput was:\n(rc: %s) %s\n' % (command, rc, output))
-    #        sys.exit(1)
+        return (records, ctags)
 
 
     def query(self, qtype):
@@ -205,11 +392,14 @@ class Source:
                     result = SRPM_Ctag.select().where((SRPM_Ctag.name.regexp(like_q)) & (SRPM_Ctag.tid == tid)).order_by(SRPM_Ctag.file.asc())
                 else:
                     result = SRPM_Ctag.select().where(SRPM_Ctag.name.regexp(like_q)).order_by(SRPM_Ctag.file.asc())
+                result = search.regexp_filter(result, SRPM_Ctag, SRPM_Ctag.name, like_q, self.trigram_index and SRPM_CtagTrigram, tid)
             else:
                 if self.options.tag:
                     result = SRPM_Ctag.select().where((SRPM_Ctag.name.contains(like_q)) & (SRPM_Ctag.tid == tid)).order_by(SRPM_Ctag.file.asc())
                 else:
                     result = SRPM_Ctag.select().where(SRPM_Ctag.name.contains(like_q)).order_by(SRPM_Ctag.file.asc())
+                if self.trigram_index:
+                    result = search.trigram_filter(result, SRPM_Ctag, SRPM_CtagTrigram, like_q, tid)
 
         elif qtype == 'buildreqs':
             if self.options.regexp:
@@ -217,6 +407,7 @@ class Source:
                     result = SRPM_BuildRequires.select().where((SRPM_BuildRequires.name.regexp(like_q)) & (SRPM_BuildRequires.tid == tid)).order_by(SRPM_BuildRequires.name.asc())
                 else:
                     result = SRPM_BuildRequires.select().where(SRPM_BuildRequires.name.regexp(like_q)).order_by(SRPM_BuildRequires.name.asc())
+                result = search.regexp_filter(result, SRPM_BuildRequires, SRPM_BuildRequires.name, like_q, None, tid)
             else:
                 if self.options.tag:
                     result = SRPM_BuildRequires.select().where((SRPM_BuildRequires.name.contains(like_q)) & (SRPM_BuildRequires.tid == tid)).order_by(SRPM_BuildRequires.name.asc())
@@ -224,16 +415,17 @@ class Source:
                     result = SRPM_BuildRequires.select().where(SRPM_BuildRequires.name.contains(like_q)).order_by(SRPM_BuildRequires.name.asc())
 
         elif qtype == 'files':
+            # paths are matched against the directory and basename dictionaries first
+            path   = SRPM_File.path()
+            result = SRPM_File.join_path(SRPM_File.select()).order_by(path.asc(), SRPM_File.id.asc())
+            if self.options.tag:
+                result = result.where(SRPM_File.tid == tid)
             if self.options.regexp:
-                if self.options.tag:
-                    result = SRPM_File.select().where((SRPM_File.file.regexp(like_q)) & (SRPM_File.tid == tid)).order_by(SRPM_File.file.asc())
-                else:
-                    result = SRPM_File.select().where(SRPM_File.file.regexp(like_q)).order_by(SRPM_File.file.asc())
+                result = search.regexp_path_filter(result.where(path.regexp(like_q)), SRPM_File, path, SRPM_Dirname,
+                                                   SRPM_Basename, like_q, self.trigram_index and SRPM_FileTrigram)
             else:
-                if self.options.tag:
-                    result = SRPM_File.select().where((SRPM_File.file.contains(like_q)) & (SRPM_File.tid == tid)).order_by(SRPM_File.file.asc())
-                else:
-                    result = SRPM_File.select().where(SRPM_File.file.contains(like_q)).order_by(SRPM_File.file.asc())
+                result = search.path_filter(result, SRPM_File, SRPM_Dirname, SRPM_Basename, like_q,
+                                            self.trigram_index and SRPM_FileTrigram)
 
 
         #TODO: need to make joins work somehow and reduce the above; need to be able to look for sources only
@@ -259,28 +451,34 @@ class Source:
         #
         # we could do this with different command-line options to search either files or patches, but then we have
         # a lot of silly options, so we can make the program smart enough to figure this out eventually
-        if result:
+
+        # fetch everything that gets displayed in the same query
+        if result is not None:
+            result = self.display_query(qtype, result)
+
+        if result is not None and result.exists():
             if self.options.count:
+                # let the database count the rows rather than fetching them all
+                matches = result.count()
                 if self.options.quiet:
-                    print len(result)
+                    print matches
                 else:
                     if self.options.tag:
-                        print '%d match(es) in database for tag (%s) and %s ("%s")' % (len(result), self.options.tag, match_type, like_q)
+                        print '%d match(es) in database for tag (%s) and %s ("%s")' % (matches, self.options.tag, match_type, like_q)
                     else:
-                        print '%d match(es) in database for %s ("%s")' % (len(result), match_type, like_q)
+                        print '%d match(es) in database for %s ("%s")' % (matches, match_type, like_q)
                 return
 
             ltag = ''
             last = ''
-            for row in result:
+            for row in stream(result):
                 utype = ''
                 # for readability
-                package = SRPM_Package.get(SRPM_Package.id == row.pid)
-                r_tag   = SRPM_Tag.get_tag(row.tid)
-                r_rpm   = package.package
-                r_ver   = package.version
-                r_rel   = package.release
-                r_date  = package.date
+                r_tag   = row['tag']
+                r_rpm   = row['package']
+                r_ver   = row['version']
+                r_rel   = row['release']
+                r_date  = row['date']
 
                 # defaults, so nothing is undeclared
                 r_ctype  = ''
@@ -290,19 +488,18 @@ class Source:
 
                 if qtype == 'buildreqs':
                     r_type = 'S'
-                    r_breq = row.name
+                    r_breq = row['name']
                 else:
-                    source  = SRPM_Source.get(SRPM_Source.id == row.sid)
-                    r_type  = source.stype
-                    r_file  = row.file
-                    r_sfile = source.file
+                    r_type  = row['stype']
+                    r_file  = row['file']
+                    r_sfile = row['source_file']
 
                 if qtype == 'ctags':
-                    r_ctype  = [k for k, v in self.ctag_map.iteritems() if v == row.ctype][0]
-                    r_cline  = row.line
-                    r_cextra = row.extra
+                    r_ctype  = [k for k, v in self.ctag_map.iteritems() if v == row['ctype']][0]
+                    r_cline  = row['line']
+                    r_cextra = row['extra']
 
-                if row.update == 1:
+                if row['update'] == 1:
                     utype = '[update] '
 
                 if not ltag == r_tag:
@@ -310,7 +507,7 @@ class Source:
                     ltag = r_tag
 
                 if self.options.debug:
-                    print vars(row)
+                    print row
                 else:
                     srpm  = '%s-%s-%s' % (r_rpm, r_ver, r_rel)
                     stype = 'source'
@@ -346,6 +543,36 @@ class Source:
                 print 'No matches in database for %s ("%s")' % (match_type, like_q)
 
 
+    def display_query(self, qtype, query):
+        """
+        Function to join the package, tag and, for files and ctags, the source file
+        of each row onto a query, so that the results can be displayed without any
+        further lookups; returns the rows as dicts
+        """
+        logging.debug('in Source.display_query(%s)' % qtype)
+
+        model   = query.model_class
+        columns = [SRPM_Package.package, SRPM_Package.version, SRPM_Package.release, SRPM_Package.date,
+                   SRPM_Package.update, SRPM_Tag.tag]
+
+        query = query.join(SRPM_Package, on=(model.pid == SRPM_Package.id)).switch(model).join(
+                    SRPM_Tag, on=(model.tid == SRPM_Tag.id)).switch(model)
+
+        if qtype == 'buildreqs':
+            columns.append(model.name)
+        else:
+            if qtype == 'files':
+                columns.append(SRPM_File.path().alias('file'))
+            else:
+                columns.append(model.file)
+            columns.extend([SRPM_Source.stype, SRPM_Source.file.alias('source_file')])
+            query = query.join(SRPM_Source, on=(model.sid == SRPM_Source.id))
+            if qtype == 'ctags':
+                columns.extend([model.ctype, model.line, model.extra])
+
+        return query.select(*columns).dicts()
+
+
     def examine(self, srpm):
         """
         Examine a src.rpm and output the details
@@ -359,36 +586,22 @@ class Source:
         print 'Examining %s...\n' % srpm
 
         # stage 1, list the rpm content
-        src_list = self.rcommon.rpm_list(srpm, raw=True)
+        hdr      = header.Header(srpm)
+        src_list = self.rcommon.rpm_list(hdr, raw=True)
         print 'SRPM Contents:\n%s\n' % src_list
 
-        file_list = self.rcommon.rpm_list(srpm)
-
-        cpio_dir = tempfile.mkdtemp()
-        try:
-            current_dir = os.getcwd()
-            os.chdir(cpio_dir)
-
-            # stage 2, list patched files
-            if self.options.patch:
-                self.get_patch_files(srpm)
-                for x in file_list.keys():
-                    if self.re_patch.search(file_list[x]['file']):
-                        plist = self.patch_list(file_list[x]['file'])
-                        print 'Patch file %s modifies:\n%s\n' % (file_list[x]['file'], plist)
-
-            # stage 3, list the tarball contents
-            if not self.options.skiptar:
-                self.get_tar_files(srpm)
-                for y in file_list.keys():
-                    if self.re_tar.search(file_list[y]['file']):
-                        tlist = self.tar_list(file_list[y]['file'])
-                        print 'Tarfile %s contents:\n%s\n' % (file_list[y]['file'], tlist)
+        file_list = self.rcommon.rpm_list(hdr)
+        if not file_list:
+            return
 
-            os.chdir(current_dir)
-        finally:
-            logging.debug('Removing temporary directory: %s...' % cpio_dir)
-            shutil.rmtree(cpio_dir)
+        # stage 2 and 3, list patched files and the tarball contents
+        (records, ctags) = self.read_sources(hdr, file_list, patches=self.options.patch, tarballs=not self.options.skiptar)
+        for (sfile, files) in records:
+            if self.re_patch.search(sfile):
+                print 'Patch file %s modifies:\n%s\n' % (sfile, '\n'.join(files))
+        for (sfile, files) in records:
+            if self.re_tar.search(sfile):
+                print 'Tarfile %s contents:\n%s\n' % (sfile, '\n'.join(files))
 
 
     def showinfo(self):
@@ -412,28 +625,39 @@ class Source:
         else:
             result = SRPM_Package.select().where(SRPM_Package.package == srpm).order_by(SRPM_Package.tid.asc())
 
+        result = list(result.select(SRPM_Package, SRPM_Tag.tag.alias('tag_name'), SRPM_Tag.path).join(
+                        SRPM_Tag, on=(SRPM_Package.tid == SRPM_Tag.id)).naive())
+
         if not result:
             print 'No matches found for package %s' % srpm
             sys.exit(0)
 
+        # fetch the sources and buildrequires of every matching package up front
+        pids    = [row.id for row in result]
+        sources = {}
+        breqs   = {}
+        for (pid, xfile) in SRPM_Source.select(SRPM_Source.pid, SRPM_Source.file).where(
+                SRPM_Source.pid << pids).order_by(SRPM_Source.stype.desc()).tuples():
+            sources.setdefault(pid, []).append(xfile)
+        for (pid, xname) in SRPM_BuildRequires.select(SRPM_BuildRequires.pid, SRPM_BuildRequires.name).where(
+                SRPM_BuildRequires.pid << pids).order_by(SRPM_BuildRequires.name.asc()).tuples():
+            breqs.setdefault(pid, []).append(xname)
+
         for row in result:
-            tag = SRPM_Tag.get(SRPM_Tag.id == row.tid)
             print 'Results for package %s-%s-%s' % (row.package, row.version, row.release)
-            print '  Tag: %-20s Source path: %s' % (tag.tag, tag.path)
+            print '  Tag: %-20s Source path: %s' % (row.tag_name, row.path)
 
-            results = SRPM_Source.select().where(SRPM_Source.pid == row.id).order_by(SRPM_Source.stype.desc())
-            if results:
+            if row.id in sources:
                 print ''
                 print '  Source RPM contains the following source files:'
-                for xrow in results:
-                    print '  %s' % xrow.file
+                for xfile in sources[row.id]:
+                    print '  %s' % xfile
 
-            results = SRPM_BuildRequires.select().where(SRPM_BuildRequires.pid == row.id).order_by(SRPM_BuildRequires.name.asc())
-            if results:
+            if row.id in breqs:
                 print ''
                 print '  Source RPM has the following BuildRequires:'
-                for xrow in results:
-                    print '  %s' % xrow.name
+                for xname in breqs[row.id]:
+                    print '  %s' % xname
             print ''
 
 
@@ -443,6 +667,7 @@ class Source:
         """
         logging.debug('in Source.add_records(%s, %s, %s)' % (tid, pid, file_list))
 
+        rows = []
         for x in file_list.keys():
             # remove any possible paths from source files; may be due to rpm5
             sfile = file_list[x]['file'].split('/')[-1]
@@ -461,177 +686,202 @@ class Source:
 
             if self.options.verbose:
                 print 'Source: %s, Type: %s' % (sfile, stype)
-            try:
-                s = SRPM_Source.create(
-                    tid   = tid,
-                    pid   = pid,
-                    stype = stype,
-                    file  = sfile.strip()
-                )
-                logging.debug('Filed Source with id %d', s.id)
-            except Exception, e:
-                logging.error('Adding source file %s failed!\n%s', file, e)
+            rows.append({'tid': tid, 'pid': pid, 'stype': stype, 'file': sfile.strip()})
+
+        count = SRPM_Source.bulk_insert(rows, self.batch_size)
+        logging.debug('Filed %d sources for pid %d', count, pid)
+        return count
 
 
-    def add_file_records(self, tid, pid, file_list):
+    def filter_files(self, flist):
         """
-        Function to add all source file records
+        Function to drop the directories and the files in our exclude list from the list of
+        files in a tarball or patch
         """
-        logging.debug('in Source.add_file_records(%s, %s, %s)' % (tid, pid, file_list))
-
-        for x in file_list.keys():
-            good_src = False
-            # file_list may contain paths, so strip them; may be due to rpm5
-            sfile    = file_list[x]['file'].split('/')[-1]
-            logging.debug('processing file: %s' % sfile)
-
-            if self.re_patch.search(sfile):
-                flist    = self.patch_list(sfile)
-                good_src = True
-
-            if self.re_tar.search(sfile):
-                flist    = self.tar_list(sfile)
-                good_src = True
-
-
-            # only proceed for tarballs and patches
-            if good_src:
-                logging.debug('found good file to process: %s' % sfile)
-                files = flist.split()
-
-                # get the s_record for this source from the db
-                sid = SRPM_Source.find_id(pid, sfile)
-                if not sid:
-                    logging.critical('adding files from %s failed...' % sfile)
-                    sys.exit(1)
-
-                for dfile in files:
-                    break_loop = False
-                    if dfile.endswith('/'):     # skip directories
-                        pass
-                    else:
-                        for exclude in self.rcommon.get_file_excludes():
-                            # make sure we don't include any files in our exclude list
-                            if re.search(exclude, dfile):
-                                logging.debug('found unwanted entry: %s' % dfile)
-                                break_loop = True
-                        if break_loop:
-                            pass
-                        else:
-                            self.rcommon.show_progress()
-                            if self.options.verbose:
-                                print 'File: %s' % dfile
-                            try:
-                                f = SRPM_File.create(
-                                    tid  = tid,
-                                    pid  = pid,
-                                    sid  = sid,
-                                    file = dfile
-                                )
-                                logging.debug('Filed File with id %d', f.id)
-                            except Exception, e:
-                                logging.error('Adding file %s failed!\n%s', dfile, e)
-
+        files = []
+        for dfile in flist:
+            break_loop = False
+            if dfile.endswith('/'):     # skip directories
+                pass
             else:
-                logging.debug('unwilling to process: %s' % sfile)
+                for exclude in self.rcommon.get_file_excludes():
+                    # make sure we don't include any files in our exclude list
+                    if re.search(exclude, dfile):
+                        logging.debug('found unwanted entry: %s' % dfile)
+                        break_loop = True
+                if break_loop:
+                    pass
+                else:
+                    files.append(dfile)
+
+        return files
 
 
-    def add_ctag_records(self, tid, pid, cpio_dir):
+    def add_file_records(self, tid, pid, records):
+        """
+        Function to add all source file records
+        """
+        logging.debug('in Source.add_file_records(%s, %s, %s)' % (tid, pid, records))
+
+        # get the s_records for this package's sources from the db
+        sids = SRPM_Source.get_ids(pid)
+
+        # intern the directories and basenames of every file up front
+        paths = dict((dfile, split_path(dfile)) for (sfile, files) in records for dfile in files)
+        SRPM_Dirname.intern(set(dirname for (dirname, basename) in paths.values()), self.dirname_cache, self.batch_size)
+        bids  = {}
+        added = SRPM_Basename.intern(set(basename for (dirname, basename) in paths.values()), bids, self.batch_size)
+        if added and self.trigram_index:
+            rows = search.trigram_rows(None, [(bid, name) for (name, bid) in added.items()])
+            SRPM_FileTrigram.bulk_insert(rows, self.batch_size)
+
+        rows = []
+        for (sfile, files) in records:
+            sid = sids.get(sfile)
+            if not sid:
+                logging.critical('adding files from %s failed...' % sfile)
+                sys.exit(1)
+
+            for dfile in files:
+                self.rcommon.show_progress()
+                if self.options.verbose:
+                    print 'File: %s' % dfile
+                (dirname, basename) = paths[dfile]
+                rows.append({'tid': tid, 'pid': pid, 'sid': sid, 'did': self.dirname_cache[dirname], 'bid': bids[basename]})
+
+        count = SRPM_File.bulk_insert(rows, self.batch_size)
+        logging.debug('Filed %d files for pid %d', count, pid)
+        return count
+
+
+    def get_ctag_records(self, tar_dir):
         """
-        Function to run ctags against an unpacked source directory
-        and insert records into the database
+        Function to run ctags against an unpacked tarball; returns a tuple of the list of
+        ctags and whether every ctags process ran successfully.  The files are split into
+        ctags_jobs shards of about the same size which are indexed at the same time, and
+        the output of each is parsed as it comes in
         """
-        logging.debug('in Source.add_ctag_records(%s, %s, %s)' % (tid, pid, cpio_dir))
+        logging.debug('in Source.get_ctag_records(%s)' % tar_dir)
+
+        # paths are relative to the top of the tarball, so we don't have to strip them
+        # out of the ctags output
+        files = []
+        for (dirpath, dirnames, filenames) in os.walk(tar_dir):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                if '\n' in path or not os.path.isfile(path):
+                    continue
+                files.append((os.path.getsize(path), os.path.join('.', os.path.relpath(path, tar_dir))))
 
-        # this is likely a double chdir, but let's make sure we're in the right place
-        # so we don't have to strip out the path from the ctags output
-        os.chdir(cpio_dir)
+        # the largest files first, each to the shard with the least to do so far
+        shards = [[] for x in range(min(self.ctags_jobs, len(files)))]
+        sizes  = [0] * len(shards)
+        for (size, path) in sorted(files, reverse=True):
+            x = sizes.index(min(sizes))
+            shards[x].append(path)
+            sizes[x] += size
 
-        # first, identify and expand any tarballs found:
-        for fname in os.listdir(cpio_dir):
-            if self.re_tar.search(fname):
-                # get the s_record for this source from the db
-                sid = SRPM_Source.find_id(pid, fname)
-                if not sid:
-                    logging.critical('!!!!! adding files from %s failed...' % fname)
-                    # don't bail, it's logged, continue
-                    #sys.exit(1)
-                    continue
+        results = [[] for shard in shards]
+        status  = [False] * len(shards)
 
-                comp = 'xf'
-                if self.re_targz.search(fname):
-                    comp = 'xzf'
-                if self.re_tarbz.search(fname):
-                    comp = 'xjf'
+        def run_shard(x):
+            status[x] = self.run_ctags(tar_dir, shards[x], results[x])
 
-                excludes = ''
-                for f in self.rcommon.get_file_excludes():
-                    f = self.fix_excludes(f)
+        threads = [threading.Thread(target=run_shard, args=(x,)) for x in range(len(shards))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-                    excludes = '%s --exclude=%s' % (excludes, f)
+        # in the order ctags -x lists them
+        ctags = [tag for result in results for tag in result]
+        ctags.sort(key=lambda tag: (tag[0], tag[3]))
+        return (ctags, all(status))
 
-                tmpdir  = tempfile.mkdtemp()
-                command = 'tar -%s "%s" -C %s %s 2>/dev/null' % (comp, fname.replace(' ', '\ '), tmpdir, excludes)
 
-                (rc, olist) = commands.getstatusoutput(command)
-                logging.debug('called tar (rc=%s): %s\n%s' % (rc, command, olist))
+    def run_ctags(self, tar_dir, files, ctags):
+        """
+        Function to run one ctags process over a list of files, appending the ctags we
+        keep to ctags a line at a time as they are read from its output; returns True if
+        ctags ran and exited successfully
+        """
+        logging.debug('in Source.run_ctags(%s, %d files)' % (tar_dir, len(files)))
 
-                os.chdir(tmpdir)
+        with tempfile.NamedTemporaryFile() as file_list:
+            file_list.write(''.join('%s\n' % path for path in files))
+            file_list.flush()
 
-                # some packages contain files that are r--r--r-- which prevents
-                # us from cleanly removing the directory, so do a recursive
-                # chmod first
-                command = "chmod -R u+rwx ."
-                (rc, output) = commands.getstatusoutput(command)
-                logging.debug('called chmod (rc=%s): %s' % (rc, command))
+            command = ['ctags', '-x', '-f', '-', '-L', file_list.name]
+            if self.ctags_options:
+                # so that ctags knows the extensions we unpacked files for
+                command.insert(1, '--langmap=%s' % self.ctags_options)
+            try:
+                with open(os.devnull, 'w') as devnull:
+                    proc = subprocess.Popen(command, cwd=tar_dir, stdout=subprocess.PIPE, stderr=devnull)
+                    for tag in iter(proc.stdout.readline, ''):
+                        try:
+                            (name, ctype, line, path, extra) = tag.rstrip('\n').split(None, 4)
+                        except:
+                            continue
+
+                        # only store some ctags info, not all of it
+                        if ctype in self.ctag_map:
+                            ctags.append((name, self.ctag_map[ctype], line, path, extra))
+                    rc = proc.wait()
+            except OSError, e:
+                logging.error('Unable to run ctags: %s', e)
+                return False
+        logging.debug('called ctags (rc=%s): %s' % (rc, ' '.join(command)))
+        if rc != 0:
+            logging.error('ctags exited with %d in %s', rc, tar_dir)
+            return False
+        return True
 
-                command = "ctags -x -R -f - ."
-                (rc, output) = commands.getstatusoutput(command)
-                logging.debug('called ctags (rc=%s): %s' % (rc, command))
 
-                for tag in output.split('\n'):
-                    try:
-                        (name, ctype, line, path, extra) = tag.split(None, 4)
-                    except:
-                        continue
+    def add_ctag_records(self, tid, pid, records):
+        """
+        Function to insert the ctags found in each tarball into the database
+        """
+        logging.debug('in Source.add_ctag_records(%s, %s, %d sources)' % (tid, pid, len(records)))
+
+        # get the s_records for this package's sources from the db
+        sids = SRPM_Source.get_ids(pid)
+
+        # written a batch at a time, rather than building every row first
+        count = 0
+        rows  = []
+        for (fname, ctags) in records:
+            sid = sids.get(fname)
+            if not sid:
+                logging.critical('!!!!! adding files from %s failed...' % fname)
+                # don't bail, it's logged, continue
+                #sys.exit(1)
+                continue
 
-                    # only store some ctags info, not all of it
-                    if ctype in self.ctag_map:
-                        self.rcommon.show_progress()
-                        try:
-                            c = SRPM_Ctag.create(
-                                tid   = tid,
-                                pid   = pid,
-                                sid   = sid,
-                                name  = name,
-                                ctype = self.ctag_map[ctype],
-                                line  = line,
-                                file  = path,
-                                extra = extra
-                            )
-                            logging.debug('Filed Ctag with id %d', c.id)
-                        except Exception, e:
-                            logging.error('Adding ctag %s for file %s failed!\n%s', name, fname, e)
-
-                os.chdir(cpio_dir)
-
-                # make sure this is empty or it will eat lots of memory
-                output = None
-
-                logging.debug('Removing temporary directory: %s...' % tmpdir)
-                try:
-                    shutil.rmtree(tmpdir)
-                except:
-                    # if we can't remove the directory, recursively chmod and try again
-                    os.system('chmod -R u+rwx ' + tmpdir)
-                    shutil.rmtree(tmpdir)
-
-
-    def add_buildreq_records(self, tid, pid, cpio_dir):
+            for (name, ctype, line, path, extra) in ctags:
+                self.rcommon.show_progress()
+                rows.append({'tid'  : tid,
+                             'pid'  : pid,
+                             'sid'  : sid,
+                             'name' : name,
+                             'ctype': ctype,
+                             'line' : line,
+                             'file' : path,
+                             'extra': extra})
+                if len(rows) == self.batch_size:
+                    count += SRPM_Ctag.bulk_insert(rows, self.batch_size)
+                    rows   = []
+
+        count += SRPM_Ctag.bulk_insert(rows, self.batch_size)
+        logging.debug('Filed %d ctags for pid %d', count, pid)
+        return count
+
+
+    def get_buildreqs(self, cpio_dir):
         """
         Get the build requirements for this package from the spec file
         """
-        logging.debug('in Source.add_buildreq_records(%s, %s, %s)' % (tid, pid, cpio_dir))
+        logging.debug('in Source.get_buildreqs(%s)' % cpio_dir)
 
         specfile = ''
         r        = []
@@ -709,55 +959,72 @@ class Source:
                     new = reqs[0]
                 r.append(new)
 
-        for require in r:
-            # now iterate through each item and add them to the database
-            self.rcommon.show_progress()
+        return r
 
-            self.get_buildreq_record(require)
 
-            # record == p_record
-            try:
-                b = SRPM_BuildRequires.create(
-                    tid  = tid,
-                    pid  = pid,
-                    name = require
-                )
-                logging.debug('Filed BuildRequires with id %d', b.id)
-            except Exception, e:
-                logging.error('Unable to add buildrequires %s to database!\n%s', require, e)
+    def add_archive_records(self, tid, pid, archives):
+        """
+        Function to record the digests of a package's tarballs and to copy the files and
+        ctags of those that were already in the database from the source they were stored
+        with; returns a tuple of the number of files and ctags copied
+        """
+        logging.debug('in Source.add_archive_records(%s, %s, %s)' % (tid, pid, archives))
+
+        if not archives:
+            return (0, 0)
+
+        sids   = SRPM_Source.get_ids(pid)
+        cached = SRPM_Archive.get_sids(set(digest for (digest, known) in archives.values() if known))
+        rows   = []
+        files  = 0
+        ctags  = 0
+        for (sfile, (digest, known)) in archives.items():
+            sid = sids.get(sfile)
+            if not sid:
+                continue
+            if known:
+                if digest not in cached:
+                    # in the database when the package was analyzed, but since removed
+                    logging.warning('Listing of %s (%s) is missing, not recording its files', sfile, digest)
+                    continue
+                logging.debug('copying files and ctags of %s from source %d' % (sfile, cached[digest]))
+                files += SRPM_Archive.copy_rows(SRPM_File, cached[digest], tid, pid, sid)
+                ctags += SRPM_Archive.copy_rows(SRPM_Ctag, cached[digest], tid, pid, sid)
+            rows.append({'tid': tid, 'pid': pid, 'sid': sid, 'digest': digest})
 
-        # make sure its empty
-        del r[:]
+        SRPM_Archive.bulk_insert(rows, self.batch_size)
+        if self.archived is not None:
+            self.archived.update(row['digest'] for row in rows)
+        return (files, ctags)
 
 
-    def cache_get_buildreq(self, name):
+    def add_buildreq_records(self, tid, pid, r):
         """
-        Function to look up the n_record and add it to the cache for buildreqs
+        Add the build requirements for this package to the database
         """
-        bid = SRPM_BuildRequires.get_id(name)
-        if bid:
-            # add to the cache
-            self.breq_cache[name] = bid
-            return bid
-        else:
-            return False
+        logging.debug('in Source.add_buildreq_records(%s, %s, %s)' % (tid, pid, r))
 
+        rows = []
+        for require in r:
+            # now iterate through each item and add them to the database
+            self.rcommon.show_progress()
 
-    def get_buildreq_record(self, name):
-        """
-        Function to lookup and cache buildrequires info
-        """
+            # record == p_record
+            rows.append({'tid': tid, 'pid': pid, 'name': require})
 
-        # first check the cache
-        if name in self.breq_cache:
-            return self.breq_cache[name]
+        return SRPM_BuildRequires.bulk_insert(rows, self.batch_size)
 
-        # not cached, check the database
-        bid = self.cache_get_buildreq(name)
-        if bid:
-            return bid
 
-        return None
+    def add_trigram_records(self, tid, pid):
+        """
+        Function to add the trigram index entries for the ctags of a package; file basenames
+        are indexed when they are added
+        """
+        logging.debug('in Source.add_trigram_records(%s, %s)' % (tid, pid))
+
+        query = SRPM_Ctag.select(SRPM_Ctag.id, SRPM_Ctag.name).where(SRPM_Ctag.pid == pid)
+        ctags = [(c.id, c.name) for c in query]
+        SRPM_CtagTrigram.bulk_insert(search.trigram_rows(tid, ctags), self.batch_size)
 
 
     def rpm_add_directory(self, tag, path, updatepath):
@@ -796,74 +1063,231 @@ class Source:
             logging.critical('Unable to add tag "%s" to the database!' % tag)
             sys.exit(1)
 
+        srpms = []
         for fname in file_list:
             if not os.path.isfile(fname):
                 print 'File %s not found!\n' % fname
             elif not self.re_srpm.search(fname):
                 print 'File %s is not a source rpm!\n' % fname
             else:
-                self.record_add(tag_id, fname)
+                srpms.append(fname)
+
+        self.import_files(tag_id, srpms)
 
         # make sure its empty
         del file_list[:]
 
 
+    def import_files(self, tag_id, file_list, update=0):
+        """
+        Function to import a list of source RPMs; the package analysis is spread
+        across --jobs worker processes and the results are written to the database,
+        in file_list order, by this process alone
+        """
+        logging.debug('in Source.import_files(%s, %d files, %d)' % (tag_id, len(file_list), update))
+
+        for fname in file_list:
+            self.rcommon.file_rpm_check(fname)
+
+        file_list = self.skip_present(tag_id, file_list)
+
+        # loaded before the workers are started so that they all get a copy
+        self.load_archived()
+        self.load_ctags_maps()
+
+        for (fname, pkg) in pool.analyze(self.analyze_package, file_list, self.options.jobs):
+            if not pkg:
+                print 'Unable to analyze %s, skipping it!' % fname
+                continue
+            self.store_package(tag_id, pkg, update)
+
+
+    def skip_present(self, tid, file_list):
+        """
+        Function to drop the packages that are already in the tag from file_list before
+        they are analyzed; the header cache makes this a stat() for packages it has seen
+        """
+        present = set((p.package, p.version, p.release) for p in SRPM_Package.get_packages(tid))
+        if not present:
+            return file_list
+
+        headers = self.rtag.header_cache()
+        tag     = SRPM_Tag.get_tag(tid)
+        srpms   = []
+        for fname in file_list:
+            try:
+                meta = headers.get(fname)
+            except header.HeaderError:
+                # analyze_package() will report it
+                srpms.append(fname)
+                continue
+            if (meta.name, meta.version, meta.release) in present:
+                print 'File %s-%s-%s is already in the database under tag %s' % (meta.name, meta.version, meta.release, tag)
+            else:
+                srpms.append(fname)
+        headers.commit()
+        return srpms
+
+
     def record_add(self, tag_id, fname, update=0):
         """
         Function to add a record to the database
         """
         logging.debug('in Source.record_add(%s, %s, %d)' % (tag_id, fname, update))
 
-        if os.path.isfile(fname):
-            path = os.path.abspath(os.path.dirname(fname))
-        else:
-            path = os.path.abspath(fname)
-        logging.debug('Path:\t%s' % path)
-
         self.rcommon.file_rpm_check(fname)
 
-        record = self.package_add_record(tag_id, fname, update)
-        if not record:
-            return
+        self.load_archived()
+        self.store_package(tag_id, self.analyze_package(fname), update)
 
-        file_list = self.rcommon.rpm_list(fname)
-        if not file_list:
-            return
 
-        logging.debug('Add source records for package record: %s' % record)
-        self.add_records(tag_id, record, file_list)
-        cpio_dir = tempfile.mkdtemp()
+    def load_archived(self):
+        """
+        Function to load the digests of the tarballs that are already in the database,
+        so that analyze_package() doesn't have to unpack them again
+        """
+        if self.archived is None:
+            self.archived = SRPM_Archive.get_digests()
+            logging.debug('%d tarballs are already in the database' % len(self.archived))
+
 
+    def analyze_package(self, fname):
+        """
+        Function to collect everything we record about a source package; this does
+        not touch the database so it is safe to run in a worker process
+        """
+        logging.debug('in Source.analyze_package(%s)' % fname)
+
+        hdr = header.Header(fname)
+
+        pkg = {'rpm'      : fname,
+               'fullname' : fname,
+               'package'  : hdr.name,
+               'version'  : hdr.version,
+               'release'  : hdr.release,
+               'epoch'    : hdr.epoch,
+               'date'     : hdr.buildtime,
+               'sources'  : self.rcommon.rpm_list(hdr),
+               'files'    : [],
+               'ctags'    : [],
+               'archives' : {},
+               'buildreqs': []}
+
+        if not pkg['sources']:
+            return pkg
+
+        # tarballs are known by the digest the header has for them; those that are already
+        # in the database are not unpacked, their files and ctags are copied when storing
+        archived = self.archived or set()
+        digests  = dict((f.path.split('/')[-1], f.digest) for f in hdr.files if f.digest and self.re_tar.search(f.path))
+        skip     = set(sfile for (sfile, digest) in digests.items() if digest in archived)
+
+        cpio_dir = tempfile.mkdtemp(dir=self.scratch_dir)
         try:
+            # only the tarballs that were read all the way through and that ctags indexed
+            # without an error are worth remembering
+            indexed = set()
+            (pkg['files'], pkg['ctags']) = self.read_sources(hdr, pkg['sources'], cpio_dir, skip=skip, indexed=indexed)
+            pkg['archives'] = dict((sfile, (digest, sfile in skip)) for (sfile, digest) in digests.items()
+                                   if sfile in skip or sfile in indexed)
             current_dir = os.getcwd()
-            os.chdir(cpio_dir)
-            self.get_all_files(fname)
-            self.add_file_records(tag_id, record, file_list)
-            self.add_ctag_records(tag_id, record, cpio_dir)
-            self.add_buildreq_records(tag_id, record, cpio_dir)
+            pkg['buildreqs'] = self.get_buildreqs(cpio_dir)
             os.chdir(current_dir)
         finally:
             logging.debug('Removing temporary directory: %s...' % cpio_dir)
             shutil.rmtree(cpio_dir)
 
+        return pkg
+
+
+    def store_package(self, tag_id, pkg, update=0):
+        """
+        Function to write an analyzed source package to the database
+        """
+        logging.debug('in Source.store_package(%s, %s, %d)' % (tag_id, pkg['rpm'], update))
+
+        # tarballs that were in the database when the package was analyzed may have been
+        # removed with their packages since, in which case they have to be read after all
+        self.relist_archives(pkg)
+
+        # the package and everything that hangs off of it go in as one transaction
+        # so that a failure part way through doesn't leave a half-imported package
+        # behind that in_db() would then consider to be present
+        try:
+            with srpm_db.atomic():
+                record = self.package_add_record(tag_id, pkg, update)
+                if not record:
+                    return
+
+                counts = {'packages': 1, 'updates': update}
+                if pkg['sources']:
+                    logging.debug('Add source records for package record: %s' % record)
+                    counts.update(sources   = self.add_records(tag_id, record, pkg['sources']),
+                                  files     = self.add_file_records(tag_id, record, pkg['files']),
+                                  ctags     = self.add_ctag_records(tag_id, record, pkg['ctags']),
+                                  buildreqs = self.add_buildreq_records(tag_id, record, pkg['buildreqs']))
+                    (files, ctags)   = self.add_archive_records(tag_id, record, pkg['archives'])
+                    counts['files'] += files
+                    counts['ctags'] += ctags
+                    if self.trigram_index:
+                        self.add_trigram_records(tag_id, record)
+                SRPM_TagStats.add(tag_id, **counts)
+        except Exception, e:
+            logging.error('Adding package %s failed, rolled back!\n%s', pkg['rpm'], e)
+            print 'Unable to add %s to the database!' % os.path.basename(pkg['rpm'])
+            # any directory names or tarballs added in the transaction are gone too
+            self.dirname_cache = {}
+            self.archived      = None
+            return
+
         if self.options.progress:
             sys.stdout.write('\n')
 
 
-    def package_add_record(self, tid, fname, update=0):
+    def relist_archives(self, pkg):
+        """
+        Function to list and run ctags over the tarballs of an analyzed package that were
+        skipped as already in the database but whose files and ctags are no longer there
+        """
+        known  = dict((sfile, digest) for (sfile, (digest, known)) in pkg['archives'].items() if known)
+        cached = SRPM_Archive.get_sids(set(known.values()))
+        stale  = set(sfile for (sfile, digest) in known.items() if digest not in cached)
+        if not stale:
+            return
+        logging.debug('in Source.relist_archives(%s, %s)' % (pkg['rpm'], sorted(stale)))
+
+        if self.archived is not None:
+            self.archived.difference_update(known[sfile] for sfile in stale)
+
+        # everything but the tarballs we lack is in pkg already
+        sources  = set(pkg['sources'][x]['file'].split('/')[-1] for x in pkg['sources'].keys())
+        indexed  = set()
+        cpio_dir = tempfile.mkdtemp(dir=self.scratch_dir)
+        try:
+            (files, ctags) = self.read_sources(header.Header(pkg['rpm']), pkg['sources'], cpio_dir,
+                                               patches=False, skip=sources - stale, indexed=indexed)
+        finally:
+            logging.debug('Removing temporary directory: %s...' % cpio_dir)
+            shutil.rmtree(cpio_dir)
+
+        pkg['files'].extend(files)
+        pkg['ctags'].extend(ctags)
+        for sfile in stale:
+            if sfile in indexed:
+                pkg['archives'][sfile] = (known[sfile], False)
+            else:
+                del pkg['archives'][sfile]
+
+
+    def package_add_record(self, tid, pkg, update=0):
         """
         Function to add a package record
         """
-        logging.debug('in Source.package_add_record(%s, %s, %d)' % (tid, fname, update))
+        logging.debug('in Source.package_add_record(%s, %s, %d)' % (tid, pkg['rpm'], update))
 
-        name    = os.path.basename(fname)
-        rpmtags = commands.getoutput("rpm -qp --nosignature --qf '%{NAME}|%{VERSION}|%{RELEASE}|%{BUILDTIME}' " + self.rcommon.clean_shell(fname))
-        tlist   = rpmtags.split('|')
-        logging.debug("tlist is %s " % tlist)
-        package = tlist[0].strip()
-        version = tlist[1].strip()
-        release = tlist[2].strip()
-        pdate   = tlist[3].strip()
+        package = pkg['package']
+        version = pkg['version']
+        release = pkg['release']
 
         tag   = SRPM_Tag.get_tag(tid)
 
@@ -874,21 +1298,19 @@ class Source:
         # TODO: we shouldn't have to have p_tag here as t_record has the same info, but it
         # TODO: sure makes it easier to sort alphabetically and I'm too lazy for the JOINs right now
 
-        self.rcommon.show_progress(name)
-        try:
-            p = SRPM_Package.create(
-                tid      = tid,
-                package  = package,
-                version  = version,
-                release  = release,
-                date     = pdate,
-                fullname = fname,
-                update   = update
-            )
-            return p.id
-        except Exception, e:
-            logging.error('Adding file %s failed!\n%s', fname, e)
-            return 0
+        self.rcommon.show_progress(os.path.basename(pkg['rpm']))
+        p = SRPM_Package.create(
+            tid      = tid,
+            package  = package,
+            version  = version,
+            release  = release,
+            epoch    = pkg['epoch'],
+            evr      = evr.evr_key(pkg['epoch'], version, release),
+            date     = pkg['date'],
+            fullname = pkg['fullname'],
+            update   = update
+        )
+        return p.id
 
 
     def list_updates(self, tag):
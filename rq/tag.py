@@ -24,11 +24,14 @@ import sys
 import datetime
 import logging
 import os
-import commands
 from glob import glob
-from app.models import RPM_Tag, RPM_Package, RPM_Requires, RPM_Provides, RPM_File, RPM_Flags, RPM_Symbols, \
+from peewee import MySQLDatabase
+from . import headercache
+from . import evr
+from app.models import RPM_Tag, RPM_Package, RPM_Requires, RPM_Provides, RPM_File, RPM_Analysis, RPM_Symbols, \
     RPM_AlreadySeen, SRPM_Package, SRPM_Tag, SRPM_BuildRequires, SRPM_Ctag, SRPM_Source, SRPM_File, SRPM_AlreadySeen, \
-    rpm_db, srpm_db
+    RPM_FileTrigram, RPM_SymbolTrigram, SRPM_FileTrigram, SRPM_CtagTrigram, RPM_User, RPM_Group, rpm_db, srpm_db, \
+    RPM_Dirname, RPM_Basename, SRPM_Dirname, SRPM_Basename, RPM_TagStats, SRPM_TagStats, SRPM_Archive, create_indexes
 
 
 class Tag:
@@ -43,6 +46,18 @@ class Tag:
         self.config  = config
         self.rcommon = rcommon
         self.options = options
+        self.headers = None
+
+    def header_cache(self):
+        """
+        Return the header cache, opening it the first time it is needed; header_cache in
+        the configuration file sets where it is kept, and an empty value turns it off
+        """
+        if self.headers is None:
+            path         = self.config.get('header_cache', '~/.rqheaders')
+            self.headers = headercache.HeaderCache(os.path.expanduser(path))
+        return self.headers
+
 
     def list(self):
         """
@@ -54,14 +69,17 @@ class Tag:
 
         if self.type == 'binary':
             results = RPM_Tag.get_list()
+            stats   = RPM_TagStats
         else:
             results = SRPM_Tag.get_list()
+            stats   = SRPM_TagStats
 
         if results:
             for row in results:
                 updated = ''
-                c_pkgs  = row.package_count
-                c_upd   = row.update_count
+                counts  = stats.get_counts(row.id)
+                c_pkgs  = counts['packages']
+                c_upd   = counts['updates']
                 if row.update_date:
                     updated = ' / Updated: %s' % row.update_date
                 print 'Tag: %-22sPackages: %-15sUpdates: %s\n  Added: %-18s%s\n  Path       : %s\n  Update Path: %s\n' % (
@@ -148,8 +166,8 @@ class Tag:
 
     def delete_entries(self, tag):
         """
-        Delete database tags and associated entries; optimizes the database if there are a lot of entries
-        to remove
+        Delete database tags and associated entries; every table is emptied of the tag's rows a
+        batch at a time, children before parents, before the tag itself is removed
 
         :param tag: the tag to delete
         :return: nothing
@@ -180,19 +198,24 @@ class Tag:
                 sys.stdout.write('Removing %s tagged %s %s for %s... ' % (result, word_package, word_entry, tag))
                 sys.stdout.flush()
 
-                if result > 500:
-                    self.optimize_db()
-
-                # now delete the tag entry itself
                 if self.type == 'binary':
-                    RPM_Flags.delete_tags(tid['id'])
-                    RPM_Symbols.delete_tags(tid['id'])
+                    models = [RPM_Provides, RPM_Requires, RPM_File, RPM_AlreadySeen, RPM_Package, RPM_TagStats]
                 else:
-                    print 'deleting sources'
-                    SRPM_Ctag.delete_tags(tid['id'])
-                    SRPM_File.delete_tags(tid['id'])
+                    models = [SRPM_CtagTrigram, SRPM_Ctag, SRPM_File, SRPM_Archive, SRPM_BuildRequires, SRPM_AlreadySeen,
+                              SRPM_Source, SRPM_Package, SRPM_TagStats]
 
+                def progress(removed):
+                    sys.stdout.write('.')
+                    sys.stdout.flush()
+
+                for model in models:
+                    removed = model.delete_tags(tid['id'], progress=progress)
+                    logging.info('Removed %d rows from %s' % (removed, model._meta.db_table))
+
+                # now delete the tag entry itself; there is nothing left for recursive to remove,
+                # it is only there in case a table has been missed
                 t.delete_instance(recursive=True)
+                self.prune()
 
                 sys.stdout.write(' done\n')
             else:
@@ -208,7 +231,9 @@ class Tag:
         sys.stdout.write('Optimizing database (this may take some time)... ')
         sys.stdout.flush()
         if self.type == 'binary':
-            RPM_Flags.optimize()
+            RPM_FileTrigram.optimize()
+            RPM_SymbolTrigram.optimize()
+            RPM_Analysis.optimize()
             RPM_Symbols.optimize()
             RPM_File.optimize()
             RPM_Provides.optimize()
@@ -216,17 +241,89 @@ class Tag:
             RPM_Package.optimize()
             RPM_Tag.optimize()
             RPM_AlreadySeen.optimize()
+            RPM_Dirname.optimize()
+            RPM_Basename.optimize()
         else:
+            SRPM_FileTrigram.optimize()
+            SRPM_CtagTrigram.optimize()
             SRPM_Ctag.optimize()
             SRPM_File.optimize()
+            SRPM_Archive.optimize()
             SRPM_Source.optimize()
             SRPM_BuildRequires.optimize()
             SRPM_AlreadySeen.optimize()
             SRPM_Tag.optimize()
             SRPM_Package.optimize()
+            SRPM_Dirname.optimize()
+            SRPM_Basename.optimize()
         sys.stdout.write(' done\n')
 
 
+    def prune(self):
+        """
+        Remove the analyses, directories and basenames that no file refers to any more,
+        after packages have been removed
+        """
+        logging.debug('in Tag.prune()')
+
+        if self.type == 'binary':
+            RPM_Analysis.prune()
+            RPM_Dirname.prune(RPM_File.did)
+            RPM_Basename.prune(RPM_File.bid, RPM_FileTrigram)
+        else:
+            SRPM_Dirname.prune(SRPM_File.did)
+            SRPM_Basename.prune(SRPM_File.bid, SRPM_FileTrigram)
+
+
+    def migrate(self):
+        """
+        Add any tables and lookup indexes that are missing from an existing database; those
+        that are already there are left alone, so this is safe to run more than once
+        """
+        logging.debug('in Tag.migrate()')
+
+        sys.stdout.write('Adding missing tables and indexes (this may take some time)... ')
+        sys.stdout.flush()
+        if self.type == 'binary':
+            rpm_db.create_tables([RPM_TagStats], True)
+            created = create_indexes(rpm_db, [RPM_Tag, RPM_User, RPM_Group, RPM_Package, RPM_File, RPM_AlreadySeen])
+        else:
+            srpm_db.create_tables([SRPM_TagStats, SRPM_Archive], True)
+            created = create_indexes(srpm_db, [SRPM_Tag, SRPM_Package, SRPM_Source, SRPM_File, SRPM_Archive,
+                                               SRPM_AlreadySeen])
+        sys.stdout.write(' done\n')
+
+        if created:
+            for name in created:
+                print 'Created index %s' % name
+        else:
+            print 'All indexes are already present'
+
+
+    def recount(self):
+        """
+        Rebuild the tag statistics by counting the rows of every tag, in case they no longer
+        match the tables (for instance after rows were removed by hand)
+        """
+        logging.debug('in Tag.recount()')
+
+        if self.type == 'binary':
+            tags  = RPM_Tag.get_list()
+            stats = RPM_TagStats
+        else:
+            tags  = SRPM_Tag.get_list()
+            stats = SRPM_TagStats
+
+        for t in tags:
+            sys.stdout.write('Counting the entries of tag %s... ' % t.tag)
+            sys.stdout.flush()
+            counts = stats.recount(t.id)
+            sys.stdout.write('%d packages\n' % counts['packages'])
+        if self.type == 'binary':
+            # analyses and symbols are shared between tags, so they are counted once
+            stats.recount(None)
+
+
     def update_entries(self, rq, tag, listonly=False):
         """
         Update entries for a given tag (for rqs)
@@ -268,37 +365,33 @@ class Tag:
             path    = u_path
             updates = 1
 
+        # everything the plan needs from the database is loaded in one query each, and
+        # packages are matched by the file name they have on disk
+        if self.type == 'binary':
+            packages = RPM_Package.get_packages(tid)
+            seen     = RPM_AlreadySeen.get_fullnames(tid)
+        else:
+            packages = SRPM_Package.get_packages(tid)
+            seen     = SRPM_AlreadySeen.get_fullnames(tid)
+        in_db   = dict((os.path.basename(package.fullname), package) for package in packages)
+        seen    = set(os.path.basename(fullname) for fullname in seen)
+        headers = self.header_cache()
+
         if updates == 0 and path:
             if not os.path.isdir(path):
                 logging.critical('Tag path %s does not exist!' % path)
                 sys.exit(1)
             # this handles entries where we don't have a dedicated updates directory
             print 'Checking for removed files in %s tag entries from %s...' % (tag, path)
-            # get the existing entries
-            if self.type == 'binary':
-                result = RPM_Package.select(RPM_Package.tid == tid)
-            else:
-                result = SRPM_Package.select(SRPM_Package.tid == tid)
-            for row in result:
-                fullname = '%s/%s' % (path, row.fullname)
-                if not os.path.isfile(fullname):
-                    logging.info('  %s missing: %s' % (pkg_type, row.fullname))
-                    to_remove.append(row.id)
-
-            src_list = glob(path + "/*.rpm")
-            src_list.sort()
+            on_disk = dict((os.path.basename(src_rpm), src_rpm) for src_rpm in glob(path + "/*.rpm"))
+            for sfname in sorted(set(in_db) - set(on_disk)):
+                logging.info('  %s missing: %s' % (pkg_type, sfname))
+                to_remove.append(in_db[sfname].id)
 
             print 'Checking for added files in %s tag entries from %s...' % (tag, path)
-            for src_rpm in src_list:
-                sfname = os.path.basename(src_rpm)
-                if self.type == 'binary':
-                    if not RPM_Package.exists(tid, sfname):
-                        logging.info('Scheduling %s to be added to database' % src_rpm)
-                        to_add.append(src_rpm)
-                else:
-                    if not SRPM_Package.exists(tid, sfname):
-                        logging.info('Scheduling %s to be added to database' % src_rpm)
-                        to_add.append(src_rpm)
+            for sfname in sorted(set(on_disk) - set(in_db)):
+                logging.info('Scheduling %s to be added to database' % on_disk[sfname])
+                to_add.append(on_disk[sfname])
 
         if updates == 1 and u_path:
             # this is an entry with an updates path
@@ -306,84 +399,65 @@ class Tag:
                 logging.critical('Tag updates path %s does not exist!' % u_path)
                 sys.exit(1)
 
-            src_list = glob(path + "/*.rpm")
-            src_list.sort()
-
             print 'Checking for added files in %s tag entries from %s...' % (tag, path)
-            for src_rpm in src_list:
-                sfname = os.path.basename(src_rpm)
-
+            on_disk = dict((os.path.basename(src_rpm), src_rpm) for src_rpm in glob(path + "/*.rpm"))
+
+            """
+            # see file, look in packages and alreadyseen, if:
+            #  not in packages, not in alreadyseen: new
+            #  in packages, not in alreadyseen: release package
+            #  in packages, in alreadyseen: should never happen
+            #  not in packages, in alreadyseen: old package
+            # if new, add it, delete old one from packages, add to alreadyseen
+            """
+            # only files that are in neither the database nor the already-seen list
+            # need their header looked at
+            candidates = sorted(set(on_disk) - set(in_db) - seen)
+            logging.debug('We have already seen %d files' % len(set(on_disk) & seen - set(in_db)))
+
+            # when looking at binaries, we need to include the arch for uniqueness otherwise
+            # we get the first hit, which might be i386 when we're looking at a new i686 pkg
+            by_name = {}
+            for package in packages:
                 if self.type == 'binary':
-                    exists = RPM_Package.exists(tid, sfname)
+                    by_name.setdefault((package.package, package.arch), []).append(package)
                 else:
-                    exists = SRPM_Package.exists(tid, sfname)
+                    by_name.setdefault(package.package, []).append(package)
 
-                if not exists:
-                    # this means we do not have this package currently in the database
-                    # so check if we have already seen and removed it
-                    if self.type == 'binary':
-                        alreadyseen = RPM_AlreadySeen.exists(tid, sfname)
-                    else:
-                        alreadyseen = SRPM_AlreadySeen.exists(tid, sfname)
-
-                    if not alreadyseen:
-                        # this is a new file that does not exist in the database, but it's
-                        # in the updates directory and we have not seen it before
-
-                        """
-                        # see file, look in packages and alreadyseen, if:
-                        #  not in packages, not in alreadyseen: new
-                        #  in packages, not in alreadyseen: release package
-                        #  in packages, in alreadyseen: should never happen
-                        #  not in packages, in alreadyseen: old package
-                        # if new, add it, delete old one from packages, add to alreadyseen
-                        """
-
-                        # this file is not in our db, so we need to see if this is an updated package
-                        rpmtags = commands.getoutput("rpm -qp --nosignature --qf '%{NAME}|%{ARCH}' " + self.rcommon.clean_shell(src_rpm))
-                        tlist   = rpmtags.split('|')
-                        logging.debug("tlist is %s " % tlist)
-                        r_pkg  = tlist[0].strip()
-                        r_arch = tlist[1].strip()
-                        if self.type == 'source':
-                            result = SRPM_Package.select().where(
-                                        (SRPM_Package.tid == tid) &
-                                        (SRPM_Package.package == r_pkg))
-                        elif self.type == 'binary':
-                            # when looking at binaries, we need to include the arch for uniqueness otherwise
-                            # we get the first hit, which might be i386 when we're looking at a new i686 pkg
-                            result = RPM_Package.select().where(
-                                        (RPM_Package.tid == tid) &
-                                        (RPM_Package.package == r_pkg) &
-                                        (RPM_Package.arch == r_arch))
-
-                        if result:
-                            # we have a package record of the same name in the database
-                            # this means we need to mark the old package as seen, remove
-                            # the old package, and add this new package
-                            for package in result:
-                                if package.id:
-                                    logging.info('Found an already-in-updates record for %s (ID: %d, %s)' % (sfname, package.id, package.fullname))
-                                    to_add.append(src_rpm)
-                                    if package.id not in to_remove:
-                                        to_remove.append(package.id)
-                                    logging.debug('Scheduling %s to be added to already-seen list' % package.fullname)
-                                    have_seen.append(package.fullname)
-                        else:
-                            # we do NOT have a matching package record of the same name
-                            # that makes this a new package to add, and there is nothing
-                            # to remove
-                            logging.debug('New package found: %s' % src_rpm)
-                            self.rcommon.show_progress()
-                            newpkgs = newpkgs + 1
-                            to_add.append(src_rpm)
-                    else:
-                        logging.debug('We have already seen %s' % sfname)
+            for sfname in candidates:
+                # this file is not in our db, so we need to see if this is an updated package
+                src_rpm = on_disk[sfname]
+                meta    = headers.get(src_rpm)
+                if self.type == 'binary':
+                    result = by_name.get((meta.name, meta.arch))
+                else:
+                    result = by_name.get(meta.name)
+
+                if result:
+                    # we have a package record of the same name in the database
+                    # this means we need to mark the old package as seen, remove
+                    # the old package, and add this new package
+                    for package in result:
+                        logging.info('Found an already-in-updates record for %s (ID: %d, %s)' % (sfname, package.id, package.fullname))
+                        to_add.append(src_rpm)
+                        if package.id not in to_remove:
+                            to_remove.append(package.id)
+                        logging.debug('Scheduling %s to be added to already-seen list' % package.fullname)
+                        have_seen.append(package.fullname)
+                else:
+                    # we do NOT have a matching package record of the same name
+                    # that makes this a new package to add, and there is nothing
+                    # to remove
+                    logging.debug('New package found: %s' % src_rpm)
+                    self.rcommon.show_progress()
+                    newpkgs = newpkgs + 1
+                    to_add.append(src_rpm)
 
         # here we need to weed out any extras; in the case of first updating
         # an updates directory with multiple similar packages (e.g multiple
         # seamonkey packages) we only want the latest version
         (to_add, have_seen) = self.trim_update_list(to_add, have_seen)
+        headers.commit()
 
         if to_remove:
             if listonly:
@@ -400,72 +474,49 @@ class Tag:
             else:
                 print 'Updating %d packages, adding %d new packages%s (%d total updates)' % (existing, newpkgs, removetext, len(to_add))
 
-        r_count = 0
-        if to_remove and not listonly:
-            sys.stdout.write('\nRemoving tagged entries for tag: %s... ' % tag)
-            # if self.type == 'binary':
-            #     tables = ('packages', 'requires', 'provides', 'files')
-            # if self.type == 'source':
-            #     tables = ('packages', 'sources', 'files', 'ctags', 'buildreqs')
-
-            for rnum in to_remove:
-                r_count = r_count + 1
-                if self.type == 'binary':
-                    p = RPM_Package.get(RPM_Package.id == rnum)
-                else:
-                    p = SRPM_Package.get(SRPM_Package.id == rnum)
-                p.delete_instance(recursive=True)
-
-            sys.stdout.write(' done\n')
-
-            if r_count > 100:
-                # we could potentially be removing a lot of stuff here, so the package
-                # count needs to be set fairly low as we're dropping buildreqs, ctags,
-                # etc. so even 10 packages could have a few thousand records all told
-                self.optimize_db()
+        # the old packages are removed after the new ones are in, so that whatever the new ones
+        # share with them (like the listings of unchanged source tarballs) is still there to be
+        # reused; an old package with the same name, version and release as a new one has to go
+        # first though, or the new one would be taken to be in the database already
+        blocking = []
+        if to_remove and to_add and not listonly:
+            adding   = set(self.package_key(headers.get(a_rpm)) for a_rpm in to_add)
+            blocking = [package.id for package in packages
+                        if package.id in to_remove and self.package_key(package) in adding]
+            self.remove_packages(tag, tid, blocking)
 
         if to_add:
             if listonly:
                 print 'Would add the following tagged entries for tag: %s\n' % tag
+                for a_rpm in to_add:
+                    print '%s' % a_rpm
             else:
                 print 'Adding tagged entries for tag: %s:' % tag
-            for a_rpm in to_add:
-                if listonly:
-                    print '%s' % a_rpm
-                else:
+                for a_rpm in to_add:
                     logging.info('Adding: %s' % a_rpm)
-                    rq.record_add(tid, a_rpm, 1)  # the 1 is to indicate this is an update
+                rq.import_files(tid, to_add, 1)  # the 1 is to indicate this is an update
+
+        if to_remove and not listonly:
+            self.remove_packages(tag, tid, [rnum for rnum in to_remove if rnum not in blocking])
+            # done after the import so that binaries and paths which are still in the updated
+            # packages are kept rather than being analyzed and added all over again
+            self.prune()
 
         if have_seen and not listonly:
-            # make have_seen unique
-            hs = []
-            for tmp in have_seen:
-                if tmp not in hs:
-                    hs.append(tmp)
-                else:
-                    logging.debug('Discarding duplicate entry: %s' % tmp)
+            # only add what isn't in the already-seen table yet, and only once
+            rows = []
+            for hseen in have_seen:
+                sfname = os.path.basename(hseen)
+                if sfname in seen:
+                    logging.debug('Discarding duplicate entry: %s' % hseen)
+                    continue
+                seen.add(sfname)
+                rows.append({'tid': tid, 'fullname': hseen})
 
-            h_count = 0
-            for hseen in hs:
-                if self.type == 'binary':
-                    aseen = RPM_AlreadySeen.exists(tid, sfname)
-                else:
-                    aseen = SRPM_AlreadySeen.exists(tid, sfname)
-                if not aseen:
-                    # only add this to the database if we've not seen it
-                    # TODO: this should be unnecessary, but seems like we might get dupes otherwise right now
-                    h_count = h_count + 1
-                    if self.type == 'binary':
-                        h = RPM_AlreadySeen.create(
-                            fullname = hseen,
-                            tid      = tid
-                        )
-                    else:
-                        h = SRPM_AlreadySeen.create(
-                            fullname = hseen,
-                            tid      = tid
-                        )
-                    logging.debug('Added %s to alreadyseen table (id: %d)', hseen, h.id)
+            if self.type == 'binary':
+                h_count = RPM_AlreadySeen.bulk_insert(rows)
+            else:
+                h_count = SRPM_AlreadySeen.bulk_insert(rows)
             logging.debug('Added %d records to alreadyseen table', h_count)
 
         if not to_add and not to_remove:
@@ -480,6 +531,62 @@ class Tag:
             q.execute()
 
 
+    def package_key(self, package):
+        """
+        Function to return what tells packages apart within a tag, from either a package
+        record or the header of a package file
+        """
+        if hasattr(package, 'package'):
+            name = package.package
+        else:
+            name = package.name
+        if self.type == 'binary':
+            return (name, package.version, package.release, package.arch)
+        return (name, package.version, package.release)
+
+
+    def remove_packages(self, tag, tid, to_remove):
+        """
+        Function to remove packages from a tag, taking their rows off of the tag's counters
+        """
+        logging.debug('in Tag.remove_packages(%s, %d packages)' % (tag, len(to_remove)))
+
+        r_count = 0
+        if to_remove:
+            sys.stdout.write('\nRemoving tagged entries for tag: %s... ' % tag)
+            # if self.type == 'binary':
+            #     tables = ('packages', 'requires', 'provides', 'files')
+            # if self.type == 'source':
+            #     tables = ('packages', 'sources', 'files', 'ctags', 'buildreqs')
+
+            if self.type == 'binary':
+                database = rpm_db
+                stats    = RPM_TagStats
+            else:
+                database = srpm_db
+                stats    = SRPM_TagStats
+
+            for rnum in to_remove:
+                r_count = r_count + 1
+                with database.atomic():
+                    if self.type == 'binary':
+                        p = RPM_Package.get(RPM_Package.id == rnum)
+                    else:
+                        p = SRPM_Package.get(SRPM_Package.id == rnum)
+                    # counted before the rows are gone, taken off the tag's counters after
+                    counts = stats.count_rows(tid, rnum)
+                    p.delete_instance(recursive=True)
+                    stats.add(tid, **dict((name, -count) for (name, count) in counts.items()))
+
+            sys.stdout.write(' done\n')
+
+            if r_count > 100:
+                # we could potentially be removing a lot of stuff here, so the package
+                # count needs to be set fairly low as we're dropping buildreqs, ctags,
+                # etc. so even 10 packages could have a few thousand records all told
+                self.optimize_db()
+
+
     def trim_update_list(self, packagelist, seenlist):
         """
         Function to examine a list of packages scheduled for addition to the
@@ -492,48 +599,37 @@ class Tag:
         """
         logging.debug("in Tag.trim_update_list(%s, %s)" % (packagelist, seenlist))
 
-        templist = {}
+        newest   = {}
         newlist  = []
         new_seen = []
 
         for pkg in packagelist:
             sfname  = os.path.basename(pkg)
-            rpmtags = commands.getoutput("rpm -qp --nosignature --qf '%{NAME}|%{VERSION}|%{RELEASE}|%{BUILDTIME}|%{ARCH}' " + self.rcommon.clean_shell(pkg))
-            tlist   = rpmtags.split('|')
-            logging.debug("tlist is %s " % tlist)
-            package = tlist[0].strip()
-            version = tlist[1].strip()
-            release = tlist[2].strip()
+            meta    = self.header_cache().get(pkg)
 
             if self.type == 'source':
                 arch    = 'src'
             else:
-                arch    = tlist[4].strip()
-            uname   = '%s-%s' % (package, arch)
+                arch    = meta.arch
+            uname   = '%s-%s' % (meta.name, arch)
 
             # first, add everything we see to the already-seen list; later we'll remove
             # what gets stuffed into our updates list
             seenlist.append(sfname)
             logging.debug('Adding %s to the already-seen list' % sfname)
-            try:
-                if not templist[uname]:
-                    templist[uname] = [version, release, pkg, sfname]
-                    logging.debug('Adding %s(%s, %s, %s, %s, %s) to templist' % (package, version, release, pkg, sfname, arch))
-                else:
-                    bigger = self.nvr_compare(templist[uname], version, release)
-                    if bigger == 1:
-                        # this one has a higher nvr
-                        templist[uname] = [version, release, pkg, sfname]
-                        logging.debug('Adding replacement %s(%s, %s, %s, %s, %s) to templist' % (package, version, release, pkg, sfname, arch))
-            except:
-                templist[uname] = [version, release, pkg, sfname]
-                logging.debug('Adding %s(%s, %s, %s, %s) to templist' % (package, version, release, pkg, sfname))
+
+            # keep the newest of each name and arch; the keys sort the way rpm orders versions
+            key = evr.evr_key(meta.epoch, meta.version, meta.release)
+            if uname not in newest or key > newest[uname][0]:
+                newest[uname] = (key, pkg, sfname)
+                logging.debug('Keeping %s(%s, %s, %s, %s, %s) in the update list' % (meta.name, meta.epoch, meta.version,
+                                                                                     meta.release, pkg, arch))
 
         # reconstruct the old list to return, less what we don't want
         ns = []
-        for pkg in templist:
-            newlist.append(templist[pkg][2])
-            ns.append(templist[pkg][3])
+        for (key, pkg, sfname) in newest.values():
+            newlist.append(pkg)
+            ns.append(sfname)
 
         # reconstruct the new_seen list so it does not contain what is in newlist
         for pkg in seenlist:
@@ -549,83 +645,6 @@ class Tag:
         return(newlist, new_seen)
 
 
-    def nvr_compare(self, oldpkg, version, release):
-        """
-        TODO: we can get this from python-rpm and do it better
-        Function to compare version and release of two different RPM packages to see which is bigger
-        :param oldpkg:
-        :param version:
-        :param release:
-        :return:
-        """
-        def ncomp(old, new, type):
-            logging.debug('comparing %s old:%s and new:%s' % (type, old, new))
-            o = old.split('.')
-            n = new.split('.')
-
-            # need to make the array lengths the same, but we don't want to use 0's here
-            # otherwise 9.1.0 may not be higher than 9.1, which it should be, so use empty
-            # values instead to prevent the try statement below failing because o has more
-            # elements than n which makes python mad
-            len_o = len(o)
-            len_n = len(n)
-            if len_o > len_n:
-                num = len_o - len_n
-                x = 0
-                while x < num:
-                    n.append('')
-                    x = x + 1
-            elif len_n > len_o:
-                num = len_n - len_o
-                x = 0
-                while x < num:
-                    o.append('')
-                    x = x + 1
-
-            c = 0
-            b = 0
-            while c < len(o):
-                try:
-                    # first try comparing numerically, as by strings 3 > 15
-                    # which we don't want -- this is pretty simplistic though
-                    # as if we get 3a vs 15b we're hooped
-                    if int(n[c]) < int(o[c]):
-                        # immediately fail if smaller
-                        return(2)
-                    elif int(n[c]) > int(o[c]):
-                        b = 1
-                        c = c + 1
-                        break
-                except:
-                    # if that fails, compare as strings and hope for the best
-                    if n[c] < o[c]:
-                        # immediately fail if smaller
-                        return(2)
-                    if n[c] > o[c]:
-                        b = 1
-                        c = c + 1
-                        break
-                c = c + 1
-
-            return(b)
-
-        ver_is_bigger = ncomp(oldpkg[0], version, "version")
-
-        if ver_is_bigger == 1:
-            return(1)
-        elif ver_is_bigger == 2:
-            # version is smaller, immediately fail
-            return(0)
-        else:
-            # version is the same so check on release
-            rel_is_bigger = ncomp(oldpkg[1], release, "release")
-            if rel_is_bigger == 1:
-                return(1)
-
-        # if we get here, neither the release nor the version are bigger
-        return(0)
-
-
     def showdbstats(self, tag=None):
         """
         Show database statistics and info.  This function exits the program when done.
@@ -647,57 +666,49 @@ class Tag:
                 print 'No such tag: "%s" does not exist in the database!\n' % tag
                 sys.exit(1)
 
-        if tid:
-            if self.type == 'binary':
-                c_tags  = RPM_Tag.select().where(RPM_Tag.id == tid).count()
-                c_pkgs  = RPM_Package.select().where(RPM_Package.tid == tid).count()
-                c_files = RPM_File.select().where(RPM_File.tid == tid).count()
-                c_reqs  = RPM_Requires.select().where(RPM_Requires.tid == tid).count()
-                c_provs = RPM_Provides.select().where(RPM_Provides.tid == tid).count()
-                c_flags = RPM_Flags.select().where(RPM_Flags.tid == tid).count()
-                c_symbs = RPM_Symbols.select().where(RPM_Symbols.tid == tid).count()
+        # the counts come from the tag statistics rather than counting the rows of every table
+        if self.type == 'binary':
+            counts = RPM_TagStats.get_counts(tid)
+            if tid:
+                c_tags = 1
             else:
-                c_tags  = SRPM_Tag.select().where(SRPM_Tag.id == tid).count()
-                c_pkgs  = SRPM_Package.select().where(SRPM_Package.tid == tid).count()
-                c_files = SRPM_File.select().where(SRPM_File.tid == tid).count()
-                c_src   = SRPM_Source.select().where(SRPM_Tag.id == tid).count()
-                c_ctags = SRPM_Ctag.select().where(SRPM_Tag.id == tid).count()
-                c_breqs = SRPM_BuildRequires.select().where(SRPM_Tag.id == tid).count()
+                c_tags = RPM_Tag.select().count()
+            c_pkgs  = counts['packages']
+            c_files = counts['files']
+            c_reqs  = counts['requires']
+            c_provs = counts['provides']
+            c_flags = counts['flags']
+            c_symbs = counts['symbols']
         else:
-            if self.type == 'binary':
-                c_tags  = RPM_Tag.select().count()
-                c_pkgs  = RPM_Package.select().count()
-                c_files = RPM_File.select().count()
-                c_reqs  = RPM_Requires.select().count()
-                c_provs = RPM_Provides.select().count()
-                c_flags = RPM_Flags.select().count()
-                c_symbs = RPM_Symbols.select().count()
+            counts = SRPM_TagStats.get_counts(tid)
+            if tid:
+                c_tags = 1
             else:
-                c_tags  = SRPM_Tag.select().count()
-                c_pkgs  = SRPM_Package.select().count()
-                c_files = SRPM_File.select().count()
-                c_src   = SRPM_Source.select().count()
-                c_ctags = SRPM_Ctag.select().count()
-                c_breqs = SRPM_BuildRequires.select().count()
+                c_tags = SRPM_Tag.select().count()
+            c_pkgs  = counts['packages']
+            c_files = counts['files']
+            c_src   = counts['sources']
+            c_ctags = counts['ctags']
+            c_breqs = counts['buildreqs']
 
         # get the size of the database as well
         size   = 0.00
         btype  = ''
-        # TODO: use srpm_db if type == source
         if self.type == 'binary':
-            db   = rpm_db.database
-            user = rpm_db.connect_kwargs['user']
-            host = rpm_db.connect_kwargs['host']
+            database = rpm_db
         else:
-            db   = srpm_db.database
-            user = srpm_db.connect_kwargs['user']
-            host = srpm_db.connect_kwargs['host']
-        query = 'SELECT table_schema "name",  sum( data_length + index_length ) "size" FROM information_schema.TABLES \
-                 WHERE table_schema = "%s" GROUP BY table_schema' % db
-        tbsize = rpm_db.execute_sql(query)
-        for x in tbsize._rows:
-            if x[0] == db:
-                size = int(x[1])
+            database = srpm_db
+        db   = database.database
+        user = database.connect_kwargs.get('user')
+        host = database.connect_kwargs.get('host')
+        # only MySQL has information_schema
+        if isinstance(database, MySQLDatabase):
+            query = 'SELECT table_schema "name",  sum( data_length + index_length ) "size" FROM information_schema.TABLES \
+                     WHERE table_schema = "%s" GROUP BY table_schema' % db
+            tbsize = database.execute_sql(query)
+            for x in tbsize.fetchall():
+                if x[0] == db:
+                    size = int(x[1])
         count = 0
 
         while size > 1024:
@@ -14,6 +14,11 @@ test() {
     fi
 }
 
+# the regexp prefilter must leave patterns with POSIX bracket expressions to the database
+no_prefilter() {
+    python -c 'import sys; from rq.search import regexp_literals; sys.exit(regexp_literals(sys.argv[1]) != ("", []))' "${1}"
+}
+
 cd ..
 echo "drop database rq_binary; create database rq_binary; drop database rq_source; create database rq_source;" | mysql -u rq
 ./create_database.py
@@ -41,3 +46,13 @@ test "./rqs -u test -P"
 test "./rqs -x"
 test "./rqs -l"
 
+echo "******************************************"
+echo "Testing regexp queries"
+echo "******************************************"
+test "no_prefilter [[:digit:]]abc"
+test "no_prefilter [a[:alpha:]]bc"
+test "no_prefilter ^lib[[:<:]]z"
+test "no_prefilter [[:<:]]main[[:>:]]"
+test "./rqp -g -q [[:alpha:]]true"
+test "./rqp -g -q ^/usr/lib[[:<:]]"
+test "./rqs -g -z [[:<:]]main[[:>:]]"